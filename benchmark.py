@@ -0,0 +1,371 @@
+"""
+╔══════════════════════════════════════════════════════════════╗
+║           PIPELINE BENCHMARK - fully offline                 ║
+║                                                              ║
+║  Drives handle_private, handle_group and get_ai_response     ║
+║  with fake Pyrogram objects, a throwaway SQLite store (or    ║
+║  mongomock as a Mongo stand-in) and a stub Gemini backend,   ║
+║  then prints one JSON report.                                ║
+║                                                              ║
+║  Usage: python benchmark.py [--users N] [--messages N] ...   ║
+╚══════════════════════════════════════════════════════════════╝
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import itertools
+import argparse
+import contextlib
+import logging
+import platform
+import tempfile
+import tracemalloc
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+BENCH_ENV = {
+    "API_ID": "1",
+    "API_HASH": "benchmark",
+    "SESSION_STRING": "B" * 400,
+    "MONGO_URI": "",
+    "PORT": "0"
+}
+
+WORDS = (
+    "kal aaj bhai kya scene hai kaha tha movie dekhi match khela padhai exam result "
+    "ghar office kaam party khana chai coffee raat subah shaam weekend trip plan "
+    "phone call message reply photo video game cricket football gym dost family "
+    "paisa bill recharge net wifi laptop code bug deploy server meeting class notes "
+    "bahut thoda abhi baad jaldi late sahi galat mast bekar accha bura naya purana"
+).split()
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return round(ordered[index] * 1000, 2)
+
+def random_text(rng: random.Random, seq: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 9))) + f" {seq}"
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.first_name = f"Bench{user_id}"
+        self.is_bot = False
+
+class FakeChat:
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+
+class FakeMessage:
+    _ids = itertools.count(1)
+
+    def __init__(self, harness: "Harness", user: FakeUser, chat: FakeChat, text: Optional[str]):
+        self.id = next(self._ids)
+        self.harness = harness
+        self.from_user = user
+        self.chat = chat
+        self.text = text
+        # Pyrogram sets message.date as naive local time
+        self.date = datetime.now()
+        self.sticker = None
+        self.voice = None
+
+    async def reply(self, text: str, parse_mode: Any = None) -> "FakeMessage":
+        await asyncio.sleep(self.harness.send_latency)
+        self.harness.on_reply(self.chat.id, text)
+        return FakeMessage(self.harness, self.from_user, self.chat, text)
+
+    async def reply_sticker(self, file_id: str) -> "FakeMessage":
+        await asyncio.sleep(self.harness.send_latency)
+        return FakeMessage(self.harness, self.from_user, self.chat, None)
+
+class FakeClient:
+    def __init__(self, harness: "Harness"):
+        self.harness = harness
+
+    async def send_chat_action(self, chat_id: int, action: Any) -> bool:
+        await asyncio.sleep(self.harness.send_latency)
+        return True
+
+class StubResponse:
+    # Same shape as a GenerateContentResponse: the reply lives in candidates[0].content.parts
+    def __init__(self, text: str, finish_reason: str = "STOP"):
+        part = SimpleNamespace(text=text)
+        self.prompt_feedback = None
+        self.candidates = [SimpleNamespace(
+            finish_reason=SimpleNamespace(name=finish_reason),
+            content=SimpleNamespace(parts=[part] if text else [])
+        )]
+
+    @property
+    def text(self) -> str:
+        parts = self.candidates[0].content.parts
+        if not parts:
+            raise ValueError("response has no text parts")
+        return "".join(part.text for part in parts)
+
+class StubModel:
+    def __init__(self, latency: float, jitter: float, error_rate: float, quota_rate: float, rng: random.Random):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.quota_rate = quota_rate
+        self.rng = rng
+        self.calls = 0
+
+    async def generate_content_async(self, prompt: str, generation_config: Any = None, request_options: Any = None) -> StubResponse:
+        self.calls += 1
+        await asyncio.sleep(max(0.0, self.rng.gauss(self.latency, self.latency * self.jitter)))
+        roll = self.rng.random()
+        if roll < self.quota_rate:
+            raise RuntimeError("429 Resource exhausted: quota")
+        if roll < self.quota_rate + self.error_rate:
+            raise RuntimeError("503 backend unavailable")
+        return StubResponse(f"Aryan: hn bhai {self.calls}")
+
+class StubModelPool:
+    def __init__(self, model: StubModel):
+        self.model = model
+
+    def get(self, key: str, kind: str = "reply") -> StubModel:
+        return self.model
+
+    def warm(self, keys: List[str]):
+        pass
+
+    def prune(self, keys: List[str]):
+        pass
+
+    def clear(self):
+        pass
+
+class Harness:
+    def __init__(self, bot: Any, args: argparse.Namespace):
+        self.bot = bot
+        self.args = args
+        self.send_latency = args.send_latency
+        self.rng = random.Random(args.seed)
+        self.client = FakeClient(self)
+        self._waiters: Dict[int, asyncio.Future] = {}
+        self.vips: set = set()
+
+    def on_reply(self, chat_id: int, text: str):
+        waiter = self._waiters.pop(chat_id, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(text)
+
+    def expect_reply(self, chat_id: int) -> asyncio.Future:
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id] = waiter
+        return waiter
+
+    async def private_user(self, user_id: int, latencies: List[float], failures: List[int]):
+        user, chat = FakeUser(user_id), FakeChat(user_id)
+        for seq in range(self.args.messages):
+            message = FakeMessage(self, user, chat, random_text(self.rng, seq))
+            waiter = self.expect_reply(chat.id)
+            started = time.perf_counter()
+            await self.bot.handle_private(self.client, message)
+            try:
+                await asyncio.wait_for(waiter, self.args.reply_timeout)
+                latencies.append(time.perf_counter() - started)
+            except asyncio.TimeoutError:
+                self._waiters.pop(chat.id, None)
+                failures.append(user_id)
+            await asyncio.sleep(self.args.think_time)
+
+    async def group_user(self, user_id: int, latencies: List[float], failures: List[int]):
+        user = FakeUser(user_id)
+        chat = FakeChat(-1000000000000 - user_id % self.args.groups)
+        for seq in range(self.args.messages):
+            text = f"@{self.bot.BOT_USERNAME} {random_text(self.rng, seq)}"
+            started = time.perf_counter()
+            try:
+                await self.bot.handle_group(self.client, FakeMessage(self, user, chat, text))
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                failures.append(user_id)
+            await asyncio.sleep(self.args.think_time)
+
+    async def ai_user(self, user_id: int, latencies: List[float], failures: List[int]):
+        is_vip = user_id in self.vips
+        for seq in range(self.args.messages):
+            started = time.perf_counter()
+            reply = await self.bot.get_ai_response(
+                user_id, random_text(self.rng, seq), is_vip, "Bench" if is_vip else None, history=[]
+            )
+            latencies.append(time.perf_counter() - started)
+            if reply == self.bot.FALLBACK_REPLY:
+                failures.append(user_id)
+            await asyncio.sleep(self.args.think_time)
+
+    async def run_scenario(self, name: str, user_base: int) -> Dict[str, Any]:
+        runner = {"private": self.private_user, "group": self.group_user, "ai": self.ai_user}[name]
+        latencies: List[float] = []
+        vip_latencies: List[float] = []
+        failures: List[int] = []
+        self.vips = set(range(user_base, user_base + self.args.vips))
+        for user_id in self.vips:
+            await self.bot.add_vip(user_id, "Bench")
+
+        db_before = sum(self.bot.DB_SECONDS.counts().values())
+        shed_before = self.bot.ADMISSION_SHED.total()
+        tracemalloc.reset_peak()
+        memory_before, _ = tracemalloc.get_traced_memory()
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            runner(user_base + i, vip_latencies if user_base + i in self.vips else latencies, failures)
+            for i in range(self.args.users)
+        ))
+        await self.bot.message_buffer.flush()
+        elapsed = time.perf_counter() - started
+        memory_after, memory_peak = tracemalloc.get_traced_memory()
+        db_trips = sum(self.bot.DB_SECONDS.counts().values()) - db_before
+
+        completed = len(latencies) + len(vip_latencies)
+        result = {
+            "messages": self.args.users * self.args.messages,
+            "completed": completed,
+            "failed": len(failures),
+            "elapsed_s": round(elapsed, 3),
+            "messages_per_s": round(completed / elapsed, 2) if elapsed > 0 else None,
+            "latency_ms": {
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "max": percentile(latencies, 100)
+            },
+            "db_round_trips": db_trips,
+            "db_round_trips_per_message": round(db_trips / completed, 2) if completed else None,
+            "memory_growth_kb": round((memory_after - memory_before) / 1024, 1),
+            "memory_peak_kb": round(memory_peak / 1024, 1),
+            "ai_shed": int(self.bot.ADMISSION_SHED.total() - shed_before)
+        }
+        if vip_latencies:
+            # latency_ms above then covers non-VIP users only
+            result["vip_latency_ms"] = {
+                "p50": percentile(vip_latencies, 50),
+                "p95": percentile(vip_latencies, 95),
+                "p99": percentile(vip_latencies, 99),
+                "max": percentile(vip_latencies, 100)
+            }
+        return result
+
+def load_bot(args: argparse.Namespace) -> Any:
+    # Runs inside the benchmark's event loop: accounts bind their Client to it
+    for key, value in BENCH_ENV.items():
+        os.environ[key] = value
+    os.environ["STORAGE_BACKEND"] = "sqlite"
+    os.environ["SQLITE_PATH"] = os.path.join(args.workdir, "bench.db")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    # main prints its import-time warnings; keep stdout for the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        import main as bot
+    logging.getLogger().setLevel(logging.WARNING if args.verbose else logging.CRITICAL)
+
+    account = bot.accounts.load(bot.ACCOUNT_SPECS)
+    if args.storage == "mongomock":
+        try:
+            import mongomock
+        except ImportError:
+            logging.getLogger(__name__).critical("❌ --storage mongomock needs the mongomock package")
+            sys.exit(1)
+        account.storage = bot.MongoStorage(
+            mongomock.MongoClient()[bot.mongo_database_name(account.namespace)], per_message=bot.PER_MESSAGE_STORAGE
+        )
+    else:
+        account.storage = bot.connect_storage([account.namespace])[0]
+    account.storage.ensure_indexes()
+    account.config.load()
+
+    keys = [f"bench-key-{i:02d}-{'x' * 24}" for i in range(args.keys)]
+    bot._load_gemini_keys = lambda: list(keys)
+    bot.GEMINI_AVAILABLE = True
+    bot.gemini_models = StubModelPool(StubModel(
+        args.gemini_latency, args.gemini_jitter, args.gemini_error_rate, args.gemini_quota_rate,
+        random.Random(args.seed + 1)
+    ))
+    if args.unthrottled:
+        account.outbound = bot.OutboundScheduler(1e9, 10 ** 9, 0.0, bot.OUTBOUND_WORKERS, account.name)
+    if args.no_debounce:
+        account.mailboxes.debounce = 0.0
+    return bot
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    bot = load_bot(args)
+    for key, value in (
+        ("bot_active", True),
+        ("first_msg_enabled", False),
+        ("sticker_chance", 0),
+        ("delay_min", args.typing_delay),
+        ("delay_max", args.typing_delay)
+    ):
+        await bot.set_config(key, value)
+
+    harness = Harness(bot, args)
+    bot.message_buffer.start()
+    tracemalloc.start()
+    results = {}
+    try:
+        for index, name in enumerate(args.scenarios):
+            results[name] = await harness.run_scenario(name, 10_000_000 * (index + 1))
+    finally:
+        tracemalloc.stop()
+        await bot.message_buffer.close()
+        await bot.outbound.stop()
+        bot.storage.close()
+
+    return {
+        "benchmark": "pipeline",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "storage": bot.storage.name,
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "verbose", "workdir")},
+        "results": results
+    }
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Offline throughput/latency benchmark for the message pipeline")
+    parser.add_argument("--users", type=int, default=20, help="concurrent simulated users")
+    parser.add_argument("--messages", type=int, default=5, help="messages sent per user")
+    parser.add_argument("--scenarios", nargs="+", default=["private", "group", "ai"], choices=["private", "group", "ai"])
+    parser.add_argument("--groups", type=int, default=5, help="group chats the group scenario spreads over")
+    parser.add_argument("--vips", type=int, default=0, help="users per scenario stored as VIPs (reported separately)")
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds each user waits between messages")
+    parser.add_argument("--typing-delay", type=int, default=0, help="delay_min/delay_max config in seconds")
+    parser.add_argument("--send-latency", type=float, default=0.02, help="fake Telegram API latency in seconds")
+    parser.add_argument("--reply-timeout", type=float, default=60.0)
+    parser.add_argument("--keys", type=int, default=3, help="stub Gemini keys")
+    parser.add_argument("--gemini-latency", type=float, default=0.8, help="mean stub Gemini latency in seconds")
+    parser.add_argument("--gemini-jitter", type=float, default=0.25, help="latency stddev as a fraction of the mean")
+    parser.add_argument("--gemini-error-rate", type=float, default=0.02)
+    parser.add_argument("--gemini-quota-rate", type=float, default=0.01)
+    parser.add_argument("--unthrottled", action="store_true", help="lift the outbound Telegram rate limits")
+    parser.add_argument("--no-debounce", action="store_true", help="answer private messages without the mailbox debounce")
+    parser.add_argument("--storage", choices=["sqlite", "mongomock"], default="sqlite",
+                        help="storage backend; sqlite uses a fresh file in a temp directory")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's warnings on stderr")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="aryan-bench-") as workdir:
+        args.workdir = workdir
+        report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -22,17 +22,28 @@ import signal
 import traceback
 import hashlib
 import threading
+import re
+import itertools
+import heapq
+import importlib.util
+import contextvars
 from datetime import datetime, timedelta
-from collections import defaultdict, deque
-from typing import Optional, List, Dict, Any, Tuple
-from functools import wraps
-
-# Web Server
-from flask import Flask, jsonify
+from types import SimpleNamespace
+from collections import deque, OrderedDict
+from typing import Optional, List, Dict, Any, Tuple, Callable
+from functools import wraps, partial
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, asynccontextmanager
+from abc import ABC, abstractmethod
+import json
+import sqlite3
+import tempfile
 
 import pytz
 from pyrogram import Client, filters, idle
 from pyrogram.types import Message
+from pyrogram.raw.functions import Ping
+from pyrogram.raw.functions.updates import GetState
 from pyrogram.enums import ChatAction, ParseMode
 from pyrogram.errors import (
     FloodWait, 
@@ -45,62 +56,504 @@ from pyrogram.errors import (
 )
 
 # MongoDB
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
 
 from dotenv import load_dotenv
 
-# Gemini
+# Gemini (imported on first use by gemini_sdk(); only check it is installed here)
 try:
-    import google.generativeai as genai
-    from google.generativeai.types import HarmCategory, HarmBlockThreshold
-    GEMINI_AVAILABLE = True
+    GEMINI_AVAILABLE = importlib.util.find_spec("google.genai") is not None
 except ImportError:
     GEMINI_AVAILABLE = False
+if not GEMINI_AVAILABLE:
     print("⚠️ Gemini not available")
 
 # ═══════════════════════════════════════════════════════════════
-#                         FLASK WEB SERVER
+#                         METRICS
+# ═══════════════════════════════════════════════════════════════
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _label_key(label_names: Tuple[str, ...], labels: Dict[str, Any]) -> Tuple[str, ...]:
+    return tuple(str(labels.get(name, "")) for name in label_names)
+
+def _format_labels(label_names: Tuple[str, ...], key: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in zip(label_names, key)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Metric:
+    kind = "untyped"
+    
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+    
+    def samples(self) -> List[str]:
+        return []
+    
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+    
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+    
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(self.label_names, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(self.label_names, labels), 0)
+    
+    def total(self) -> float:
+        with self._lock:
+            return sum(self._values.values())
+    
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in items]
+
+class Gauge(Counter):
+    kind = "gauge"
+    
+    def set(self, value: float, **labels):
+        key = _label_key(self.label_names, labels)
+        with self._lock:
+            self._values[key] = value
+
+class GaugeFunc(Metric):
+    # Read at scrape time; fn returns a number or {label_value_tuple: number}
+    def __init__(self, name: str, help_text: str, fn: Callable, label_names: Tuple[str, ...] = (), kind: str = "gauge"):
+        super().__init__(name, help_text, label_names)
+        self.fn = fn
+        self.kind = kind
+    
+    def samples(self) -> List[str]:
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        if isinstance(value, dict):
+            return [f"{self.name}{_format_labels(self.label_names, key)} {v}" for key, v in value.items()]
+        return [f"{self.name} {value}"]
+
+class Histogram(Metric):
+    kind = "histogram"
+    
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+    
+    def observe(self, value: float, **labels):
+        key = _label_key(self.label_names, labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # bucket counts, then +Inf count, then sum
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+    
+    def counts(self) -> Dict[Tuple[str, ...], int]:
+        with self._lock:
+            return {key: series[-2] for key, series in self._series.items()}
+    
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+    
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._series.items()]
+        lines = []
+        for key, series in items:
+            for bound, count in zip(self.buckets, series):
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {count}")
+            inf = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, inf)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {series[-2]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {series[-1]}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+    
+    def register(self, metric: Metric) -> Any:
+        self._metrics.append(metric)
+        return metric
+    
+    def counter(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help_text, label_names))
+    
+    def gauge(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, help_text, label_names))
+    
+    def gauge_func(self, name: str, help_text: str, fn: Callable, label_names: Tuple[str, ...] = (), kind: str = "gauge") -> GaugeFunc:
+        return self.register(GaugeFunc(name, help_text, fn, label_names, kind))
+    
+    def histogram(self, name: str, help_text: str, label_names: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, label_names, buckets))
+    
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+metrics = MetricsRegistry()
+
+MESSAGES_REPLIED = metrics.counter("bot_messages_replied_total", "Replies sent to users", ("account",))
+COMMANDS_EXECUTED = metrics.counter("bot_commands_executed_total", "Rate-limited owner commands executed", ("account",))
+ERRORS = metrics.counter("bot_errors_total", "Errors recorded by log_error", ("account",))
+PIPELINE_SECONDS = metrics.histogram(
+    "bot_pipeline_stage_seconds", "Time spent per message handling stage", ("account", "handler", "stage")
+)
+DB_SECONDS = metrics.histogram("bot_db_call_seconds", "Database call latency, including executor wait", ("op",))
+DB_ERRORS = metrics.counter("bot_db_errors_total", "Database calls that raised", ("op",))
+BREAKER_REJECTED = metrics.counter("bot_circuit_rejected_total", "Calls failed fast by an open circuit", ("breaker",))
+BREAKER_TRANSITIONS = metrics.counter(
+    "bot_circuit_transitions_total", "Circuit breaker state changes", ("breaker", "state")
+)
+GEMINI_SECONDS = metrics.histogram("bot_gemini_request_seconds", "Gemini generate latency per key", ("key",))
+GEMINI_REQUESTS = metrics.counter("bot_gemini_requests_total", "Gemini attempts by key and outcome", ("key", "outcome"))
+SEND_SECONDS = metrics.histogram("bot_send_seconds", "Telegram send latency by priority", ("account", "priority"))
+SEND_WAIT_SECONDS = metrics.histogram("bot_send_queue_wait_seconds", "Time sends spent queued", ("account", "priority"))
+ADMISSION_WAIT_SECONDS = metrics.histogram(
+    "bot_ai_admission_wait_seconds", "Time AI requests waited for a generation slot", ("priority",)
+)
+ADMISSION_SHED = metrics.counter(
+    "bot_ai_admission_shed_total", "AI requests answered locally instead of generated", ("priority", "reason")
+)
+PROMPT_TOKENS = metrics.histogram(
+    "bot_prompt_tokens", "Estimated prompt size sent to Gemini", ("kind",),
+    buckets=(100, 200, 400, 600, 800, 1000, 1500, 2000, 3000, 4000)
+)
+STARTUP_SECONDS = metrics.gauge("bot_startup_phase_seconds", "Duration of each startup phase", ("phase",))
+LOOP_LAG_SECONDS = metrics.histogram(
+    "bot_event_loop_lag_seconds", "Event loop scheduling lag",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+)
+
+metrics.gauge_func(
+    "bot_outbound_queue_depth", "Queued Telegram sends",
+    lambda: {(a.name,): a.outbound.depth for a in accounts}, ("account",)
+)
+metrics.gauge_func("bot_write_buffer_depth", "Message appends waiting to be flushed", lambda: message_buffer.depth)
+metrics.gauge_func(
+    "bot_log_buffer_depth", "Log lines waiting to be sent",
+    lambda: {(a.name,): a.log_sink.depth for a in accounts}, ("account",)
+)
+metrics.gauge_func(
+    "bot_mailboxes_active", "Users with a reply in progress",
+    lambda: {(a.name,): a.mailboxes.active_count for a in accounts}, ("account",)
+)
+metrics.gauge_func(
+    "bot_user_states", "Tracked per-user state records",
+    lambda: {(a.name,): len(a.state.users) for a in accounts}, ("account",)
+)
+metrics.gauge_func(
+    "bot_ai_admission_queue_depth", "AI requests waiting for a generation slot",
+    lambda: {(AI_PRIORITY_NAMES[p],): n for p, n in ai_admission.depth_by_priority().items()}, ("priority",)
+)
+metrics.gauge_func("bot_ai_admission_in_flight", "AI generations running", lambda: ai_admission.in_flight)
+metrics.gauge_func(
+    "bot_circuit_state", "Circuit breaker state (0 closed, 1 half-open, 2 open)",
+    lambda: {(name,): CIRCUIT_STATE_VALUES[b.state] for name, b in circuit_breakers.items()}, ("breaker",)
+)
+metrics.gauge_func("bot_gemini_keys_healthy", "Gemini keys not in cooldown", lambda: key_scheduler.healthy_count())
+metrics.gauge_func(
+    "bot_cache_requests_total", "Cache lookups by cache and result",
+    lambda: {
+        ("history", "hit"): history_cache.hits,
+        ("history", "miss"): history_cache.misses,
+        ("reply", "hit"): reply_cache.hits,
+        ("reply", "miss"): reply_cache.misses,
+        ("reply", "skip"): reply_cache.skipped
+    },
+    ("cache", "result"),
+    kind="counter"
+)
+metrics.gauge_func(
+    "bot_summary_updates_total", "Rolling conversation summary refreshes by result",
+    lambda: {("ok",): summarizer.updates, ("failed",): summarizer.failures},
+    ("result",),
+    kind="counter"
+)
+metrics.gauge_func(
+    "bot_outbound_events_total", "Outbound scheduler events",
+    lambda: {
+        (a.name, event): value
+        for a in accounts
+        for event, value in (
+            ("sent", a.outbound.sent),
+            ("failed", a.outbound.failed),
+            ("dropped", a.outbound.dropped),
+            ("flood_wait", a.outbound.flood_waits)
+        )
+    },
+    ("account", "event"),
+    kind="counter"
+)
+
+def metric_op_name(func: Callable) -> str:
+    name = getattr(func, "__qualname__", None) or getattr(func, "__name__", "call")
+    return name.split(".<locals>")[0]
+
+def bot_stats(account: Optional[str] = None) -> Dict[str, int]:
+    # Totals across every hosted account unless one is named
+    if account is None:
+        return {
+            "messages_replied": int(MESSAGES_REPLIED.total()),
+            "commands_executed": int(COMMANDS_EXECUTED.total()),
+            "errors_count": int(ERRORS.total())
+        }
+    return {
+        "messages_replied": int(MESSAGES_REPLIED.value(account=account)),
+        "commands_executed": int(COMMANDS_EXECUTED.value(account=account)),
+        "errors_count": int(ERRORS.value(account=account))
+    }
+
+def pipeline_stage(handler: str, stage: str):
+    return PIPELINE_SECONDS.time(account=current_account().name, handler=handler, stage=stage)
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - expected))
+
+# ═══════════════════════════════════════════════════════════════
+#                         WEB SERVER
 # ═══════════════════════════════════════════════════════════════
 
-flask_app = Flask(__name__)
 START_TIME = datetime.now()
-BOT_STATS = {
-    "messages_replied": 0,
-    "commands_executed": 0,
-    "errors_count": 0
-}
+HEALTH_PROBE_INTERVAL = 15
+HEALTH_PROBE_TIMEOUT = 5
+WEB_READ_TIMEOUT = 5
+WEB_MAX_HEADER_LINES = 100
+HTTP_REASONS = {200: "OK", 404: "Not Found", 405: "Method Not Allowed", 503: "Service Unavailable"}
+
+class HealthProbe:
+    # Probes run in the background; requests only read the cached result
+    def __init__(self, interval: float, timeout: float):
+        self.interval = interval
+        self.timeout = timeout
+        self.results: Dict[str, Dict[str, Any]] = {}
+        self.checked_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    async def _check_telegram(self, client: Client) -> bool:
+        if not client.is_connected:
+            raise ConnectionError("not connected")
+        await client.invoke(Ping(ping_id=random.getrandbits(63)))
+        return True
+    
+    async def _check_storage(self, backend: "Storage") -> bool:
+        # Straight to the executor: the probe has to see the backend even while its
+        # breaker is open, and must not take the half-open probe slot
+        await asyncio.get_running_loop().run_in_executor(db_executor, backend.ping)
+        return True
+    
+    async def _run(self, name: str, check: Callable, breaker: Optional["CircuitBreaker"] = None):
+        started = time.perf_counter()
+        try:
+            ok = await asyncio.wait_for(check(), self.timeout)
+            result = {"ok": ok, "latency_ms": round((time.perf_counter() - started) * 1000, 1)}
+        except Exception as e:
+            result = {"ok": False, "error": str(e) or type(e).__name__}
+            # A backend whose breaker has tripped is already being served around
+            # (fallback replies, buffered writes), so it degrades rather than fails
+            if breaker is not None and breaker.state != CIRCUIT_CLOSED:
+                result["degraded"] = True
+        self.results[name] = result
+    
+    async def probe(self):
+        checks = []
+        for account in accounts:
+            suffix = "" if account.primary else f":{account.name}"
+            checks.append(self._run(f"telegram{suffix}", partial(self._check_telegram, account.client)))
+            checks.append(self._run(
+                f"{account.storage.name}{suffix}",
+                partial(self._check_storage, account.storage),
+                account.storage.breaker
+            ))
+        await asyncio.gather(*checks)
+        self.checked_at = time.monotonic()
+    
+    async def _loop(self):
+        while True:
+            await self.probe()
+            await asyncio.sleep(self.interval)
+    
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+    
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+    
+    @property
+    def healthy(self) -> bool:
+        return self.checked_at is not None and all(r["ok"] or r.get("degraded") for r in self.results.values())
+    
+    def report(self) -> Dict[str, Any]:
+        breakers = {name: b.snapshot() for name, b in circuit_breakers.items()}
+        if self.checked_at is None:
+            return {"status": "starting", "checks": {}, "breakers": breakers}
+        if not self.healthy:
+            status = "unhealthy"
+        elif storage_failover.active or any(b["state"] != CIRCUIT_CLOSED for b in breakers.values()):
+            # Still serving (fallback replies, cached reads), so not a 503
+            status = "degraded"
+        else:
+            status = "healthy"
+        return {
+            "status": status,
+            "age_seconds": round(time.monotonic() - self.checked_at, 1),
+            "checks": self.results,
+            "breakers": breakers,
+            "storage_failover": storage_failover.active
+        }
+
+health_probe = HealthProbe(HEALTH_PROBE_INTERVAL, HEALTH_PROBE_TIMEOUT)
+
+def json_response(data: Any, status: int = 200) -> Tuple[int, str, bytes]:
+    return status, "application/json", json.dumps(data, ensure_ascii=False).encode()
+
+def text_response(text: str, status: int = 200, content_type: str = "text/plain; charset=utf-8") -> Tuple[int, str, bytes]:
+    return status, content_type, text.encode()
 
-@flask_app.route('/')
-def home():
+def web_home():
     uptime = str(datetime.now() - START_TIME).split('.')[0]
-    return jsonify({
+    return json_response({
         "status": "✅ alive",
         "bot": "Aryan's Userbot V5.3",
         "uptime": uptime,
-        "stats": BOT_STATS
+        "stats": bot_stats()
     })
 
-@flask_app.route('/health')
-def health():
-    return jsonify({"status": "healthy", "code": 200})
+def web_health():
+    report = health_probe.report()
+    code = 200 if health_probe.healthy else 503
+    report["code"] = code
+    return json_response(report, code)
 
-@flask_app.route('/ping')
-def ping():
-    return "pong", 200
+def web_ping():
+    return text_response("pong")
 
-@flask_app.route('/stats')
-def stats():
+def web_stats():
     uptime = str(datetime.now() - START_TIME).split('.')[0]
-    return jsonify({
+    counts = bot_stats()
+    return json_response({
         "uptime": uptime,
-        "messages_replied": BOT_STATS["messages_replied"],
-        "commands_executed": BOT_STATS["commands_executed"],
-        "errors": BOT_STATS["errors_count"]
+        "messages_replied": counts["messages_replied"],
+        "commands_executed": counts["commands_executed"],
+        "errors": counts["errors_count"],
+        "reply_cache": reply_cache.stats(),
+        "ai_admission": ai_admission.stats(),
+        "breakers": {name: b.snapshot() for name, b in circuit_breakers.items()},
+        "accounts": {
+            account.name: {
+                **bot_stats(account.name),
+                "outbound": account.outbound.stats(),
+                "log_sink": account.log_sink.stats()
+            }
+            for account in accounts
+        }
     })
 
-def run_flask():
-    port = int(os.environ.get("PORT", 10000))
-    flask_app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False, threaded=True)
+def web_metrics():
+    return text_response(metrics.render(), content_type="text/plain; version=0.0.4")
+
+WEB_ROUTES = {
+    "/": web_home,
+    "/health": web_health,
+    "/ping": web_ping,
+    "/stats": web_stats,
+    "/metrics": web_metrics
+}
+
+class WebServer:
+    # Minimal HTTP/1.1 responder on the bot's own event loop
+    def __init__(self, routes: Dict[str, Callable]):
+        self.routes = routes
+        self._server: Optional[asyncio.AbstractServer] = None
+    
+    async def start(self, host: str, port: int):
+        self._server = await asyncio.start_server(self._handle, host, port)
+    
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+    
+    async def _read_request(self, reader: asyncio.StreamReader) -> Tuple[str, str]:
+        line = await asyncio.wait_for(reader.readline(), WEB_READ_TIMEOUT)
+        parts = line.decode("latin-1").split()
+        if len(parts) < 2:
+            raise ValueError("bad request line")
+        for _ in range(WEB_MAX_HEADER_LINES):
+            header = await asyncio.wait_for(reader.readline(), WEB_READ_TIMEOUT)
+            if header in (b"\r\n", b"\n", b""):
+                break
+        return parts[0].upper(), parts[1].split("?", 1)[0]
+    
+    def _dispatch(self, method: str, path: str) -> Tuple[int, str, bytes]:
+        handler = self.routes.get(path)
+        if handler is None:
+            return json_response({"error": "not found"}, 404)
+        if method not in ("GET", "HEAD"):
+            return json_response({"error": "method not allowed"}, 405)
+        try:
+            return handler()
+        except Exception as e:
+            log_error(f"Web {path}: {e}")
+            return json_response({"error": "internal"}, 503)
+    
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            method, path = await self._read_request(reader)
+            status, content_type, body = self._dispatch(method, path)
+            head = (
+                f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'OK')}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode()
+            writer.write(head if method == "HEAD" else head + body)
+            await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
+
+web_server = WebServer(WEB_ROUTES)
 
 # ═══════════════════════════════════════════════════════════════
 #                         CONSTANTS
@@ -108,24 +561,128 @@ def run_flask():
 
 MAX_MESSAGE_LENGTH = 4096
 MAX_HISTORY_PER_USER = 100
+DUPLICATE_KEY_ERROR = 11000
 MAX_WORDS_TO_REPLY = 200
 MAX_STICKER_PREVIEW = 5
 SPAM_MESSAGE_THRESHOLD = 3
 SPAM_TIME_WINDOW = 60
-ACTION_LOG_LIMIT = 50
+SPAM_FINGERPRINT_WINDOW = 5
+SPAM_SIMHASH_DISTANCE = 10
+SPAM_SIMHASH_MAX_CHARS = 256
+SPAM_RATE_BUCKETS = 6
+SPAM_USER_RATE_LIMIT = 20
+SPAM_GLOBAL_RATE_LIMIT = 600
 ERROR_LOG_LIMIT = 20
 GEMINI_MAX_RETRIES = 3
 FLOOD_WAIT_MAX_RETRIES = 3
 REPLY_COOLDOWN_SECONDS = 2
 COMMAND_COOLDOWN_SECONDS = 1
 CONFIRM_CLEAR_TIMEOUT = 60
+CONFIG_RELOAD_RETRY_SECONDS = 30
+USER_STATE_MAX_ENTRIES = 10000
+USER_STATE_IDLE_TTL = 3600
+WRITE_BUFFER_MAX_PENDING = 5000
+WRITE_BUFFER_BATCH_SIZE = 200
+WRITE_BUFFER_FLUSH_INTERVAL = 1.0
+WRITE_BUFFER_MAX_RETRIES = 3
+WRITE_BUFFER_RETRY_SECONDS = 5.0
+WRITE_BUFFER_SPILL_PATH = "write_spill.jsonl"
+HISTORY_CACHE_DEPTH = 20
+HISTORY_CACHE_MAX_USERS = 2000
+HISTORY_CACHE_MAX_CHARS = 2_000_000
+HISTORY_PREWARM_USERS = 200
+ACTIVITY_RETENTION_HOURS = 72
+ACTIVITY_SUMMARY_TOP = 10
+KEY_COOLDOWN_BASE_SECONDS = 30
+KEY_COOLDOWN_MAX_SECONDS = 3600
+KEY_FAILURE_COOLDOWN_THRESHOLD = 3
+KEY_LATENCY_EWMA_ALPHA = 0.3
+KEY_STATS_SAVE_INTERVAL = 60
+REPLY_CACHE_MAX_ENTRIES = 1000
+REPLY_CACHE_TTL_SECONDS = 6 * 3600
+REPLY_CACHE_VARIANTS = 4
+REPLY_CACHE_MAX_WORDS = 4
+REPLY_CACHE_MAX_CHARS = 40
+REPLY_CACHE_CONTEXT_SECONDS = 600
+REPLY_CACHE_BUCKET_HOURS = 6
+MAILBOX_DEBOUNCE_SECONDS = 1.5
+MAILBOX_IDLE_SETTLE_SECONDS = 0.15
+MAILBOX_MAX_WAIT_SECONDS = 5.0
+MAILBOX_MAX_MESSAGES = 10
+MAILBOX_IDLE_TTL = 300
+OUTBOUND_RATE_PER_SECOND = 10.0
+OUTBOUND_BURST = 20
+OUTBOUND_CHAT_INTERVAL = 1.0
+OUTBOUND_WORKERS = 4
+OUTBOUND_MAX_QUEUE = 1000
+OUTBOUND_ACTION_DROP_DEPTH = 50
+OUTBOUND_MAX_FLOOD_RETRY_WAIT = 60
+OUTBOUND_CHAT_PRUNE_SIZE = 1024
+PRIORITY_REPLY = 0
+PRIORITY_COMMAND = 1
+PRIORITY_ACTION = 2
+PRIORITY_LOG = 3
+AI_PRIORITY_VIP = 0
+AI_PRIORITY_KNOWN = 1
+AI_PRIORITY_NEW = 2
+AI_PRIORITY_SUMMARY = 3
+AI_PRIORITY_NAMES = {
+    AI_PRIORITY_VIP: "vip",
+    AI_PRIORITY_KNOWN: "known",
+    AI_PRIORITY_NEW: "new",
+    AI_PRIORITY_SUMMARY: "summary"
+}
+# Longest estimated (and actual) queue wait before a request is answered locally;
+# None never sheds. Summaries only run when a slot is free right away.
+ADMISSION_MAX_WAIT = {
+    AI_PRIORITY_VIP: None,
+    AI_PRIORITY_KNOWN: 15.0,
+    AI_PRIORITY_NEW: 6.0,
+    AI_PRIORITY_SUMMARY: 0.0
+}
+ADMISSION_MAX_QUEUE = 200
+ADMISSION_INITIAL_SERVICE_SECONDS = 2.0
+ADMISSION_SERVICE_EWMA_ALPHA = 0.2
+BREAKER_WINDOW_SECONDS = 30
+BREAKER_MIN_CALLS = 5
+BREAKER_FAILURE_RATE = 0.5
+BREAKER_OPEN_SECONDS = 10
+BREAKER_MAX_OPEN_SECONDS = 120
+BREAKER_HALF_OPEN_PROBES = 1
+LOG_FLUSH_INTERVAL = 10
+LOG_BUFFER_MAX_LINES = 500
+LOG_LINE_MAX_CHARS = 1000
+LOG_SPILL_PATH = "log_spill.txt"
+LOG_SPILL_MAX_BYTES = 5 * 1024 * 1024
 MIN_DELAY_SECONDS = 1
 MAX_DELAY_SECONDS = 30
 DEFAULT_DELAY_MIN = 3
 DEFAULT_DELAY_MAX = 8
 DEFAULT_STICKER_CHANCE = 10
 GEMINI_CONTEXT_LIMIT = 3000
+PROMPT_MAX_TURNS = 8
+PROMPT_TURN_MAX_CHARS = 300
+PROMPT_MESSAGE_MAX_CHARS = 500
+REPLY_MAX_CHARS = 300
+REPLY_TOKENS_SHORT = 64
+REPLY_TOKENS_DEFAULT = 96
+REPLY_TOKENS_LONG = 160
+INDEX_RETRY_SECONDS = 5
+INDEX_RETRY_MAX_SECONDS = 300
+SUMMARY_MIN_TURNS = 6
+SUMMARY_MAX_CHARS = 600
+SUMMARY_MAX_OUTPUT_TOKENS = 200
+SUMMARY_TURN_MAX_CHARS = 200
+TYPING_REFRESH_SECONDS = 4.5
+GROUP_REPLY_DELAY_SECONDS = 3.0
 SESSION_STRING_MIN_LENGTH = 100
+MAX_ACCOUNTS = 20
+ACCOUNT_NAME_RE = re.compile(r"[A-Za-z0-9_]{1,32}")
+SQLITE_BUSY_TIMEOUT = 5
+STORAGE_FAILOVER_AFTER_SECONDS = 30
+STORAGE_FAILOVER_CHECK_SECONDS = 5
+STORAGE_RECOVERY_MAX_SECONDS = 120
+STORAGE_SNAPSHOT_SECONDS = 300
 
 # ═══════════════════════════════════════════════════════════════
 #                         LOGGING
@@ -137,7 +694,6 @@ logging.basicConfig(
     handlers=[logging.StreamHandler()]
 )
 logger = logging.getLogger(__name__)
-logging.getLogger('werkzeug').setLevel(logging.ERROR)
 
 # ═══════════════════════════════════════════════════════════════
 #                         CONFIGURATION
@@ -168,37 +724,136 @@ if len(SESSION_STRING) < SESSION_STRING_MIN_LENGTH:
     sys.exit(1)
 
 OWNER_ID = get_env_int("OWNER_ID", default=0)
+ACCOUNT_NAME = get_env("ACCOUNT_NAME", "main")
 MONGO_URI = get_env("MONGO_URI", required=False)
+CONFIG_CACHE_TTL = get_env_int("CONFIG_CACHE_TTL", default=60)
+CONFIG_CHANGE_STREAM = get_env("CONFIG_CHANGE_STREAM", "1").lower() in ("1", "true", "yes", "on")
+MONGO_POOL_SIZE = get_env_int("MONGO_POOL_SIZE", default=20)
+MONGO_MIN_POOL_SIZE = get_env_int("MONGO_MIN_POOL_SIZE", default=0)
+MONGO_WRITE_CONCERN = get_env("MONGO_WRITE_CONCERN", "1")
+MONGO_JOURNAL = get_env("MONGO_JOURNAL", "0").lower() in ("1", "true", "yes", "on")
+MESSAGE_STORAGE = (get_env("MESSAGE_STORAGE", "embedded") or "embedded").strip().lower()
+PER_MESSAGE_STORAGE = MESSAGE_STORAGE == "per_message"
+MESSAGE_RETENTION_DAYS = get_env_int("MESSAGE_RETENTION_DAYS", default=0)
+STORAGE_BACKEND = (get_env("STORAGE_BACKEND", "auto") or "auto").strip().lower()
+SQLITE_PATH = get_env("SQLITE_PATH", "aryan_userbot.db")
+DB_EXECUTOR_WORKERS = get_env_int("DB_EXECUTOR_WORKERS", default=min(MONGO_POOL_SIZE, 16)) or 1
+GEMINI_MAX_CONCURRENCY = get_env_int("GEMINI_MAX_CONCURRENCY", default=8) or 1
+GEMINI_ATTEMPT_TIMEOUT = get_env_int("GEMINI_ATTEMPT_TIMEOUT", default=12)
+GEMINI_REQUEST_TIMEOUT = get_env_int("GEMINI_REQUEST_TIMEOUT", default=25)
+# Tokens GEMINI_MODEL may spend thinking before it answers. 0 turns thinking off, so
+# max_output_tokens is exactly the per-message reply size.
+GEMINI_THINKING_BUDGET = get_env_int("GEMINI_THINKING_BUDGET", default=0)
+
+def get_account_specs() -> List[Tuple[str, str, int]]:
+    # SESSION_STRING is the primary account; SESSION_STRING_2..N add more sessions,
+    # named by ACCOUNT_NAME_<i> and owned by OWNER_ID_<i>
+    specs = [(ACCOUNT_NAME, SESSION_STRING, OWNER_ID)]
+    for i in range(2, MAX_ACCOUNTS + 1):
+        session = get_env(f"SESSION_STRING_{i}")
+        if not session or not session.strip():
+            continue
+        specs.append((
+            get_env(f"ACCOUNT_NAME_{i}", f"account{i}"),
+            session.strip(),
+            get_env_int(f"OWNER_ID_{i}", default=0)
+        ))
+    names = set()
+    for name, session, _ in specs:
+        if not ACCOUNT_NAME_RE.fullmatch(name) or name in names:
+            logger.critical(f"❌ Invalid or duplicate account name: {name}")
+            sys.exit(1)
+        if len(session) < SESSION_STRING_MIN_LENGTH:
+            logger.critical(f"❌ Invalid session string for {name}")
+            sys.exit(1)
+        names.add(name)
+    return specs
+
+ACCOUNT_SPECS = get_account_specs()
 
 BOT_USERNAME = "MaiHuAryan"
 BOT_NAME = "Aryan"
 TIMEZONE = pytz.timezone("Asia/Kolkata")
 GEMINI_MODEL = "gemini-2.5-flash-latest"
 
-if GEMINI_AVAILABLE:
-    SAFETY_SETTINGS = {
-        HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-    }
-else:
-    SAFETY_SETTINGS = {}
-
 # ═══════════════════════════════════════════════════════════════
 #                      GLOBAL STATE
 # ═══════════════════════════════════════════════════════════════
 
+class RollingCounter:
+    # Fixed ring of time buckets; add() is O(buckets) regardless of traffic
+    __slots__ = ("width", "counts", "stamp")
+    
+    def __init__(self, window: float, buckets: int):
+        self.width = window / buckets
+        self.counts = [0] * buckets
+        self.stamp = 0
+    
+    def add(self, now: float) -> int:
+        idx = int(now / self.width)
+        size = len(self.counts)
+        gap = idx - self.stamp
+        if gap >= size:
+            self.counts = [0] * size
+        else:
+            for i in range(1, gap + 1):
+                self.counts[(self.stamp + i) % size] = 0
+        self.stamp = idx
+        self.counts[idx % size] += 1
+        return sum(self.counts)
+
+class UserRecord:
+    __slots__ = ("last_reply", "last_command", "spam", "rate", "spam_warned", "touched")
+    
+    def __init__(self, now: float):
+        self.last_reply = 0.0
+        self.last_command = 0.0
+        self.spam: Optional[deque] = None
+        self.rate: Optional[RollingCounter] = None
+        self.spam_warned = 0.0
+        self.touched = now
+
+class UserStateStore:
+    # Per-user timestamps on time.monotonic(); least recently touched records are
+    # evicted once idle past the TTL or when the store is over capacity
+    def __init__(self, max_entries: int, idle_ttl: float):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self._records: "OrderedDict[int, UserRecord]" = OrderedDict()
+        self.evicted = 0
+    
+    def __len__(self) -> int:
+        return len(self._records)
+    
+    def peek(self, user_id: int) -> Optional[UserRecord]:
+        return self._records.get(user_id)
+    
+    def get(self, user_id: int) -> UserRecord:
+        now = time.monotonic()
+        record = self._records.get(user_id)
+        if record is None:
+            record = self._records[user_id] = UserRecord(now)
+        else:
+            self._records.move_to_end(user_id)
+            record.touched = now
+        self._evict(now)
+        return record
+    
+    def _evict(self, now: float):
+        records = self._records
+        while records:
+            oldest = next(iter(records.values()))
+            if len(records) <= self.max_entries and now - oldest.touched <= self.idle_ttl:
+                break
+            records.popitem(last=False)
+            self.evicted += 1
+
 class BotState:
     def __init__(self):
         self._lock = threading.Lock()
-        self.spam_tracker: Dict[int, deque] = defaultdict(lambda: deque(maxlen=5))
-        self.action_logs: deque = deque(maxlen=ACTION_LOG_LIMIT)
+        self.users = UserStateStore(USER_STATE_MAX_ENTRIES, USER_STATE_IDLE_TTL)
         self.error_logs: deque = deque(maxlen=ERROR_LOG_LIMIT)
-        self.last_reply_time: Dict[int, datetime] = {}
-        self.last_command_time: Dict[int, datetime] = {}
         self.processing_users: set = set()
-        self.gemini_key_index = 0
         self.confirm_clear_time: Optional[datetime] = None
         self.confirm_clear_user: Optional[int] = None
         
@@ -213,369 +868,2224 @@ class BotState:
         with self._lock:
             self.processing_users.discard(user_id)
 
-bot_state = BotState()
-
 # ═══════════════════════════════════════════════════════════════
-#                      DATABASE
+#                      ACCOUNT CONTEXT
 # ═══════════════════════════════════════════════════════════════
 
-mongo_client: Optional[MongoClient] = None
-db = None
+# Set on every task spawned for an account (see Account.run); code that runs outside
+# any account, such as the web server and shared background loops, sees the primary
+_current_account: contextvars.ContextVar = contextvars.ContextVar("account")
+
+def current_account() -> "Account":
+    account = _current_account.get(None)
+    return account if account is not None else accounts.primary
 
-def connect_mongodb():
-    global mongo_client, db
+def account_key(user_id: int) -> Tuple[str, int]:
+    return (current_account().name, user_id)
+
+def account_path(path: str, namespace: str) -> str:
+    if not namespace:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}_{namespace}{ext}"
+
+class AccountLocal:
+    # Module-level name for a per-account singleton; attribute access goes to the
+    # instance owned by the account the current task belongs to
+    __slots__ = ("_attr",)
     
-    if not MONGO_URI:
-        logger.warning("⚠️ No MongoDB URI - using memory only")
-        return False
+    def __init__(self, attr: str):
+        object.__setattr__(self, "_attr", attr)
     
-    try:
-        mongo_client = MongoClient(
-            MONGO_URI,
-            serverSelectionTimeoutMS=5000,
-            connectTimeoutMS=10000,
-            retryWrites=True
-        )
-        mongo_client.admin.command('ping')
-        db = mongo_client['aryan_userbot']
-        
-        try:
-            db.messages.create_index("user_id", unique=True)
-            db.vips.create_index("user_id", unique=True)
-            db.config.create_index("key", unique=True)
-        except:
-            pass
-        
-        logger.info("✅ MongoDB connected")
-        return True
-    except Exception as e:
-        logger.warning(f"⚠️ MongoDB failed: {e}")
-        return False
+    def __getattr__(self, name: str) -> Any:
+        return getattr(getattr(current_account(), self._attr), name)
+    
+    def __setattr__(self, name: str, value: Any):
+        setattr(getattr(current_account(), self._attr), name, value)
 
-connect_mongodb()
+bot_state = AccountLocal("state")
 
 # ═══════════════════════════════════════════════════════════════
-#                      PYROGRAM CLIENT
+#                      CIRCUIT BREAKERS
 # ═══════════════════════════════════════════════════════════════
 
-app = Client(
-    name="aryan_userbot",
-    api_id=API_ID,
-    api_hash=API_HASH,
-    session_string=SESSION_STRING,
-    in_memory=False
-)
+class CircuitOpenError(Exception):
+    pass
 
-# ═══════════════════════════════════════════════════════════════
-#                      DECORATORS
-# ═══════════════════════════════════════════════════════════════
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_HALF_OPEN = "half_open"
+CIRCUIT_OPEN = "open"
+CIRCUIT_STATE_VALUES = {CIRCUIT_CLOSED: 0, CIRCUIT_HALF_OPEN: 1, CIRCUIT_OPEN: 2}
 
-def rate_limit(seconds: int = COMMAND_COOLDOWN_SECONDS):
-    def decorator(func):
-        @wraps(func)
-        async def wrapper(client: Client, message: Message):
-            user_id = message.from_user.id if message.from_user else 0
-            now = get_current_time()
-            
-            last_time = bot_state.last_command_time.get(user_id)
-            if last_time:
-                diff = (now - last_time).total_seconds()
-                if diff < seconds:
-                    return
-            
-            bot_state.last_command_time[user_id] = now
-            BOT_STATS["commands_executed"] += 1
-            return await func(client, message)
-        return wrapper
-    return decorator
+circuit_breakers: Dict[str, "CircuitBreaker"] = {}
 
-def owner_only(func):
-    @wraps(func)
-    async def wrapper(client: Client, message: Message):
-        user_id = message.from_user.id if message.from_user else 0
-        if not is_owner(user_id):
+class CircuitBreaker:
+    # Closed: outcomes are tracked over a rolling window and the circuit opens once at
+    # least min_calls have failed at failure_rate or worse. Open: calls fail fast until
+    # the cooldown ends. Half-open: a few probe calls either close it or reopen it with
+    # the cooldown doubled. Only touched from the event loop.
+    def __init__(
+        self,
+        name: str,
+        window: float = BREAKER_WINDOW_SECONDS,
+        min_calls: int = BREAKER_MIN_CALLS,
+        failure_rate: float = BREAKER_FAILURE_RATE,
+        open_seconds: float = BREAKER_OPEN_SECONDS,
+        max_open_seconds: float = BREAKER_MAX_OPEN_SECONDS,
+        probes: int = BREAKER_HALF_OPEN_PROBES
+    ):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.probes = probes
+        self.state = CIRCUIT_CLOSED
+        self._outcomes: deque = deque()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._cooldown = open_seconds
+        self._probing = 0
+        self.rejected = 0
+        self.trips = 0
+        circuit_breakers[name] = self
+    
+    @property
+    def retry_in(self) -> float:
+        if self.state != CIRCUIT_OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self._cooldown - time.monotonic())
+    
+    @property
+    def rejecting(self) -> bool:
+        # Peek for callers that want to skip work up front; does not claim a probe
+        if self.state == CIRCUIT_OPEN:
+            return self.retry_in > 0
+        return self.state == CIRCUIT_HALF_OPEN and self._probing >= self.probes
+    
+    def _set_state(self, state: str):
+        self.state = state
+        BREAKER_TRANSITIONS.inc(breaker=self.name, state=state)
+        log = logger.warning if state == CIRCUIT_OPEN else logger.info
+        log(f"⚡ Circuit {self.name}: {state}")
+    
+    def _open(self, now: float):
+        self._opened_at = now
+        self.trips += 1
+        self._set_state(CIRCUIT_OPEN)
+    
+    def _reject(self) -> bool:
+        self.rejected += 1
+        BREAKER_REJECTED.inc(breaker=self.name)
+        return False
+    
+    def allow(self) -> bool:
+        # Every allowed call must be followed by exactly one record()
+        if self.state == CIRCUIT_OPEN:
+            if self.retry_in > 0:
+                return self._reject()
+            self._probing = 0
+            self._set_state(CIRCUIT_HALF_OPEN)
+        if self.state == CIRCUIT_HALF_OPEN:
+            if self._probing >= self.probes:
+                return self._reject()
+            self._probing += 1
+        return True
+    
+    def reset(self):
+        # The backend was verified out of band (StorageFailover), so start clean
+        self._outcomes.clear()
+        self._failures = 0
+        self._probing = 0
+        self._cooldown = self.open_seconds
+        if self.state != CIRCUIT_CLOSED:
+            self._set_state(CIRCUIT_CLOSED)
+    
+    def record(self, ok: bool):
+        now = time.monotonic()
+        if self.state == CIRCUIT_HALF_OPEN:
+            self._probing = max(0, self._probing - 1)
+            if ok:
+                self._cooldown = self.open_seconds
+                self._outcomes.clear()
+                self._failures = 0
+                self._set_state(CIRCUIT_CLOSED)
+            else:
+                self._cooldown = min(self._cooldown * 2, self.max_open_seconds)
+                self._open(now)
             return
-        return await func(client, message)
-    return wrapper
+        if self.state == CIRCUIT_OPEN:
+            # A call let through before the circuit opened
+            return
+        self._outcomes.append((now, not ok))
+        self._failures += not ok
+        while self._outcomes and now - self._outcomes[0][0] > self.window:
+            self._failures -= self._outcomes.popleft()[1]
+        calls = len(self._outcomes)
+        if not ok and calls >= self.min_calls and self._failures / calls >= self.failure_rate:
+            self._open(now)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        calls = len(self._outcomes)
+        return {
+            "state": self.state,
+            "retry_in": round(self.retry_in, 1),
+            "failure_rate": round(self._failures / calls, 2) if calls else 0.0,
+            "trips": self.trips,
+            "rejected": self.rejected
+        }
+    
+    def describe(self) -> str:
+        if self.state == CIRCUIT_OPEN:
+            return f"{self.name} 🔴 {self.retry_in:.0f}s"
+        return f"{self.name} {'🟡' if self.state == CIRCUIT_HALF_OPEN else '🟢'}"
 
 # ═══════════════════════════════════════════════════════════════
-#                      HELPER FUNCTIONS (ALL FIXED!)
+#                      DATABASE
 # ═══════════════════════════════════════════════════════════════
 
-def get_current_time() -> datetime:
-    return datetime.now(TIMEZONE)
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
 
-def get_config(key: str, default: Any = None) -> Any:
-    if db is None:  # ✅ FIXED
-        return default
-    try:
-        config = db.config.find_one({"key": key})
-        return config["value"] if config and "value" in config else default
-    except:
-        return default
+def get_write_concern() -> Any:
+    value = (MONGO_WRITE_CONCERN or "1").strip()
+    return int(value) if value.isdigit() else value
 
-def set_config(key: str, value: Any) -> bool:
-    if db is None:  # ✅ FIXED
-        return False
+async def db_call(func: Callable, *args, **kwargs) -> Any:
+    loop = asyncio.get_running_loop()
+    op = metric_op_name(func)
+    # Storage methods go through their backend's breaker; other callables run as-is
+    breaker = getattr(getattr(func, "__self__", None), "breaker", None)
+    if breaker is not None and not breaker.allow():
+        raise CircuitOpenError(f"circuit {breaker.name} open")
+    started = time.perf_counter()
+    ok = False
     try:
-        db.config.update_one(
-            {"key": key},
-            {"$set": {"key": key, "value": value}},
-            upsert=True
-        )
-        return True
-    except:
-        return False
-
-def log_action(action: str):
-    timestamp = get_current_time().strftime('%H:%M:%S')
-    bot_state.action_logs.append(f"[{timestamp}] {action}")
-    logger.info(action)
+        result = await loop.run_in_executor(db_executor, partial(func, *args, **kwargs))
+        ok = True
+        return result
+    except Exception:
+        DB_ERRORS.inc(op=op)
+        raise
+    finally:
+        DB_SECONDS.observe(time.perf_counter() - started, op=op)
+        if breaker is not None:
+            breaker.record(ok)
 
-def log_error(error: str):
-    timestamp = get_current_time().strftime('%H:%M:%S')
-    bot_state.error_logs.append(f"[{timestamp}] {error}")
-    logger.error(error)
-    BOT_STATS["errors_count"] += 1
+# Message layouts: "embedded" keeps a capped messages array on one document per user;
+# "per_message" stores one chat_messages document per message with a BSON date,
+# and the db.messages document only tracks last_active for that user.
 
-def is_bot_active() -> bool:
-    return get_config("bot_active", False)
+def parse_message_time(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = TIMEZONE.localize(parsed)
+    return parsed
 
-def get_owner_id() -> int:
-    owner = get_config("owner_id")
-    return owner if owner else OWNER_ID
+def format_message_time(value: datetime) -> str:
+    if value.tzinfo is None:
+        value = pytz.utc.localize(value)
+    return value.astimezone(TIMEZONE).isoformat(timespec="milliseconds")
 
-def is_owner(user_id: int) -> bool:
-    owner = get_owner_id()
-    return user_id == owner and owner != 0
+def message_id(user_id: int, entry: Dict, seen: Dict[str, int]) -> str:
+    # Same scheme as migrate_messages.py: derived from the message itself, with a counter
+    # that keeps exact duplicates in one batch apart, so a retried batch maps onto the
+    # documents the failed attempt already wrote
+    digest = hashlib.sha1(
+        f"{entry.get('time')}|{entry.get('sender')}|{entry.get('text')}".encode()
+    ).hexdigest()[:16]
+    seen[digest] = seen.get(digest, 0) + 1
+    return f"{user_id}:{digest}:{seen[digest]}"
 
-def save_message(user_id: int, text: str, sender: str = "user") -> bool:
-    if db is None:  # ✅ FIXED
-        return False
-    try:
-        db.messages.update_one(
-            {"user_id": user_id},
-            {
-                "$push": {
-                    "messages": {
-                        "$each": [{
-                            "text": text[:1000] if text else "[Empty]",
-                            "sender": sender,
-                            "time": get_current_time().isoformat()
-                        }],
-                        "$slice": -MAX_HISTORY_PER_USER
-                    }
-                }
-            },
-            upsert=True
-        )
-        return True
-    except:
-        return False
+def to_message_doc(user_id: int, entry: Dict, seen: Dict[str, int]) -> Dict:
+    return {
+        "_id": message_id(user_id, entry, seen),
+        "user_id": user_id,
+        "sender": entry.get("sender", "user"),
+        "text": entry.get("text", ""),
+        "time": parse_message_time(entry["time"])
+    }
 
-def get_conversation_history(user_id: int, limit: int = 10) -> List[Dict]:
-    if db is None:  # ✅ FIXED
-        return []
-    try:
-        data = db.messages.find_one({"user_id": user_id})
-        return data["messages"][-limit:] if data and "messages" in data else []
-    except:
-        return []
+def from_message_doc(doc: Dict) -> Dict:
+    value = doc.get("time")
+    return {
+        "text": doc.get("text", ""),
+        "sender": doc.get("sender", "user"),
+        "time": format_message_time(value) if isinstance(value, datetime) else value or ""
+    }
 
-def get_message_count(user_id: int) -> int:
-    if db is None:  # ✅ FIXED
-        return 0
-    try:
-        data = db.messages.find_one({"user_id": user_id})
-        return len(data.get("messages", [])) if data else 0
-    except:
-        return 0
+class Storage(ABC):
+    # Every persistent read/write goes through one of these. Methods are blocking
+    # and are always run on db_executor via db_call. A backend missing one of the
+    # abstract methods fails when it is constructed, not on first use.
+    name = "none"
+    local = False
+    bounded_history = False
+    breaker: Optional[CircuitBreaker] = None
+    
+    @abstractmethod
+    def ping(self): ...
+    def close(self): pass
+    def ensure_indexes(self): pass
+    # Blocks while streaming config changes into apply; returns when there is
+    # nothing to watch
+    @abstractmethod
+    def watch_config(self, apply: Callable): ...
+    @abstractmethod
+    def load_config(self) -> Dict[str, Any]: ...
+    @abstractmethod
+    def set_config(self, key: str, value: Any): ...
+    @abstractmethod
+    def append_messages(self, grouped: Dict[int, List[Dict]], when: datetime): ...
+    @abstractmethod
+    def add_activity(self, counts: Dict[int, int], hour: datetime): ...
+    @abstractmethod
+    def activity_summary(self, since: datetime, top: int) -> Dict[str, Any]: ...
+    # {"messages": [...], "summary": {...} or None}; the summary rides along so a
+    # history miss costs one read
+    @abstractmethod
+    def fetch_history(self, user_id: int, depth: int) -> Dict[str, Any]: ...
+    @abstractmethod
+    def count_history(self, user_id: int) -> int: ...
+    @abstractmethod
+    def recent_histories(self, count: int, depth: int) -> List[Dict]: ...
+    @abstractmethod
+    def count_users(self) -> int: ...
+    @abstractmethod
+    def get_summary(self, user_id: int) -> Optional[Dict]: ...
+    @abstractmethod
+    def set_summary(self, user_id: int, text: str, through: str): ...
+    @abstractmethod
+    def clear_user(self, user_id: int): ...
+    @abstractmethod
+    def clear_all(self) -> int: ...
+    @abstractmethod
+    def get_vip(self, user_id: int) -> Optional[Dict]: ...
+    @abstractmethod
+    def get_vips(self, user_ids: List[int]) -> List[Dict]: ...
+    @abstractmethod
+    def list_vips(self) -> List[Dict]: ...
+    @abstractmethod
+    def count_vips(self) -> int: ...
+    @abstractmethod
+    def set_vip(self, user_id: int, name: str): ...
+    @abstractmethod
+    def delete_vip(self, user_id: int) -> bool: ...
+    @abstractmethod
+    def get_gemini_keys(self) -> List[str]: ...
+    @abstractmethod
+    def set_gemini_keys(self, keys: List[str]): ...
+    @abstractmethod
+    def add_gemini_key(self, key: str): ...
+    @abstractmethod
+    def clear_gemini_keys(self): ...
+    @abstractmethod
+    def load_key_stats(self, fingerprints: List[str]) -> Dict[str, Dict]: ...
+    @abstractmethod
+    def save_key_stats(self, docs: List[Tuple[str, Dict]]): ...
+    @abstractmethod
+    def get_stickers(self) -> List[str]: ...
+    @abstractmethod
+    def add_sticker(self, file_id: str): ...
+    @abstractmethod
+    def remove_sticker(self, file_id: str): ...
+    @abstractmethod
+    def clear_stickers(self): ...
 
-def get_all_gemini_keys() -> List[str]:
-    if db is not None:  # ✅ FIXED
-        try:
-            doc = db.gemini_keys.find_one({"type": "keys"})
-            if doc and doc.get("keys"):
-                return doc["keys"]
-        except:
-            pass
+class MongoStorage(Storage):
+    name = "mongo"
     
-    keys = []
-    for i in range(1, 15):
-        key = os.getenv(f"GEMINI_KEY_{i}")
-        if key and key.strip():
-            keys.append(key.strip())
+    def __init__(self, database: Any, client: Optional[MongoClient] = None, per_message: bool = False):
+        self.db = database
+        self.client = client
+        self.per_message = per_message
+        self.bounded_history = not per_message
     
-    if keys and db is not None:  # ✅ FIXED
-        try:
-            db.gemini_keys.update_one(
-                {"type": "keys"},
-                {"$set": {"keys": keys, "current_index": 0}},
+    def ensure_indexes(self):
+        db = self.db
+        db.messages.create_index("user_id", unique=True)
+        db.messages.create_index("last_active")
+        db.activity.create_index([("user_id", 1), ("hour", 1)], unique=True)
+        db.activity.create_index("hour", expireAfterSeconds=ACTIVITY_RETENTION_HOURS * 3600)
+        if self.per_message:
+            db.chat_messages.create_index([("user_id", 1), ("time", -1)])
+            if MESSAGE_RETENTION_DAYS > 0:
+                db.chat_messages.create_index("time", expireAfterSeconds=MESSAGE_RETENTION_DAYS * 86400)
+        db.vips.create_index("user_id", unique=True)
+        db.config.create_index("key", unique=True)
+        db.gemini_key_stats.create_index("fingerprint", unique=True)
+    
+    def ping(self):
+        self.db.command("ping")
+    
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+    
+    def watch_config(self, apply: Callable):
+        with self.db.config.watch(full_document="updateLookup") as stream:
+            logger.info("✅ Config change stream active")
+            for change in stream:
+                apply(change)
+    
+    def load_config(self) -> Dict[str, Any]:
+        return {
+            doc["key"]: doc["value"]
+            for doc in self.db.config.find({}, {"_id": 0, "key": 1, "value": 1})
+            if "key" in doc and "value" in doc
+        }
+    
+    def set_config(self, key: str, value: Any):
+        self.db.config.update_one({"key": key}, {"$set": {"key": key, "value": value}}, upsert=True)
+    
+    def append_messages(self, grouped: Dict[int, List[Dict]], when: datetime):
+        if self.per_message:
+            self.db.messages.bulk_write([
+                UpdateOne({"user_id": user_id}, {"$max": {"last_active": when}}, upsert=True)
+                for user_id in grouped
+            ], ordered=False)
+            # A retried batch reuses its deterministic _ids, so whatever the failed attempt
+            # already inserted comes back as duplicate keys and is skipped
+            docs = []
+            for user_id, entries in grouped.items():
+                seen: Dict[str, int] = {}
+                docs.extend(to_message_doc(user_id, entry, seen) for entry in entries)
+            try:
+                self.db.chat_messages.insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                errors = e.details.get("writeErrors", [])
+                if e.details.get("writeConcernErrors") or any(error.get("code") != DUPLICATE_KEY_ERROR for error in errors):
+                    raise
+            return
+        self.db.messages.bulk_write([
+            UpdateOne(
+                {"user_id": user_id},
+                {
+                    "$push": {"messages": {"$each": entries, "$slice": -MAX_HISTORY_PER_USER}},
+                    "$max": {"last_active": when}
+                },
                 upsert=True
             )
-        except:
-            pass
+            for user_id, entries in grouped.items()
+        ], ordered=False)
     
-    return keys
-
-def add_gemini_key(key: str) -> bool:
-    if db is None:  # ✅ FIXED
-        return False
-    try:
-        db.gemini_keys.update_one(
-            {"type": "keys"},
-            {"$addToSet": {"keys": key}},
-            upsert=True
+    def add_activity(self, counts: Dict[int, int], hour: datetime):
+        self.db.activity.bulk_write([
+            UpdateOne({"user_id": user_id, "hour": hour}, {"$inc": {"count": count}}, upsert=True)
+            for user_id, count in counts.items()
+        ], ordered=False)
+    
+    def activity_summary(self, since: datetime, top: int) -> Dict[str, Any]:
+        result = list(self.db.activity.aggregate([
+            {"$match": {"hour": {"$gte": since}}},
+            {"$group": {"_id": "$user_id", "count": {"$sum": "$count"}}},
+            {"$facet": {
+                "top": [{"$sort": {"count": -1}}, {"$limit": top}],
+                "totals": [{"$group": {"_id": None, "total": {"$sum": "$count"}, "users": {"$sum": 1}}}]
+            }}
+        ]))
+        facet = result[0] if result else {}
+        totals = facet.get("totals") or [{}]
+        return {
+            "top": [(doc["_id"], doc["count"]) for doc in facet.get("top", [])],
+            "total": totals[0].get("total", 0),
+            "users": totals[0].get("users", 0)
+        }
+    
+    def fetch_history(self, user_id: int, depth: int) -> Dict[str, Any]:
+        if self.per_message:
+            docs = list(
+                self.db.chat_messages.find({"user_id": user_id}, {"_id": 0, "text": 1, "sender": 1, "time": 1})
+                .sort("time", -1)
+                .limit(depth)
+            )
+            return {
+                "messages": [from_message_doc(doc) for doc in reversed(docs)],
+                "summary": self.get_summary(user_id)
+            }
+        data = self.db.messages.find_one(
+            {"user_id": user_id},
+            {"_id": 0, "messages": {"$slice": -depth}, "summary": 1}
+        ) or {}
+        return {"messages": data.get("messages", []), "summary": data.get("summary")}
+    
+    def count_history(self, user_id: int) -> int:
+        if self.per_message:
+            return self.db.chat_messages.count_documents({"user_id": user_id})
+        data = self.db.messages.find_one({"user_id": user_id}, {"_id": 0, "messages": 1})
+        return len(data.get("messages", [])) if data else 0
+    
+    def recent_histories(self, count: int, depth: int) -> List[Dict]:
+        if self.per_message:
+            docs = self.db.messages.find({}, {"_id": 0, "user_id": 1}).sort("last_active", -1).limit(count)
+            return [
+                {"user_id": doc["user_id"], **self.fetch_history(doc["user_id"], depth)}
+                for doc in docs if "user_id" in doc
+            ]
+        return list(
+            self.db.messages.find(
+                {},
+                {"_id": 0, "user_id": 1, "messages": {"$slice": -depth}, "summary": 1}
+            ).sort("last_active", -1).limit(count)
         )
-        return True
-    except:
-        return False
+    
+    def count_users(self) -> int:
+        return self.db.messages.count_documents({})
+    
+    def get_summary(self, user_id: int) -> Optional[Dict]:
+        doc = self.db.messages.find_one({"user_id": user_id}, {"_id": 0, "summary": 1})
+        return doc.get("summary") if doc else None
+    
+    def set_summary(self, user_id: int, text: str, through: str):
+        self.db.messages.update_one(
+            {"user_id": user_id},
+            {"$set": {"summary": {"text": text, "through": through}}},
+            upsert=True
+        )
+    
+    def clear_user(self, user_id: int):
+        if self.per_message:
+            self.db.chat_messages.delete_many({"user_id": user_id})
+        self.db.activity.delete_many({"user_id": user_id})
+        self.db.messages.delete_one({"user_id": user_id})
+    
+    def clear_all(self) -> int:
+        if self.per_message:
+            self.db.chat_messages.delete_many({})
+        self.db.activity.delete_many({})
+        return self.db.messages.delete_many({}).deleted_count
+    
+    def get_vip(self, user_id: int) -> Optional[Dict]:
+        return self.db.vips.find_one({"user_id": user_id}, {"_id": 0})
+    
+    def get_vips(self, user_ids: List[int]) -> List[Dict]:
+        return list(self.db.vips.find({"user_id": {"$in": user_ids}}, {"_id": 0}))
+    
+    def list_vips(self) -> List[Dict]:
+        return list(self.db.vips.find({}, {"_id": 0}))
+    
+    def count_vips(self) -> int:
+        return self.db.vips.count_documents({})
+    
+    def set_vip(self, user_id: int, name: str):
+        self.db.vips.update_one({"user_id": user_id}, {"$set": {"user_id": user_id, "name": name}}, upsert=True)
+    
+    def delete_vip(self, user_id: int) -> bool:
+        return self.db.vips.delete_one({"user_id": user_id}).deleted_count > 0
+    
+    def get_gemini_keys(self) -> List[str]:
+        doc = self.db.gemini_keys.find_one({"type": "keys"})
+        return doc.get("keys", []) if doc else []
+    
+    def set_gemini_keys(self, keys: List[str]):
+        self.db.gemini_keys.update_one(
+            {"type": "keys"},
+            {"$set": {"keys": keys, "current_index": 0}},
+            upsert=True
+        )
+    
+    def add_gemini_key(self, key: str):
+        self.db.gemini_keys.update_one({"type": "keys"}, {"$addToSet": {"keys": key}}, upsert=True)
+    
+    def clear_gemini_keys(self):
+        self.db.gemini_keys.delete_one({"type": "keys"})
+    
+    def load_key_stats(self, fingerprints: List[str]) -> Dict[str, Dict]:
+        return {
+            doc["fingerprint"]: doc
+            for doc in self.db.gemini_key_stats.find({"fingerprint": {"$in": fingerprints}}, {"_id": 0})
+        }
+    
+    def save_key_stats(self, docs: List[Tuple[str, Dict]]):
+        ops = [
+            UpdateOne({"fingerprint": fp}, {"$set": {"fingerprint": fp, **doc}}, upsert=True)
+            for fp, doc in docs
+        ]
+        if ops:
+            self.db.gemini_key_stats.bulk_write(ops, ordered=False)
+    
+    def get_stickers(self) -> List[str]:
+        doc = self.db.stickers.find_one({"type": "stickers"})
+        return doc.get("file_ids", []) if doc else []
+    
+    def add_sticker(self, file_id: str):
+        self.db.stickers.update_one({"type": "stickers"}, {"$addToSet": {"file_ids": file_id}}, upsert=True)
+    
+    def remove_sticker(self, file_id: str):
+        self.db.stickers.update_one({"type": "stickers"}, {"$pull": {"file_ids": file_id}})
+    
+    def clear_stickers(self):
+        self.db.stickers.delete_one({"type": "stickers"})
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, last_active REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS users_last_active ON users (last_active);
+CREATE TABLE IF NOT EXISTS chat_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    sender TEXT NOT NULL,
+    text TEXT NOT NULL,
+    time TEXT NOT NULL,
+    ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chat_messages_user ON chat_messages (user_id, id);
+CREATE INDEX IF NOT EXISTS chat_messages_ts ON chat_messages (ts);
+CREATE TABLE IF NOT EXISTS activity (
+    user_id INTEGER NOT NULL,
+    hour INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (user_id, hour)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS activity_hour ON activity (hour);
+CREATE TABLE IF NOT EXISTS summaries (user_id INTEGER PRIMARY KEY, text TEXT NOT NULL, through TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS vips (user_id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE IF NOT EXISTS gemini_keys (position INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS gemini_key_stats (fingerprint TEXT PRIMARY KEY, doc TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS stickers (position INTEGER PRIMARY KEY AUTOINCREMENT, file_id TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS failover (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS failover_journal (id INTEGER PRIMARY KEY AUTOINCREMENT, method TEXT NOT NULL, args TEXT NOT NULL);
+"""
+
+def _utc_epoch(value: datetime) -> float:
+    if value.tzinfo is None:
+        value = pytz.utc.localize(value)
+    return value.timestamp()
+
+class SQLiteStorage(Storage):
+    # Local store: one WAL-mode file, one connection per executor thread so reads
+    # run concurrently and writes serialize on SQLite's own lock. Also the standby
+    # for an unreachable MongoDB (see StorageFailover): while failed over, every
+    # change is journaled in the same transaction, except message appends and their
+    # activity counts, which are rebuilt from the messages past the watermark.
+    name = "sqlite"
+    local = True
+    # Each user's rows are trimmed to MAX_HISTORY_PER_USER on append, like the capped
+    # embedded Mongo array, so the file doesn't grow with every message ever sent
+    bounded_history = True
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        with self._conn() as conn:
+            conn.executescript(SQLITE_SCHEMA)
+        self.journaling = self.failover_pending()
+    
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=OFF")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+    
+    def _all(self, sql: str, params: Tuple = ()) -> List[sqlite3.Row]:
+        return self._conn().execute(sql, params).fetchall()
+    
+    def _one(self, sql: str, params: Tuple = ()) -> Optional[sqlite3.Row]:
+        return self._conn().execute(sql, params).fetchone()
+    
+    def ping(self):
+        self._one("SELECT 1")
+    
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+    
+    def _journal(self, conn: sqlite3.Connection, method: str, *args):
+        if self.journaling:
+            conn.execute("INSERT INTO failover_journal (method, args) VALUES (?, ?)", (method, json.dumps(args)))
+    
+    def failover_pending(self) -> bool:
+        return self._one("SELECT 1 FROM failover WHERE key = 'watermark'") is not None
+    
+    def begin_failover(self):
+        # Keeps the older watermark if a previous failover was never reconciled
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO failover (key, value) "
+                "SELECT 'watermark', COALESCE(MAX(id), 0) FROM chat_messages"
+            )
+        self.journaling = True
+    
+    def failover_journal(self) -> List[Tuple[int, str, List]]:
+        return [
+            (row["id"], row["method"], json.loads(row["args"]))
+            for row in self._all("SELECT id, method, args FROM failover_journal ORDER BY id")
+        ]
+    
+    def drop_journal_entry(self, entry_id: int):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM failover_journal WHERE id = ?", (entry_id,))
+    
+    def failover_messages(self) -> List[Tuple[int, Dict]]:
+        rows = self._all(
+            "SELECT user_id, sender, text, time FROM chat_messages "
+            "WHERE id > (SELECT value FROM failover WHERE key = 'watermark') ORDER BY id"
+        )
+        return [(row["user_id"], {"text": row["text"], "sender": row["sender"], "time": row["time"]}) for row in rows]
+    
+    def end_failover(self):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM failover")
+            conn.execute("DELETE FROM failover_journal")
+        self.journaling = False
+    
+    def load_snapshot(
+        self,
+        config: Dict[str, Any],
+        vips: List[Dict],
+        keys: Optional[List[str]],
+        stickers: List[str]
+    ):
+        # Mirror of the small MongoDB collections, so a failover starts with the
+        # current config, VIPs, keys and stickers. Not journaled: it came from there.
+        with self._conn() as conn:
+            conn.execute("DELETE FROM config")
+            conn.executemany(
+                "INSERT INTO config (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in config.items()]
+            )
+            conn.execute("DELETE FROM vips")
+            conn.executemany(
+                "INSERT OR REPLACE INTO vips (user_id, name) VALUES (?, ?)",
+                [(vip["user_id"], vip.get("name")) for vip in vips if "user_id" in vip]
+            )
+            if keys is not None:
+                conn.execute("DELETE FROM gemini_keys")
+                conn.executemany(
+                    "INSERT OR IGNORE INTO gemini_keys (position, key) VALUES (?, ?)", list(enumerate(keys))
+                )
+            conn.execute("DELETE FROM stickers")
+            conn.executemany("INSERT OR IGNORE INTO stickers (file_id) VALUES (?)", [(f,) for f in stickers])
+    
+    def watch_config(self, apply: Callable):
+        # This process is the file's only writer, so there are no outside changes
+        return
+    
+    def load_config(self) -> Dict[str, Any]:
+        return {row["key"]: json.loads(row["value"]) for row in self._all("SELECT key, value FROM config")}
+    
+    def set_config(self, key: str, value: Any):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO config (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, json.dumps(value))
+            )
+            self._journal(conn, "set_config", key, value)
+    
+    def append_messages(self, grouped: Dict[int, List[Dict]], when: datetime):
+        now = _utc_epoch(when)
+        rows = [
+            (user_id, entry.get("sender", "user"), entry.get("text", ""), entry["time"],
+             parse_message_time(entry["time"]).timestamp())
+            for user_id, entries in grouped.items() for entry in entries
+        ]
+        with self._conn() as conn:
+            conn.executemany(
+                "INSERT INTO users (user_id, last_active) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET last_active = MAX(last_active, excluded.last_active)",
+                [(user_id, now) for user_id in grouped]
+            )
+            conn.executemany(
+                "INSERT INTO chat_messages (user_id, sender, text, time, ts) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            conn.executemany(
+                "DELETE FROM chat_messages WHERE user_id = ? AND id <= "
+                "(SELECT id FROM chat_messages WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                [(user_id, user_id, MAX_HISTORY_PER_USER) for user_id in grouped]
+            )
+            if MESSAGE_RETENTION_DAYS > 0:
+                conn.execute("DELETE FROM chat_messages WHERE ts < ?", (now - MESSAGE_RETENTION_DAYS * 86400,))
+    
+    def add_activity(self, counts: Dict[int, int], hour: datetime):
+        stamp = int(_utc_epoch(hour))
+        with self._conn() as conn:
+            conn.executemany(
+                "INSERT INTO activity (user_id, hour, count) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id, hour) DO UPDATE SET count = count + excluded.count",
+                [(user_id, stamp, count) for user_id, count in counts.items()]
+            )
+            conn.execute("DELETE FROM activity WHERE hour < ?", (stamp - ACTIVITY_RETENTION_HOURS * 3600,))
+    
+    def activity_summary(self, since: datetime, top: int) -> Dict[str, Any]:
+        stamp = int(_utc_epoch(since))
+        rows = self._all(
+            "SELECT user_id, SUM(count) AS total FROM activity WHERE hour >= ? "
+            "GROUP BY user_id ORDER BY total DESC LIMIT ?",
+            (stamp, top)
+        )
+        totals = self._one(
+            "SELECT COALESCE(SUM(count), 0) AS total, COUNT(DISTINCT user_id) AS users FROM activity WHERE hour >= ?",
+            (stamp,)
+        )
+        return {
+            "top": [(row["user_id"], row["total"]) for row in rows],
+            "total": totals["total"],
+            "users": totals["users"]
+        }
+    
+    def fetch_history(self, user_id: int, depth: int) -> Dict[str, Any]:
+        rows = self._all(
+            "SELECT sender, text, time FROM chat_messages WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+            (user_id, depth)
+        )
+        return {
+            "messages": [{"text": row["text"], "sender": row["sender"], "time": row["time"]} for row in reversed(rows)],
+            "summary": self.get_summary(user_id)
+        }
+    
+    def count_history(self, user_id: int) -> int:
+        return self._one("SELECT COUNT(*) FROM chat_messages WHERE user_id = ?", (user_id,))[0]
+    
+    def recent_histories(self, count: int, depth: int) -> List[Dict]:
+        return [
+            {"user_id": row["user_id"], **self.fetch_history(row["user_id"], depth)}
+            for row in self._all("SELECT user_id FROM users ORDER BY last_active DESC LIMIT ?", (count,))
+        ]
+    
+    def count_users(self) -> int:
+        return self._one("SELECT COUNT(*) FROM users")[0]
+    
+    def get_summary(self, user_id: int) -> Optional[Dict]:
+        row = self._one("SELECT text, through FROM summaries WHERE user_id = ?", (user_id,))
+        return dict(row) if row else None
+    
+    def set_summary(self, user_id: int, text: str, through: str):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO summaries (user_id, text, through) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET text = excluded.text, through = excluded.through",
+                (user_id, text, through)
+            )
+            self._journal(conn, "set_summary", user_id, text, through)
+    
+    def clear_user(self, user_id: int):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM chat_messages WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM summaries WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM activity WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+            self._journal(conn, "clear_user", user_id)
+    
+    def clear_all(self) -> int:
+        with self._conn() as conn:
+            conn.execute("DELETE FROM chat_messages")
+            conn.execute("DELETE FROM summaries")
+            conn.execute("DELETE FROM activity")
+            self._journal(conn, "clear_all")
+            return conn.execute("DELETE FROM users").rowcount
+    
+    def get_vip(self, user_id: int) -> Optional[Dict]:
+        row = self._one("SELECT user_id, name FROM vips WHERE user_id = ?", (user_id,))
+        return dict(row) if row else None
+    
+    def get_vips(self, user_ids: List[int]) -> List[Dict]:
+        marks = ",".join("?" * len(user_ids))
+        return [dict(row) for row in self._all(f"SELECT user_id, name FROM vips WHERE user_id IN ({marks})", tuple(user_ids))]
+    
+    def list_vips(self) -> List[Dict]:
+        return [dict(row) for row in self._all("SELECT user_id, name FROM vips")]
+    
+    def count_vips(self) -> int:
+        return self._one("SELECT COUNT(*) FROM vips")[0]
+    
+    def set_vip(self, user_id: int, name: str):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO vips (user_id, name) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET name = excluded.name",
+                (user_id, name)
+            )
+            self._journal(conn, "set_vip", user_id, name)
+    
+    def delete_vip(self, user_id: int) -> bool:
+        with self._conn() as conn:
+            self._journal(conn, "delete_vip", user_id)
+            return conn.execute("DELETE FROM vips WHERE user_id = ?", (user_id,)).rowcount > 0
+    
+    def get_gemini_keys(self) -> List[str]:
+        return [row["key"] for row in self._all("SELECT key FROM gemini_keys ORDER BY position")]
+    
+    def set_gemini_keys(self, keys: List[str]):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM gemini_keys")
+            conn.executemany(
+                "INSERT OR IGNORE INTO gemini_keys (position, key) VALUES (?, ?)", list(enumerate(keys))
+            )
+            self._journal(conn, "set_gemini_keys", keys)
+    
+    def add_gemini_key(self, key: str):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO gemini_keys (position, key) "
+                "SELECT COALESCE(MAX(position), -1) + 1, ? FROM gemini_keys",
+                (key,)
+            )
+            self._journal(conn, "add_gemini_key", key)
+    
+    def clear_gemini_keys(self):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM gemini_keys")
+            self._journal(conn, "clear_gemini_keys")
+    
+    def load_key_stats(self, fingerprints: List[str]) -> Dict[str, Dict]:
+        marks = ",".join("?" * len(fingerprints))
+        return {
+            row["fingerprint"]: json.loads(row["doc"])
+            for row in self._all(
+                f"SELECT fingerprint, doc FROM gemini_key_stats WHERE fingerprint IN ({marks})", tuple(fingerprints)
+            )
+        }
+    
+    def save_key_stats(self, docs: List[Tuple[str, Dict]]):
+        with self._conn() as conn:
+            conn.executemany(
+                "INSERT INTO gemini_key_stats (fingerprint, doc) VALUES (?, ?) "
+                "ON CONFLICT(fingerprint) DO UPDATE SET doc = excluded.doc",
+                [(fp, json.dumps({"fingerprint": fp, **doc})) for fp, doc in docs]
+            )
+            self._journal(conn, "save_key_stats", docs)
+    
+    def get_stickers(self) -> List[str]:
+        return [row["file_id"] for row in self._all("SELECT file_id FROM stickers ORDER BY position")]
+    
+    def add_sticker(self, file_id: str):
+        with self._conn() as conn:
+            conn.execute("INSERT OR IGNORE INTO stickers (file_id) VALUES (?)", (file_id,))
+            self._journal(conn, "add_sticker", file_id)
+    
+    def remove_sticker(self, file_id: str):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM stickers WHERE file_id = ?", (file_id,))
+            self._journal(conn, "remove_sticker", file_id)
+    
+    def clear_stickers(self):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM stickers")
+            self._journal(conn, "clear_stickers")
+
+def mongo_database_name(namespace: str) -> str:
+    return f"aryan_userbot_{namespace}" if namespace else "aryan_userbot"
+
+def connect_mongodb() -> Optional[MongoClient]:
+    if not MONGO_URI:
+        logger.warning("⚠️ No MongoDB URI")
+        return None
+    
+    try:
+        client = MongoClient(
+            MONGO_URI,
+            serverSelectionTimeoutMS=5000,
+            connectTimeoutMS=10000,
+            retryWrites=True,
+            maxPoolSize=MONGO_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            w=get_write_concern(),
+            journal=MONGO_JOURNAL
+        )
+    except Exception as e:
+        logger.critical(f"❌ Invalid MONGO_URI: {e}")
+        sys.exit(1)
+    return client
+
+def ping_mongodb(client: MongoClient) -> bool:
+    try:
+        client.admin.command('ping')
+        return True
+    except Exception as e:
+        logger.warning(f"⚠️ MongoDB unreachable: {e}")
+        return False
+
+def open_sqlite(path: str) -> SQLiteStorage:
+    try:
+        backend = SQLiteStorage(path)
+    except Exception as e:
+        fallback = os.path.join(tempfile.gettempdir(), os.path.basename(path) or "aryan_userbot.db")
+        logger.error(f"❌ SQLite at {path} failed ({e}), using {fallback}")
+        backend = SQLiteStorage(fallback)
+    logger.info(f"✅ Local storage: {backend.path}")
+    return backend
+
+def open_local_storage(namespaces: List[str]) -> List[SQLiteStorage]:
+    backends = [open_sqlite(account_path(SQLITE_PATH, ns)) for ns in namespaces]
+    for ns, backend in zip(namespaces, backends):
+        backend.breaker = CircuitBreaker(f"sqlite:{ns}" if ns else "sqlite")
+    return backends
+
+def connect_storage(namespaces: List[str]) -> List[Storage]:
+    # One namespace per account: a database on the shared MongoClient (one pool for
+    # every account), or a separate SQLite file next to SQLITE_PATH. In auto mode the
+    # SQLite files also stand by for MongoDB and take over while it is unreachable.
+    if STORAGE_BACKEND != "sqlite":
+        client = connect_mongodb()
+        if client is not None:
+            # One cluster, so one breaker for every account's database
+            breaker = CircuitBreaker("mongo")
+            backends = [
+                MongoStorage(client[mongo_database_name(ns)], client, PER_MESSAGE_STORAGE)
+                for ns in namespaces
+            ]
+            for backend in backends:
+                backend.breaker = breaker
+            reachable = ping_mongodb(client)
+            if reachable:
+                logger.info("✅ MongoDB connected")
+            if STORAGE_BACKEND == "mongo":
+                return backends
+            return storage_failover.attach(client, namespaces, backends, open_local_storage(namespaces), reachable)
+        if STORAGE_BACKEND == "mongo":
+            logger.critical("❌ STORAGE_BACKEND=mongo but MongoDB is unavailable")
+            sys.exit(1)
+    return open_local_storage(namespaces)
+
+class StorageFailover:
+    # STORAGE_BACKEND=auto with MONGO_URI: each account's SQLite file is a warm
+    # standby, refreshed from MongoDB every STORAGE_SNAPSHOT_SECONDS. If the ping fails
+    # at startup, or the mongo breaker stays tripped for STORAGE_FAILOVER_AFTER_SECONDS,
+    # the accounts move to it. Once MongoDB answers again, the standby's journal is
+    # replayed there, its new messages go back through the write buffer, and the
+    # accounts move back.
+    def __init__(self):
+        self.client: Optional[MongoClient] = None
+        self.pairs: Dict[str, Tuple[MongoStorage, SQLiteStorage]] = {}
+        self.active = False
+        self.failovers = 0
+        self.restores = 0
+        self._tripped_since: Optional[float] = None
+        self._next_ping = 0.0
+        self._ping_backoff = STORAGE_FAILOVER_CHECK_SECONDS
+        self._snapshot_at = float("-inf")
+        self._task: Optional[asyncio.Task] = None
+    
+    @property
+    def enabled(self) -> bool:
+        return self.client is not None
+    
+    @property
+    def remote_breaker(self) -> Optional[CircuitBreaker]:
+        # All remote backends share the one "mongo" breaker
+        return next(iter(self.pairs.values()))[0].breaker if self.pairs else None
+    
+    def attach(
+        self,
+        client: MongoClient,
+        namespaces: List[str],
+        remote: List[MongoStorage],
+        local: List[SQLiteStorage],
+        reachable: bool
+    ) -> List[Storage]:
+        self.client = client
+        self.pairs = {ns: pair for ns, pair in zip(namespaces, zip(remote, local))}
+        # A standby holding an unreconciled failover is replayed before MongoDB is used
+        self.active = not reachable or any(backend.failover_pending() for backend in local)
+        if not self.active:
+            return remote
+        if not reachable:
+            logger.warning("⚠️ Running on local storage until MongoDB is reachable")
+        for backend in local:
+            backend.begin_failover()
+        return local
+    
+    async def _snapshot(self, account: "Account"):
+        remote, local = self.pairs[account.namespace]
+        config = await db_call(remote.load_config)
+        vips = await db_call(remote.list_vips)
+        keys = await db_call(remote.get_gemini_keys) if account.primary else None
+        stickers = await db_call(remote.get_stickers)
+        await db_call(local.load_snapshot, config, vips, keys, stickers)
+    
+    async def snapshot(self):
+        self._snapshot_at = time.monotonic()
+        for account in accounts:
+            try:
+                await self._snapshot(account)
+            except Exception as e:
+                logger.warning(f"⚠️ Standby snapshot for {account.name} failed: {e}")
+    
+    async def fail_over(self):
+        for account in accounts:
+            remote, local = self.pairs[account.namespace]
+            # Config and keys may be newer in memory than in the last snapshot
+            for key, value in account.config.snapshot().items():
+                await db_call(local.set_config, key, value)
+            if account.primary:
+                keys = await key_scheduler.get_keys()
+                if keys:
+                    await db_call(local.set_gemini_keys, keys)
+            await db_call(local.begin_failover)
+            account.storage = local
+        self.active = True
+        self.failovers += 1
+        self._ping_backoff = STORAGE_FAILOVER_CHECK_SECONDS
+        self._next_ping = time.monotonic() + self._ping_backoff
+        logger.warning("⚠️ MongoDB unavailable, accounts moved to local storage")
+    
+    async def _replay(self, account: "Account", local: SQLiteStorage, remote: MongoStorage):
+        for entry_id, method, args in await db_call(local.failover_journal):
+            await db_call(getattr(remote, method), *args)
+            await db_call(local.drop_journal_entry, entry_id)
+        messages = await db_call(local.failover_messages)
+        try:
+            # Indexes were never built if the process started on the standby
+            await db_call(remote.ensure_indexes)
+        except Exception as e:
+            logger.warning(f"⚠️ Index creation failed for {account.name}: {e}")
+        account.storage = remote
+        for user_id, entry in messages:
+            await message_buffer.put(user_id, entry)
+        await db_call(local.end_failover)
+        await db_call(account.config.load)
+        account.config.start_watcher()
+        return len(messages)
+    
+    async def restore(self) -> bool:
+        try:
+            reachable = await asyncio.to_thread(ping_mongodb, self.client)
+        except Exception:
+            reachable = False
+        if not reachable:
+            self._ping_backoff = min(self._ping_backoff * 2, STORAGE_RECOVERY_MAX_SECONDS)
+            self._next_ping = time.monotonic() + self._ping_backoff
+            return False
+        if self.remote_breaker is not None:
+            self.remote_breaker.reset()
+        replayed = 0
+        for account in accounts:
+            remote, local = self.pairs[account.namespace]
+            if account.storage is remote:
+                continue
+            try:
+                replayed += await account.run(self._replay(account, local, remote))
+            except Exception as e:
+                # Whatever was replayed is dropped from the journal; the rest waits
+                account.storage = local
+                log_error(f"Storage restore for {account.name}: {e}")
+                self._next_ping = time.monotonic() + self._ping_backoff
+                return False
+        await message_buffer.flush()
+        self.active = False
+        self.restores += 1
+        self._tripped_since = None
+        logger.info(f"✅ MongoDB back, {replayed} local messages handed to the write buffer")
+        await self.snapshot()
+        return True
+    
+    async def check(self):
+        now = time.monotonic()
+        if self.active:
+            if now >= self._next_ping:
+                await self.restore()
+            return
+        breaker = self.remote_breaker
+        if breaker is not None and breaker.state != CIRCUIT_CLOSED:
+            if self._tripped_since is None:
+                self._tripped_since = now
+            elif now - self._tripped_since >= STORAGE_FAILOVER_AFTER_SECONDS:
+                await self.fail_over()
+            return
+        self._tripped_since = None
+        if now - self._snapshot_at >= STORAGE_SNAPSHOT_SECONDS:
+            await self.snapshot()
+    
+    async def _loop(self):
+        while True:
+            try:
+                await self.check()
+            except Exception as e:
+                log_error(f"Storage failover: {e}")
+            await asyncio.sleep(STORAGE_FAILOVER_CHECK_SECONDS)
+    
+    def start(self):
+        if self.enabled and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._loop())
+    
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+    
+    def close(self):
+        for remote, local in self.pairs.values():
+            remote.close()
+            local.close()
+
+storage_failover = StorageFailover()
+
+# Opened by start_bot (init_storage), concurrently with the Telegram login
+storage = AccountLocal("storage")
+
+def shared_storage() -> Storage:
+    # Gemini keys and their stats are one pool for every account, kept with the primary
+    return accounts.primary.storage
+
+# ═══════════════════════════════════════════════════════════════
+#                      CONFIG CACHE
+# ═══════════════════════════════════════════════════════════════
+
+class ConfigCache:
+    def __init__(self, account: "Account"):
+        self.account = account
+        self._lock = threading.Lock()
+        self._values: Dict[str, Any] = {}
+        self._loaded = False
+        self._last_attempt = 0.0
+        self._watcher: Optional[threading.Thread] = None
+    
+    def load(self) -> bool:
+        self._last_attempt = time.monotonic()
+        try:
+            values = self.account.storage.load_config()
+        except Exception as e:
+            logger.warning(f"⚠️ Config load failed: {e}")
+            return False
+        with self._lock:
+            self._values = values
+            self._loaded = True
+        return True
+    
+    def get(self, key: str, default: Any = None) -> Any:
+        if not self._loaded and time.monotonic() - self._last_attempt > CONFIG_RELOAD_RETRY_SECONDS:
+            self._last_attempt = time.monotonic()
+            db_executor.submit(self.load)
+        values = self._values
+        return values[key] if key in values else default
+    
+    def put(self, key: str, value: Any):
+        with self._lock:
+            self._values = {**self._values, key: value}
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return dict(self._values)
+    
+    def _apply_change(self, change: Dict):
+        doc = change.get("fullDocument")
+        if change.get("operationType") in ("insert", "update", "replace") and doc and "key" in doc:
+            with self._lock:
+                self._values = {**self._values, doc["key"]: doc.get("value")}
+        else:
+            self.load()
+    
+    def _watch_stream(self):
+        try:
+            self.account.storage.watch_config(self._apply_change)
+        except Exception as e:
+            logger.warning(f"⚠️ Config change stream unavailable: {e}")
+    
+    def _watch(self):
+        if CONFIG_CHANGE_STREAM:
+            self._watch_stream()
+        if CONFIG_CACHE_TTL <= 0:
+            return
+        while True:
+            time.sleep(CONFIG_CACHE_TTL)
+            self.load()
+    
+    def start_watcher(self):
+        # A local store has no other writers to watch for
+        if self.account.storage.local or (self._watcher and self._watcher.is_alive()):
+            return
+        if not CONFIG_CHANGE_STREAM and CONFIG_CACHE_TTL <= 0:
+            return
+        self._watcher = threading.Thread(
+            target=self._watch, name=f"config-watcher-{self.account.name}", daemon=True
+        )
+        self._watcher.start()
+
+config_cache = AccountLocal("config")
+
+# ═══════════════════════════════════════════════════════════════
+#                      WRITE-BEHIND BUFFER
+# ═══════════════════════════════════════════════════════════════
+
+class MessageWriteBuffer:
+    # Shared by every account; entries carry their account and are written to
+    # that account's storage. Batches that still fail after the retries are kept
+    # and retried later (they stay visible to history reads meanwhile); beyond
+    # max_pending kept entries, and whatever is unwritten at shutdown, go to a
+    # spill file that restore() replays on the next start.
+    def __init__(self, max_pending: int, batch_size: int, flush_interval: float, spill_path: str):
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self._queue: Optional[asyncio.Queue] = None
+        self._batch: List[Tuple["Account", int, Dict]] = []
+        self._retained: List[Tuple["Account", int, Dict]] = []
+        self._retry_at = 0.0
+        self._pending: Dict[Tuple[str, int], deque] = {}
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+        self.flushed_count = 0
+        self.retained_count = 0
+        self.spilled_count = 0
+    
+    def start(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_pending)
+            self._flush_lock = asyncio.Lock()
+        if self._task is None or self._task.done():
+            self._closed = False
+            self._task = asyncio.create_task(self._run())
+    
+    @property
+    def depth(self) -> int:
+        return (self._queue.qsize() if self._queue else 0) + len(self._batch) + len(self._retained)
+    
+    def _track(self, account: "Account", user_id: int, entry: Dict):
+        self._pending.setdefault((account.name, user_id), deque()).append(entry)
+    
+    def _untrack(self, account: "Account", user_id: int, entry: Dict):
+        key = (account.name, user_id)
+        entries = self._pending.get(key)
+        if not entries:
+            return
+        try:
+            entries.remove(entry)
+        except ValueError:
+            pass
+        if not entries:
+            del self._pending[key]
+    
+    def pending(self, user_id: int) -> List[Dict]:
+        return list(self._pending.get(account_key(user_id), ()))
+    
+    async def put(self, user_id: int, entry: Dict):
+        self.start()
+        account = current_account()
+        self._track(account, user_id, entry)
+        await self._queue.put((account, user_id, entry))
+    
+    async def discard(self, user_id: Optional[int] = None) -> int:
+        # Drops the current account's unwritten entries (one user's, or all of them)
+        # so a clear isn't undone when they are written, along with their activity,
+        # after it. Holding the flush lock also waits out a write already in flight.
+        self.start()
+        account = current_account()
+        
+        def cleared(name: str, uid: int) -> bool:
+            return name == account.name and (user_id is None or uid == user_id)
+        
+        async with self._flush_lock:
+            while not self._queue.empty():
+                self._batch.append(self._queue.get_nowait())
+            dropped = [item for item in self._batch + self._retained if cleared(item[0].name, item[1])]
+            self._batch = [item for item in self._batch if not cleared(item[0].name, item[1])]
+            self._retained = [item for item in self._retained if not cleared(item[0].name, item[1])]
+            for item in dropped:
+                self._untrack(*item)
+            return len(dropped) + self._discard_spilled(cleared)
+    
+    def _discard_spilled(self, cleared: Callable[[str, int], bool]) -> int:
+        if not os.path.exists(self.spill_path):
+            return 0
+        try:
+            with open(self.spill_path, encoding="utf-8") as f:
+                lines = f.readlines()
+            kept = []
+            for line in lines:
+                try:
+                    doc = json.loads(line)
+                except ValueError:
+                    kept.append(line)
+                    continue
+                if not cleared(doc.get("account"), doc.get("user_id")):
+                    kept.append(line)
+            if len(kept) == len(lines):
+                return 0
+            with open(self.spill_path, "w", encoding="utf-8") as f:
+                f.writelines(kept)
+            return len(lines) - len(kept)
+        except Exception as e:
+            log_error(f"Write buffer: couldn't drop cleared entries from {self.spill_path}: {e}")
+            return 0
+    
+    async def _next(self) -> Optional[Tuple["Account", int, Dict]]:
+        if not self._retained:
+            return await self._queue.get()
+        try:
+            return await asyncio.wait_for(self._queue.get(), max(0.0, self._retry_at - time.monotonic()))
+        except asyncio.TimeoutError:
+            return None
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while not self._closed:
+                item = await self._next()
+                if item is None:
+                    await asyncio.shield(self.flush())
+                    continue
+                self._batch.append(item)
+                deadline = loop.time() + self.flush_interval
+                while len(self._batch) < self.batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        # Await before touching self._batch: flush() may swap the list meanwhile
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    self._batch.append(item)
+                await asyncio.shield(self.flush())
+        except asyncio.CancelledError:
+            pass
+    
+    async def flush(self):
+        if self._queue is None:
+            return
+        async with self._flush_lock:
+            while not self._queue.empty():
+                self._batch.append(self._queue.get_nowait())
+            # Kept entries are older than anything queued since, so they go first
+            batch, self._retained, self._batch = self._retained + self._batch, [], []
+            if batch:
+                await self._write(batch)
+    
+    async def _write(self, batch: List[Tuple["Account", int, Dict]]):
+        by_account: Dict["Account", List[Tuple[int, Dict]]] = {}
+        for account, user_id, entry in batch:
+            by_account.setdefault(account, []).append((user_id, entry))
+        accounts_in_batch = list(by_account)
+        results = await asyncio.gather(*(
+            account.run(self._write_account(account, by_account[account]))
+            for account in accounts_in_batch
+        ), return_exceptions=True)
+        retry_in = {
+            account: WRITE_BUFFER_RETRY_SECONDS if isinstance(delay, BaseException) else delay
+            for account, delay in zip(accounts_in_batch, results)
+            if delay is not None
+        }
+        kept = []
+        for item in batch:
+            if item[0] in retry_in:
+                kept.append(item)
+            else:
+                self._untrack(*item)
+        if kept:
+            self._retain(kept, min(retry_in.values()))
+    
+    def _retain(self, items: List[Tuple["Account", int, Dict]], retry_in: float):
+        self._retained = items + self._retained
+        self.retained_count += len(items)
+        self._retry_at = time.monotonic() + retry_in
+        overflow = len(self._retained) - self.max_pending
+        if overflow > 0:
+            spill, self._retained = self._retained[:overflow], self._retained[overflow:]
+            self._spill(spill)
+    
+    def _spill(self, items: List[Tuple["Account", int, Dict]]):
+        try:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for account, user_id, entry in items:
+                    f.write(json.dumps({"account": account.name, "user_id": user_id, "entry": entry}, ensure_ascii=False) + "\n")
+        except Exception as e:
+            log_error(f"Write buffer: spill to {self.spill_path} failed, {len(items)} messages lost: {e}")
+            return
+        for item in items:
+            self._untrack(*item)
+        self.spilled_count += len(items)
+        logger.warning(f"⚠️ Write buffer: spilled {len(items)} messages to {self.spill_path}")
+    
+    def restore(self, hosted: List["Account"]) -> int:
+        # Replays a spill file left by an earlier run; entries for accounts that are no
+        # longer hosted stay in the renamed file
+        if not os.path.exists(self.spill_path):
+            return 0
+        by_name = {account.name: account for account in hosted}
+        restored, orphaned = [], []
+        replay_path = f"{self.spill_path}.replay"
+        os.replace(self.spill_path, replay_path)
+        with open(replay_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    doc = json.loads(line)
+                except ValueError:
+                    continue
+                account = by_name.get(doc.get("account"))
+                if account is None:
+                    orphaned.append(line)
+                    continue
+                item = (account, doc["user_id"], doc["entry"])
+                self._track(*item)
+                restored.append(item)
+        if orphaned:
+            with open(f"{self.spill_path}.orphaned", "a", encoding="utf-8") as f:
+                f.writelines(orphaned)
+        os.remove(replay_path)
+        self._retained = restored + self._retained
+        self._retry_at = time.monotonic()
+        return len(restored)
+    
+    async def _write_account(self, account: "Account", batch: List[Tuple[int, Dict]]) -> Optional[float]:
+        # Returns None once the messages are stored, otherwise seconds until the batch
+        # should be retried
+        grouped: Dict[int, List[Dict]] = {}
+        for user_id, entry in batch:
+            grouped.setdefault(user_id, []).append(entry)
+        
+        last_active = datetime.utcnow()
+        hour = last_active.replace(minute=0, second=0, microsecond=0)
+        activity = {
+            user_id: count
+            for user_id, count in (
+                (user_id, sum(1 for e in entries if e.get("sender") == "user"))
+                for user_id, entries in grouped.items()
+            )
+            if count
+        }
+        
+        attempt = 0
+        while True:
+            try:
+                if grouped:
+                    await db_call(account.storage.append_messages, grouped, last_active)
+                    grouped = {}
+                    self.flushed_count += len(batch)
+                if activity:
+                    await db_call(account.storage.add_activity, activity, hour)
+                    activity = {}
+                return None
+            except CircuitOpenError:
+                # Not an attempt: storage was never tried. Hold the batch without
+                # sleeping under the flush lock and come back when the breaker
+                # lets a probe through.
+                if not grouped:
+                    log_error(f"Write buffer: activity update skipped, {account.storage.name} circuit open")
+                    return None
+                return max(account.storage.breaker.retry_in, self.flush_interval)
+            except Exception as e:
+                attempt += 1
+                if attempt < WRITE_BUFFER_MAX_RETRIES:
+                    await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+                elif grouped:
+                    log_error(f"Write buffer: keeping {len(batch)} messages for retry: {e}")
+                    return WRITE_BUFFER_RETRY_SECONDS
+                else:
+                    # Messages are stored; only the activity counters for this batch are lost
+                    log_error(f"Write buffer: activity update failed: {e}")
+                    return None
+    
+    async def close(self):
+        self._closed = True
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        if self._retained:
+            retained, self._retained = self._retained, []
+            self._spill(retained)
+
+message_buffer = MessageWriteBuffer(
+    WRITE_BUFFER_MAX_PENDING,
+    WRITE_BUFFER_BATCH_SIZE,
+    WRITE_BUFFER_FLUSH_INTERVAL,
+    WRITE_BUFFER_SPILL_PATH
+)
+
+# ═══════════════════════════════════════════════════════════════
+#                      HISTORY CACHE
+# ═══════════════════════════════════════════════════════════════
+
+class HistoryCache:
+    # Entries are stored as (sender, text, time) tuples to keep per-user overhead small.
+    # Shared by every account, keyed by (account, user_id).
+    def __init__(self, depth: int, max_users: int, max_chars: int):
+        self.depth = depth
+        self.max_users = max_users
+        self.max_chars = max_chars
+        self._users: "OrderedDict[Tuple[str, int], deque]" = OrderedDict()
+        self._chars = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def __len__(self) -> int:
+        return len(self._users)
+    
+    def __contains__(self, user_id: int) -> bool:
+        return account_key(user_id) in self._users
+    
+    @staticmethod
+    def _pack(entry: Dict) -> Tuple[str, str, str]:
+        return (entry.get("sender", "user"), entry.get("text", ""), entry.get("time", ""))
+    
+    @staticmethod
+    def _unpack(item: Tuple[str, str, str]) -> Dict:
+        return {"sender": item[0], "text": item[1], "time": item[2]}
+    
+    def get(self, user_id: int, limit: int) -> Optional[List[Dict]]:
+        key = account_key(user_id)
+        entries = self._users.get(key)
+        if entries is None or limit > self.depth:
+            self.misses += 1
+            return None
+        self._users.move_to_end(key)
+        self.hits += 1
+        return [self._unpack(item) for item in list(entries)[-limit:]]
+    
+    def put(self, user_id: int, messages: List[Dict]):
+        self.invalidate(user_id)
+        entries = deque((self._pack(m) for m in messages[-self.depth:]), maxlen=self.depth)
+        self._users[account_key(user_id)] = entries
+        self._chars += sum(len(item[1]) for item in entries)
+        self._evict()
+    
+    def append(self, user_id: int, entry: Dict):
+        key = account_key(user_id)
+        entries = self._users.get(key)
+        if entries is None:
+            return
+        if len(entries) == entries.maxlen:
+            self._chars -= len(entries[0][1])
+        item = self._pack(entry)
+        entries.append(item)
+        self._chars += len(item[1])
+        self._users.move_to_end(key)
+        self._evict()
+    
+    def invalidate(self, user_id: int):
+        entries = self._users.pop(account_key(user_id), None)
+        if entries is not None:
+            self._chars -= sum(len(item[1]) for item in entries)
+    
+    def clear(self):
+        name = current_account().name
+        for key in [key for key in self._users if key[0] == name]:
+            self._chars -= sum(len(item[1]) for item in self._users.pop(key))
+    
+    def _evict(self):
+        while self._users and (len(self._users) > self.max_users or self._chars > self.max_chars):
+            _, entries = self._users.popitem(last=False)
+            self._chars -= sum(len(item[1]) for item in entries)
+
+history_cache = HistoryCache(HISTORY_CACHE_DEPTH, HISTORY_CACHE_MAX_USERS, HISTORY_CACHE_MAX_CHARS)
+
+# ═══════════════════════════════════════════════════════════════
+#                      PYROGRAM CLIENT
+# ═══════════════════════════════════════════════════════════════
+
+# One Client per hosted account (Account.client); this resolves to the current one
+app = AccountLocal("client")
+
+# ═══════════════════════════════════════════════════════════════
+#                      DECORATORS
+# ═══════════════════════════════════════════════════════════════
+
+def rate_limit(seconds: int = COMMAND_COOLDOWN_SECONDS):
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(client: Client, message: Message):
+            user_id = message.from_user.id if message.from_user else 0
+            now = time.monotonic()
+            
+            record = bot_state.users.get(user_id)
+            if record.last_command and now - record.last_command < seconds:
+                return
+            
+            record.last_command = now
+            COMMANDS_EXECUTED.inc(account=current_account().name)
+            return await func(client, message)
+        return wrapper
+    return decorator
+
+def owner_only(func):
+    @wraps(func)
+    async def wrapper(client: Client, message: Message):
+        user_id = message.from_user.id if message.from_user else 0
+        if not is_owner(user_id):
+            return
+        return await func(client, message)
+    return wrapper
+
+# ═══════════════════════════════════════════════════════════════
+#                      OUTBOUND SCHEDULER
+# ═══════════════════════════════════════════════════════════════
+
+class OutboundJob:
+    __slots__ = ("priority", "chat_id", "factory", "future", "retries", "enqueued_at", "is_action")
+    
+    def __init__(self, priority: int, chat_id: int, factory: Callable, future: asyncio.Future, is_action: bool):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.factory = factory
+        self.future = future
+        self.retries = 0
+        self.enqueued_at = time.monotonic()
+        self.is_action = is_action
+
+class OutboundScheduler:
+    # Every Telegram send goes through here: a global token bucket, per-chat pacing,
+    # priorities, and one account-wide FloodWait pause instead of one per handler
+    def __init__(self, rate: float, burst: int, chat_interval: float, workers: int, account: str = ""):
+        self.account = account
+        self.rate = rate
+        self.burst = burst
+        self.chat_interval = chat_interval
+        self.workers = workers
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._seq = itertools.count()
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._chat_next: Dict[int, float] = {}
+        self._chat_prune_at = OUTBOUND_CHAT_PRUNE_SIZE
+        self._pending_actions: set = set()
+        self._flood_until = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.flood_waits = 0
+        self.wait_avg = 0.0
+        self.wait_max = 0.0
+    
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+    
+    @property
+    def flood_remaining(self) -> float:
+        return max(0.0, self._flood_until - time.monotonic())
+    
+    def start(self):
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        self._tasks = [t for t in self._tasks if not t.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._worker()))
+    
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    def _enqueue(self, job: OutboundJob):
+        self._queue.put_nowait((job.priority, next(self._seq), job))
+    
+    async def send(self, chat_id: int, factory: Callable, priority: int = PRIORITY_REPLY) -> Any:
+        self.start()
+        if priority >= PRIORITY_ACTION and self.depth >= OUTBOUND_MAX_QUEUE:
+            self.dropped += 1
+            raise RuntimeError("outbound queue full")
+        job = OutboundJob(priority, chat_id, factory, asyncio.get_running_loop().create_future(), False)
+        self._enqueue(job)
+        return await job.future
+    
+    def send_action(self, chat_id: int, factory: Callable):
+        self.start()
+        if (chat_id in self._pending_actions or self.depth >= OUTBOUND_ACTION_DROP_DEPTH
+                or self.flood_remaining > 0):
+            self.dropped += 1
+            return
+        self._pending_actions.add(chat_id)
+        job = OutboundJob(PRIORITY_ACTION, chat_id, factory, asyncio.get_running_loop().create_future(), True)
+        job.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._enqueue(job)
+    
+    async def _take_token(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+            self._refilled_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+    
+    def _finish(self, job: OutboundJob):
+        if job.is_action:
+            self._pending_actions.discard(job.chat_id)
+    
+    def _pace_chat(self, chat_id: int):
+        now = time.monotonic()
+        self._chat_next[chat_id] = now + self.chat_interval
+        if len(self._chat_next) >= self._chat_prune_at:
+            # A slot in the past paces nothing, so expired chats can go; the next
+            # sweep waits until the map has doubled again, keeping this amortized O(1)
+            self._chat_next = {cid: at for cid, at in self._chat_next.items() if at > now}
+            self._chat_prune_at = max(OUTBOUND_CHAT_PRUNE_SIZE, 2 * len(self._chat_next))
+    
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, job = await self._queue.get()
+            if job.future.done():
+                self._finish(job)
+                continue
+            
+            if job.is_action and self.flood_remaining > 0:
+                self.dropped += 1
+                self._finish(job)
+                job.future.set_result(False)
+                continue
+            
+            wait = self.flood_remaining
+            if wait > 0:
+                await asyncio.sleep(wait)
+            
+            if not job.is_action:
+                ready = self._chat_next.get(job.chat_id, 0.0) - time.monotonic()
+                if ready > 0:
+                    loop.call_later(ready, self._enqueue, job)
+                    continue
+            
+            await self._take_token()
+            if not job.is_action:
+                self._pace_chat(job.chat_id)
+            
+            if job.retries == 0:
+                waited = time.monotonic() - job.enqueued_at
+                self.wait_avg += 0.1 * (waited - self.wait_avg)
+                self.wait_max = max(self.wait_max, waited)
+                SEND_WAIT_SECONDS.observe(waited, account=self.account, priority=job.priority)
+            
+            try:
+                with SEND_SECONDS.time(account=self.account, priority=job.priority):
+                    result = await job.factory()
+                self.sent += 1
+                self._finish(job)
+                if not job.future.done():
+                    job.future.set_result(result)
+            except FloodWait as e:
+                self.flood_waits += 1
+                self._flood_until = max(self._flood_until, time.monotonic() + e.value)
+                if (not job.is_action and job.retries < FLOOD_WAIT_MAX_RETRIES
+                        and e.value < OUTBOUND_MAX_FLOOD_RETRY_WAIT):
+                    job.retries += 1
+                    self._enqueue(job)
+                else:
+                    self.failed += 1
+                    self._finish(job)
+                    if not job.future.done():
+                        job.future.set_exception(e)
+            except Exception as e:
+                self.failed += 1
+                self._finish(job)
+                if not job.future.done():
+                    job.future.set_exception(e)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": self.depth,
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "flood_waits": self.flood_waits,
+            "flood_remaining": round(self.flood_remaining, 1),
+            "wait_avg_ms": round(self.wait_avg * 1000, 1),
+            "wait_max_ms": round(self.wait_max * 1000, 1)
+        }
+
+outbound = AccountLocal("outbound")
+
+# ═══════════════════════════════════════════════════════════════
+#                      HELPER FUNCTIONS (ALL FIXED!)
+# ═══════════════════════════════════════════════════════════════
+
+def get_current_time() -> datetime:
+    return datetime.now(TIMEZONE)
+
+def get_config(key: str, default: Any = None) -> Any:
+    return config_cache.get(key, default)
+
+async def set_config(key: str, value: Any) -> bool:
+    try:
+        await db_call(storage.set_config, key, value)
+    except Exception:
+        return False
+    config_cache.put(key, value)
+    return True
+
+def log_error(error: str):
+    timestamp = get_current_time().strftime('%H:%M:%S')
+    bot_state.error_logs.append(f"[{timestamp}] {error}")
+    logger.error(error)
+    ERRORS.inc(account=current_account().name)
+
+def is_bot_active() -> bool:
+    return get_config("bot_active", False)
+
+def get_owner_id() -> int:
+    owner = get_config("owner_id")
+    return owner if owner else current_account().owner_id
+
+def is_owner(user_id: int) -> bool:
+    owner = get_owner_id()
+    return user_id == owner and owner != 0
+
+def sent_time(message: Message) -> datetime:
+    # Pyrogram gives message.date as naive local time
+    return message.date.astimezone(TIMEZONE) if message.date else get_current_time()
+
+async def save_message(user_id: int, text: str, sender: str = "user", when: Optional[datetime] = None) -> bool:
+    entry = {
+        "text": text[:1000] if text else "[Empty]",
+        "sender": sender,
+        "time": (when or get_current_time()).isoformat(timespec="milliseconds")
+    }
+    history_cache.append(user_id, entry)
+    await message_buffer.put(user_id, entry)
+    return True
+
+def merge_pending(messages: List[Dict], pending: List[Dict]) -> List[Dict]:
+    if not pending:
+        return messages
+    tail = messages[-len(pending):]
+    return messages + [m for m in pending if m not in tail]
+
+async def get_conversation_history(user_id: int, limit: int = 10) -> List[Dict]:
+    cached = history_cache.get(user_id, limit)
+    if cached is not None:
+        return cached
+    try:
+        # Snapshot pending appends around the read so a racing flush is neither lost nor doubled
+        pending = message_buffer.pending(user_id)
+        epoch = summarizer.epoch
+        data = await db_call(storage.fetch_history, user_id, max(limit, HISTORY_CACHE_DEPTH))
+        for entry in message_buffer.pending(user_id):
+            if entry not in pending:
+                pending.append(entry)
+        messages = merge_pending(data["messages"], pending)
+        history_cache.put(user_id, messages)
+        summarizer.seed(user_id, data["summary"], epoch)
+        return messages[-limit:]
+    except Exception:
+        return []
+
+async def prewarm_history_cache(count: int = HISTORY_PREWARM_USERS) -> int:
+    try:
+        docs = await db_call(storage.recent_histories, count, HISTORY_CACHE_DEPTH)
+    except Exception as e:
+        log_error(f"History prewarm: {e}")
+        return 0
+    warmed = 0
+    for doc in reversed(docs):
+        user_id = doc.get("user_id")
+        if user_id is None or user_id in history_cache:
+            continue
+        messages = merge_pending(doc.get("messages", []), message_buffer.pending(user_id))
+        history_cache.put(user_id, messages)
+        summarizer.seed(user_id, doc.get("summary"), summarizer.epoch)
+        warmed += 1
+    return warmed
+
+def _load_gemini_keys() -> List[str]:
+    try:
+        keys = shared_storage().get_gemini_keys()
+        if keys:
+            return keys
+    except Exception:
+        pass
+    
+    keys = []
+    for i in range(1, 15):
+        key = os.getenv(f"GEMINI_KEY_{i}")
+        if key and key.strip():
+            keys.append(key.strip())
+    
+    if keys:
+        try:
+            shared_storage().set_gemini_keys(keys)
+        except Exception:
+            pass
+    
+    return keys
+
+async def get_all_gemini_keys() -> List[str]:
+    return await key_scheduler.get_keys()
 
-def remove_gemini_key(index: int) -> bool:
-    if db is None:  # ✅ FIXED
+async def add_gemini_key(key: str) -> bool:
+    try:
+        await db_call(shared_storage().add_gemini_key, key)
+        await key_scheduler.reload()
+        return True
+    except Exception:
         return False
+
+async def remove_gemini_key(index: int) -> bool:
     try:
-        keys = get_all_gemini_keys()
+        keys = await get_all_gemini_keys()
         if 0 <= index < len(keys):
             keys.pop(index)
-            db.gemini_keys.update_one(
-                {"type": "keys"},
-                {"$set": {"keys": keys, "current_index": 0}},
-                upsert=True
-            )
+            await db_call(shared_storage().set_gemini_keys, keys)
+            await key_scheduler.reload()
+            gemini_models.prune(keys)
             return True
         return False
-    except:
+    except Exception:
         return False
 
-def get_next_gemini_key() -> Optional[str]:
-    keys = get_all_gemini_keys()
-    if not keys:
-        return None
-    
-    idx = bot_state.gemini_key_index
-    if idx >= len(keys):
-        idx = 0
-    
-    key = keys[idx]
-    bot_state.gemini_key_index = (idx + 1) % len(keys)
-    return key
+async def clear_gemini_keys() -> bool:
+    try:
+        await db_call(shared_storage().clear_gemini_keys)
+        await key_scheduler.reload()
+        gemini_models.clear()
+        return True
+    except Exception:
+        return False
 
-def get_vip_info(user_id: int) -> Optional[Dict]:
-    if db is None:  # ✅ FIXED
-        return None
+async def get_next_gemini_key(exclude: Optional[set] = None) -> Optional[str]:
+    await key_scheduler.get_keys()
+    return key_scheduler.acquire(exclude)
+
+async def get_vip_info(user_id: int) -> Optional[Dict]:
     try:
-        return db.vips.find_one({"user_id": user_id})
-    except:
+        return await db_call(storage.get_vip, user_id)
+    except Exception:
         return None
 
-def add_vip(user_id: int, name: str) -> bool:
-    if db is None:  # ✅ FIXED
-        return False
+async def add_vip(user_id: int, name: str) -> bool:
     try:
-        db.vips.update_one(
-            {"user_id": user_id},
-            {"$set": {"user_id": user_id, "name": name}},
-            upsert=True
-        )
+        await db_call(storage.set_vip, user_id, name)
         return True
-    except:
+    except Exception:
         return False
 
-def remove_vip(user_id: int) -> bool:
-    if db is None:  # ✅ FIXED
-        return False
+async def remove_vip(user_id: int) -> bool:
     try:
-        result = db.vips.delete_one({"user_id": user_id})
-        return result.deleted_count > 0
-    except:
+        return await db_call(storage.delete_vip, user_id)
+    except Exception:
         return False
 
-def get_all_vips() -> List[Dict]:
-    if db is None:  # ✅ FIXED
-        return []
+async def get_all_vips() -> List[Dict]:
     try:
-        return list(db.vips.find())
-    except:
+        return await db_call(storage.list_vips)
+    except Exception:
         return []
 
-def set_vip_name(user_id: int, name: str) -> bool:
-    if db is None:  # ✅ FIXED
+async def set_vip_name(user_id: int, name: str) -> bool:
+    try:
+        await db_call(storage.set_vip, user_id, name)
+        return True
+    except Exception:
         return False
+
+async def count_users() -> int:
     try:
-        db.vips.update_one(
-            {"user_id": user_id},
-            {"$set": {"name": name}},
-            upsert=True
-        )
+        return await db_call(storage.count_users)
+    except Exception:
+        return 0
+
+async def count_vips() -> int:
+    try:
+        return await db_call(storage.count_vips)
+    except Exception:
+        return 0
+
+async def clear_user_messages(user_id: int) -> bool:
+    try:
+        await message_buffer.discard(user_id)
+        history_cache.invalidate(user_id)
+        summarizer.invalidate(user_id)
+        await db_call(storage.clear_user, user_id)
         return True
-    except:
+    except Exception:
         return False
 
+async def clear_all_messages() -> int:
+    try:
+        await message_buffer.discard()
+        history_cache.clear()
+        summarizer.clear()
+        return await db_call(storage.clear_all)
+    except Exception:
+        return 0
+
+async def get_activity_24h(top: int = ACTIVITY_SUMMARY_TOP) -> Dict[str, Any]:
+    empty = {"top": [], "total": 0, "users": 0}
+    try:
+        await message_buffer.flush()
+        cutoff = datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(hours=23)
+        return await db_call(storage.activity_summary, cutoff, top)
+    except Exception:
+        return empty
+
+async def get_vips_by_ids(user_ids: List[int]) -> Dict[int, Dict]:
+    if not user_ids:
+        return {}
+    try:
+        docs = await db_call(storage.get_vips, user_ids)
+        return {doc["user_id"]: doc for doc in docs}
+    except Exception:
+        return {}
+
 def get_log_group() -> Optional[int]:
     return get_config("log_group_id")
 
-async def send_log(text: str, retry: int = 0) -> bool:
-    if retry >= FLOOD_WAIT_MAX_RETRIES:
-        return False
+class LogSink:
+    # Buffers log lines and sends them to the log group as one combined message
+    # per interval; undeliverable batches are appended to a local spill file
+    _header = "📊 **LOG**\n\n"
+    _separator = "\n\n"
     
-    log_group = get_log_group()
-    if not log_group:
-        return False
+    def __init__(self, flush_interval: float, max_lines: int, spill_path: str):
+        self.flush_interval = flush_interval
+        self.max_lines = max_lines
+        self.spill_path = spill_path
+        self._lines: deque = deque()
+        self._chars = 0
+        self._wake: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self.sent_batches = 0
+        self.dropped = 0
+        self.spilled = 0
     
-    try:
-        if len(text) > MAX_MESSAGE_LENGTH - 100:
-            text = text[:MAX_MESSAGE_LENGTH - 100] + "..."
-        
-        await app.send_message(log_group, f"📊 **LOG**\n\n{text}", parse_mode=ParseMode.MARKDOWN)
-        return True
-    except FloodWait as e:
-        await asyncio.sleep(min(e.value, 60))
-        return await send_log(text, retry + 1)
-    except:
+    @property
+    def depth(self) -> int:
+        return len(self._lines)
+    
+    @property
+    def _limit(self) -> int:
+        return MAX_MESSAGE_LENGTH - len(self._header) - 100
+    
+    def start(self):
+        if self._wake is None:
+            self._wake = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    def add(self, text: str):
+        self.start()
+        if len(text) > LOG_LINE_MAX_CHARS:
+            text = text[:LOG_LINE_MAX_CHARS] + "..."
+        self._lines.append(text)
+        self._chars += len(text) + len(self._separator)
+        while len(self._lines) > self.max_lines:
+            self._chars -= len(self._lines.popleft()) + len(self._separator)
+            self.dropped += 1
+        if self._chars >= self._limit:
+            self._wake.set()
+    
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+    
+    def _take_chunk(self) -> str:
+        parts, size = [], 0
+        while self._lines:
+            line = self._lines[0]
+            cost = len(line) + len(self._separator)
+            if parts and size + cost > self._limit:
+                break
+            parts.append(self._lines.popleft())
+            self._chars -= cost
+            size += cost
+        return self._separator.join(parts)
+    
+    async def flush(self):
+        if self._flush_lock is None:
+            return
+        async with self._flush_lock:
+            log_group = get_log_group()
+            if not log_group:
+                self._lines.clear()
+                self._chars = 0
+                return
+            while self._lines:
+                chunk = self._take_chunk()
+                try:
+                    await outbound.send(
+                        log_group,
+                        lambda: app.send_message(log_group, f"{self._header}{chunk}", parse_mode=ParseMode.MARKDOWN),
+                        PRIORITY_LOG
+                    )
+                    self.sent_batches += 1
+                except Exception as e:
+                    logger.warning(f"⚠️ Log group unreachable, spilling to {self.spill_path}: {e}")
+                    rest = [chunk] + list(self._lines)
+                    self._lines.clear()
+                    self._chars = 0
+                    await asyncio.to_thread(self._spill, rest)
+                    return
+    
+    def _spill(self, chunks: List[str]):
+        try:
+            if os.path.exists(self.spill_path) and os.path.getsize(self.spill_path) > LOG_SPILL_MAX_BYTES:
+                os.replace(self.spill_path, f"{self.spill_path}.1")
+            stamp = get_current_time().strftime('%Y-%m-%d %H:%M:%S')
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for chunk in chunks:
+                    f.write(f"[{stamp}]\n{chunk}\n\n")
+            self.spilled += len(chunks)
+        except Exception as e:
+            logger.error(f"Log spill failed: {e}")
+    
+    async def close(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "buffered": self.depth,
+            "sent_batches": self.sent_batches,
+            "dropped": self.dropped,
+            "spilled": self.spilled
+        }
+
+log_sink = AccountLocal("log_sink")
+
+async def send_log(text: str) -> bool:
+    if not get_log_group():
         return False
+    log_sink.add(text)
+    return True
 
-def get_all_stickers() -> List[str]:
-    if db is None:  # ✅ FIXED
-        return []
+async def get_all_stickers() -> List[str]:
     try:
-        doc = db.stickers.find_one({"type": "stickers"})
-        return doc.get("file_ids", []) if doc else []
-    except:
+        return await db_call(storage.get_stickers)
+    except Exception:
         return []
 
-def add_sticker(file_id: str) -> bool:
-    if db is None:  # ✅ FIXED
-        return False
+async def add_sticker(file_id: str) -> bool:
     try:
-        db.stickers.update_one(
-            {"type": "stickers"},
-            {"$addToSet": {"file_ids": file_id}},
-            upsert=True
-        )
+        await db_call(storage.add_sticker, file_id)
         return True
-    except:
+    except Exception:
         return False
 
-def remove_sticker(file_id: str) -> bool:
-    if db is None:  # ✅ FIXED
-        return False
+async def remove_sticker(file_id: str) -> bool:
     try:
-        db.stickers.update_one(
-            {"type": "stickers"},
-            {"$pull": {"file_ids": file_id}}
-        )
+        await db_call(storage.remove_sticker, file_id)
         return True
-    except:
+    except Exception:
         return False
 
-def clear_all_stickers() -> bool:
-    if db is None:  # ✅ FIXED
-        return False
+async def clear_all_stickers() -> bool:
     try:
-        db.stickers.delete_one({"type": "stickers"})
+        await db_call(storage.clear_stickers)
         return True
-    except:
+    except Exception:
         return False
 
 def should_send_sticker() -> bool:
@@ -591,144 +3101,970 @@ def get_delay_range() -> Tuple[int, int]:
 def count_words(text: str) -> int:
     return len(text.split()) if text else 0
 
+_NORMALIZE_STRIP_RE = re.compile(r"[^\w\s]", re.UNICODE)
+_NORMALIZE_REPEAT_RE = re.compile(r"(\w)\1+", re.UNICODE)
+_SIMHASH_MASK = (1 << 64) - 1
+
+def normalize_text(text: str) -> str:
+    text = _NORMALIZE_STRIP_RE.sub(" ", text.lower())
+    text = _NORMALIZE_REPEAT_RE.sub(r"\1", text)
+    return " ".join(text.split())
+
+# Byte value -> its 8 bits spread into 16-bit lanes, so one integer addition counts
+# all 8 bit positions at once (up to 65535 trigrams without overflowing a lane)
+_SIMHASH_LANE_BITS = 16
+_SIMHASH_LANE_MASK = (1 << _SIMHASH_LANE_BITS) - 1
+_SIMHASH_SPREAD = [
+    sum(1 << (bit * _SIMHASH_LANE_BITS) for bit in range(8) if byte >> bit & 1)
+    for byte in range(256)
+]
+
+def simhash(text: str) -> int:
+    padded = f" {text[:SPAM_SIMHASH_MAX_CHARS]} "
+    count = len(padded) - 2
+    if count <= 0:
+        return 0
+    packed = b"".join(
+        (hash(padded[i:i + 3]) & _SIMHASH_MASK).to_bytes(8, "little") for i in range(count)
+    )
+    fingerprint = 0
+    for byte in range(8):
+        lanes = sum(map(_SIMHASH_SPREAD.__getitem__, packed[byte::8]))
+        for bit in range(8):
+            # Bit set in more than half of the trigram hashes
+            if 2 * (lanes >> (bit * _SIMHASH_LANE_BITS) & _SIMHASH_LANE_MASK) > count:
+                fingerprint |= 1 << (byte * 8 + bit)
+    return fingerprint
+
+class SpamEngine:
+    # Per message: one normalized fingerprint, comparison against the last
+    # SPAM_FINGERPRINT_WINDOW fingerprints, and fixed-size rolling rate counters
+    def __init__(self):
+        self._global_rate = RollingCounter(SPAM_TIME_WINDOW, SPAM_RATE_BUCKETS)
+        self.rejected = 0
+    
+    def check(self, user_id: int, text: str) -> bool:
+        now = time.monotonic()
+        record = bot_state.users.get(user_id)
+        if record.rate is None:
+            record.rate = RollingCounter(SPAM_TIME_WINDOW, SPAM_RATE_BUCKETS)
+        
+        under_pressure = self._global_rate.add(now) > SPAM_GLOBAL_RATE_LIMIT
+        user_limit = SPAM_USER_RATE_LIMIT // 2 if under_pressure else SPAM_USER_RATE_LIMIT
+        dup_threshold = max(2, SPAM_MESSAGE_THRESHOLD - 1) if under_pressure else SPAM_MESSAGE_THRESHOLD
+        
+        spam = record.rate.add(now) > user_limit
+        
+        normalized = normalize_text(text) if text else ""
+        if normalized:
+            exact = hash(normalized)
+            fingerprint = simhash(normalized)
+            if record.spam is None:
+                record.spam = deque(maxlen=SPAM_FINGERPRINT_WINDOW)
+            similar = 1
+            for seen_at, seen_exact, seen_fp in record.spam:
+                if now - seen_at >= SPAM_TIME_WINDOW:
+                    continue
+                if seen_exact == exact or bin(seen_fp ^ fingerprint).count("1") <= SPAM_SIMHASH_DISTANCE:
+                    similar += 1
+            record.spam.append((now, exact, fingerprint))
+            spam = spam or similar >= dup_threshold
+        
+        if spam:
+            self.rejected += 1
+        return spam
+    
+    def should_warn(self, user_id: int) -> bool:
+        record = bot_state.users.get(user_id)
+        now = time.monotonic()
+        if record.spam_warned and now - record.spam_warned < SPAM_TIME_WINDOW:
+            return False
+        record.spam_warned = now
+        return True
+
+spam_engine = SpamEngine()
+
 def is_spam(user_id: int, text: str) -> bool:
+    try:
+        return spam_engine.check(user_id, text)
+    except Exception:
+        return False
+
+def reply_cooldown_remaining(user_id: int) -> float:
+    record = bot_state.users.peek(user_id)
+    if record is None or not record.last_reply:
+        return 0.0
+    return max(0.0, REPLY_COOLDOWN_SECONDS - (time.monotonic() - record.last_reply))
+
+async def update_reply_time(user_id: int):
+    bot_state.users.get(user_id).last_reply = time.monotonic()
+
+def get_user_name(message: Message) -> str:
+    try:
+        return message.from_user.first_name or f"User{message.from_user.id}"
+    except:
+        return "Unknown"
+
+def get_user_id_safe(message: Message) -> Optional[int]:
+    try:
+        return message.from_user.id if message.from_user else None
+    except:
+        return None
+
+def escape_markdown(text: str) -> str:
     if not text:
+        return ""
+    for char in ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']:
+        text = text.replace(char, f'\\{char}')
+    return text
+
+async def safe_edit(message: Message, text: str, parse_mode: ParseMode = None) -> bool:
+    try:
+        await outbound.send(message.chat.id, lambda: message.edit(text, parse_mode=parse_mode), PRIORITY_COMMAND)
+        return True
+    except MessageNotModified:
+        return True
+    except Exception:
         return False
+
+async def safe_reply(message: Message, text: str, parse_mode: ParseMode = None) -> bool:
     try:
-        now = get_current_time()
-        text_hash = hashlib.md5(text.encode()).hexdigest()
-        
-        bot_state.spam_tracker[user_id].append({"hash": text_hash, "time": now})
-        
-        recent = []
-        for m in bot_state.spam_tracker[user_id]:
+        await outbound.send(message.chat.id, lambda: message.reply(text, parse_mode=parse_mode), PRIORITY_REPLY)
+        return True
+    except Exception:
+        return False
+
+async def safe_reply_sticker(message: Message, file_id: str) -> bool:
+    try:
+        await outbound.send(message.chat.id, lambda: message.reply_sticker(file_id), PRIORITY_REPLY)
+        return True
+    except Exception:
+        return False
+
+async def safe_delete(message: Message) -> bool:
+    try:
+        await outbound.send(message.chat.id, message.delete, PRIORITY_COMMAND)
+        return True
+    except Exception:
+        return False
+
+# ═══════════════════════════════════════════════════════════════
+#                      GEMINI AI
+# ═══════════════════════════════════════════════════════════════
+
+ARYAN_SYSTEM_INSTRUCTION = """Tu Aryan hai (@MaiHuAryan). Telegram pe replies de raha hai.
+
+PERSONALITY:
+- Serious aur sarcastic ho
+- Hinglish mein naturally baat kar
+- Emojis BILKUL NAHI use kar
+- Short-medium replies de
+- Tu mostly serious rehta hai
+
+REPLY STYLE:
+- "kuch nhi, tu bta.."
+- "hn?"
+- "hn bhai bol bol"
+- "acha"
+- "hmm"
+- "dekh lenge"
+- "thik hai"
+- "soja" (for spam/bakwas)
+
+SPECIAL RULES:
+- Bot question → "Kya farak padta hai, bol kaam kya hai"
+- Personal info → "Ye sab Aryan se seedha puch lena"
+- Money/earning → "Aryan se baat kar iske baare mein"
+
+Hamesha sirf Aryan ka reply likh (short, Hinglish, NO quotes)."""
+
+SUMMARY_SYSTEM_INSTRUCTION = """You keep short running notes about one Telegram chat between a user and Aryan.
+Write plain third-person notes: who the user is, what they want, facts they shared, open threads.
+No greetings, no quotes, no markdown. Hinglish or English is fine."""
+
+SYSTEM_INSTRUCTIONS = {
+    "reply": ARYAN_SYSTEM_INSTRUCTION,
+    "summary": SUMMARY_SYSTEM_INSTRUCTION
+}
+
+SUMMARY_PROMPT = """Current notes:
+{summary}
+
+New messages:
+{turns}
+
+Rewrite the notes to include the new messages. Max {max_words} words."""
+
+_gemini_sdk: Optional[SimpleNamespace] = None
+_gemini_sdk_lock = threading.Lock()
+
+def gemini_sdk() -> SimpleNamespace:
+    # google.genai drags in httpx and pydantic; import it once, off the startup path
+    global _gemini_sdk
+    with _gemini_sdk_lock:
+        if _gemini_sdk is None:
+            from google import genai
+            from google.genai import types
+            _gemini_sdk = SimpleNamespace(
+                genai=genai,
+                types=types,
+                safety_settings=[
+                    types.SafetySetting(category=category, threshold=types.HarmBlockThreshold.BLOCK_NONE)
+                    for category in (
+                        types.HarmCategory.HARM_CATEGORY_HARASSMENT,
+                        types.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+                        types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+                        types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+                    )
+                ]
+            )
+        return _gemini_sdk
+
+class GeminiModel:
+    # GEMINI_MODEL behind one key's client, with the system instruction of one prompt kind
+    def __init__(self, client: Any, kind: str):
+        self._client = client
+        self._kind = kind
+    
+    async def generate_content_async(
+        self,
+        prompt: str,
+        generation_config: Optional[Dict] = None,
+        request_options: Optional[Dict] = None
+    ) -> Any:
+        sdk = gemini_sdk()
+        timeout = (request_options or {}).get("timeout")
+        config = sdk.types.GenerateContentConfig(
+            system_instruction=SYSTEM_INSTRUCTIONS[self._kind],
+            safety_settings=sdk.safety_settings,
+            http_options=sdk.types.HttpOptions(timeout=int(timeout * 1000)) if timeout else None,
+            # No tools are declared; this also silences the SDK's per-call AFC log line
+            automatic_function_calling=sdk.types.AutomaticFunctionCallingConfig(disable=True),
+            **(generation_config or {})
+        )
+        return await self._client.aio.models.generate_content(model=GEMINI_MODEL, contents=prompt, config=config)
+
+class GeminiModelPool:
+    # One API client per key, so calls never share credentials through global state
+    def __init__(self):
+        self._clients: Dict[str, Any] = {}
+        self._models: Dict[Tuple[str, str], Any] = {}
+    
+    def _build(self, key: str, kind: str) -> Any:
+        client = self._clients.get(key)
+        if client is None:
+            client = gemini_sdk().genai.Client(api_key=key)
+            self._clients[key] = client
+        return GeminiModel(client, kind)
+    
+    def get(self, key: str, kind: str = "reply") -> Any:
+        model = self._models.get((key, kind))
+        if model is None:
+            model = self._build(key, kind)
+            self._models[(key, kind)] = model
+        return model
+    
+    def warm(self, keys: List[str]):
+        for key in keys:
+            try:
+                self.get(key)
+            except Exception as e:
+                log_error(f"Gemini model init: {e}")
+    
+    def prune(self, keys: List[str]):
+        for key, kind in list(self._models):
+            if key not in keys:
+                del self._models[(key, kind)]
+        for key in list(self._clients):
+            if key not in keys:
+                del self._clients[key]
+    
+    def clear(self):
+        self._models.clear()
+        self._clients.clear()
+
+gemini_models = GeminiModelPool()
+gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+gemini_breaker = CircuitBreaker("gemini")
+
+def key_fingerprint(key: str) -> str:
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+def mask_key(key: str) -> str:
+    return f"{key[:4]}…{key[-4:]}" if len(key) > 8 else "…"
+
+class KeyStats:
+    __slots__ = (
+        "successes", "failures", "quota_errors", "consecutive_failures",
+        "latency_ewma", "cooldown_until", "cooldown_level", "in_flight"
+    )
+    
+    def __init__(self, doc: Optional[Dict] = None):
+        doc = doc or {}
+        self.successes = doc.get("successes", 0)
+        self.failures = doc.get("failures", 0)
+        self.quota_errors = doc.get("quota_errors", 0)
+        self.consecutive_failures = 0
+        self.latency_ewma: Optional[float] = doc.get("latency_ewma")
+        self.cooldown_until = doc.get("cooldown_until", 0.0)
+        self.cooldown_level = doc.get("cooldown_level", 0)
+        self.in_flight = 0
+    
+    @property
+    def success_rate(self) -> float:
+        total = self.successes + self.failures
+        return self.successes / total if total else 1.0
+    
+    def to_doc(self) -> Dict:
+        return {
+            "successes": self.successes,
+            "failures": self.failures,
+            "quota_errors": self.quota_errors,
+            "latency_ewma": self.latency_ewma,
+            "cooldown_until": self.cooldown_until,
+            "cooldown_level": self.cooldown_level
+        }
+
+class GeminiKeyScheduler:
+    # Picks the fastest healthy key; quota-exhausted keys sit out an exponential cooldown
+    def __init__(self):
+        self._keys: List[str] = []
+        self._stats: Dict[str, KeyStats] = {}
+        self._loaded = False
+        self._load_lock: Optional[asyncio.Lock] = None
+        self._dirty = False
+        self._task: Optional[asyncio.Task] = None
+    
+    def _load(self) -> Tuple[List[str], Dict[str, Dict]]:
+        keys = _load_gemini_keys()
+        docs = {}
+        if keys:
             try:
-                msg_time = m["time"]
-                if isinstance(msg_time, str):
-                    msg_time = datetime.fromisoformat(msg_time)
-                if msg_time.tzinfo is None:
-                    msg_time = TIMEZONE.localize(msg_time)
-                if (now - msg_time).total_seconds() < SPAM_TIME_WINDOW:
-                    recent.append(m)
-            except:
+                docs = shared_storage().load_key_stats([key_fingerprint(k) for k in keys])
+            except Exception as e:
+                logger.warning(f"⚠️ Key stats load failed: {e}")
+        return keys, docs
+    
+    async def reload(self):
+        if self._load_lock is None:
+            self._load_lock = asyncio.Lock()
+        async with self._load_lock:
+            keys, docs = await db_call(self._load)
+            stats = {}
+            for key in keys:
+                stats[key] = self._stats.get(key) or KeyStats(docs.get(key_fingerprint(key)))
+            self._keys = keys
+            self._stats = stats
+            self._loaded = True
+    
+    async def get_keys(self) -> List[str]:
+        if not self._loaded:
+            await self.reload()
+        return list(self._keys)
+    
+    def acquire(self, exclude: Optional[set] = None) -> Optional[str]:
+        now = time.time()
+        best, best_score = None, None
+        for key in self._keys:
+            if exclude and key in exclude:
                 continue
+            stats = self._stats[key]
+            if stats.cooldown_until > now:
+                continue
+            if stats.latency_ewma is None:
+                score = -1.0 + stats.in_flight
+            else:
+                score = stats.latency_ewma * (1 + stats.in_flight) / max(stats.success_rate, 0.05)
+            if best_score is None or score < best_score:
+                best, best_score = key, score
+        if best is not None:
+            self._stats[best].in_flight += 1
+        return best
+    
+    def release(self, key: str):
+        stats = self._stats.get(key)
+        if stats and stats.in_flight > 0:
+            stats.in_flight -= 1
+    
+    def report_success(self, key: str, latency: float):
+        stats = self._stats.get(key)
+        if not stats:
+            return
+        stats.successes += 1
+        stats.consecutive_failures = 0
+        stats.cooldown_level = 0
+        if stats.latency_ewma is None:
+            stats.latency_ewma = latency
+        else:
+            stats.latency_ewma += KEY_LATENCY_EWMA_ALPHA * (latency - stats.latency_ewma)
+        self._dirty = True
+    
+    def report_failure(self, key: str, quota: bool = False):
+        stats = self._stats.get(key)
+        if not stats:
+            return
+        stats.failures += 1
+        stats.consecutive_failures += 1
+        if quota:
+            stats.quota_errors += 1
+        if quota or stats.consecutive_failures >= KEY_FAILURE_COOLDOWN_THRESHOLD:
+            cooldown = min(KEY_COOLDOWN_BASE_SECONDS * 2 ** stats.cooldown_level, KEY_COOLDOWN_MAX_SECONDS)
+            stats.cooldown_until = time.time() + cooldown
+            stats.cooldown_level += 1
+            stats.consecutive_failures = 0
+        self._dirty = True
+    
+    def healthy_count(self) -> int:
+        now = time.time()
+        return sum(1 for key in self._keys if self._stats[key].cooldown_until <= now)
+    
+    def describe(self) -> List[str]:
+        now = time.time()
+        lines = []
+        for i, key in enumerate(self._keys, 1):
+            stats = self._stats[key]
+            wait = stats.cooldown_until - now
+            state = f"⏸ {int(wait)}s" if wait > 0 else "✅"
+            latency = f"{stats.latency_ewma * 1000:.0f}ms" if stats.latency_ewma is not None else "—"
+            lines.append(
+                f"{i}. `{mask_key(key)}` {state} ok:{stats.successes} "
+                f"fail:{stats.failures} 429:{stats.quota_errors} {latency}"
+            )
+        return lines
+    
+    async def save(self):
+        if not self._dirty or not self._keys:
+            return
+        self._dirty = False
+        docs = [(key_fingerprint(key), self._stats[key].to_doc()) for key in self._keys]
+        try:
+            await db_call(shared_storage().save_key_stats, docs)
+        except Exception as e:
+            self._dirty = True
+            logger.warning(f"⚠️ Key stats save failed: {e}")
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(KEY_STATS_SAVE_INTERVAL)
+            await self.save()
+    
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+        await self.save()
+
+key_scheduler = GeminiKeyScheduler()
+
+class AdmissionController:
+    # Bounded priority queue in front of AI generation. At most `slots` generations run
+    # at once; waiters are served VIP first, then known users, then first-time users.
+    # A request is shed (answered locally) when its estimated wait is over its class
+    # limit, when it has waited that long, or when a more important one needs its place.
+    def __init__(self, slots: int, max_queue: int, max_wait: Dict[int, Optional[float]]):
+        self.slots = slots
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self.service_ewma = ADMISSION_INITIAL_SERVICE_SECONDS
+        self.admitted = 0
+        self.shed = 0
+        self.wait_max = 0.0
+    
+    @property
+    def depth(self) -> int:
+        return len(self._waiters)
+    
+    def depth_by_priority(self) -> Dict[int, int]:
+        counts = dict.fromkeys(AI_PRIORITY_NAMES, 0)
+        for priority, _, _ in self._waiters:
+            counts[priority] += 1
+        return counts
+    
+    def estimated_wait(self, priority: int) -> float:
+        if self.in_flight < self.slots and not self._waiters:
+            return 0.0
+        ahead = sum(1 for p, _, _ in self._waiters if p <= priority)
+        return (ahead + 1) * self.service_ewma / self.slots
+    
+    def _shed(self, priority: int, reason: str):
+        self.shed += 1
+        ADMISSION_SHED.inc(priority=AI_PRIORITY_NAMES[priority], reason=reason)
+    
+    def _grant(self):
+        while self._waiters and self.in_flight < self.slots:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self.in_flight += 1
+                future.set_result(True)
+    
+    def _remove(self, entry: Tuple[int, int, asyncio.Future]):
+        try:
+            self._waiters.remove(entry)
+        except ValueError:
+            return
+        heapq.heapify(self._waiters)
+    
+    async def _acquire(self, priority: int) -> bool:
+        if self.in_flight < self.slots and not self._waiters:
+            self.in_flight += 1
+            return True
+        limit = self.max_wait.get(priority)
+        if limit is not None and self.estimated_wait(priority) > limit:
+            self._shed(priority, "wait")
+            return False
+        if len(self._waiters) >= self.max_queue:
+            victim = max(self._waiters)
+            if victim[0] <= priority:
+                self._shed(priority, "full")
+                return False
+            self._remove(victim)
+            victim[2].set_result(False)
+            self._shed(victim[0], "evicted")
         
-        if len(recent) >= SPAM_MESSAGE_THRESHOLD:
-            if len(set(m["hash"] for m in recent)) == 1:
-                return True
-        return False
-    except:
-        return False
-
-async def check_reply_cooldown(user_id: int) -> bool:
-    last = bot_state.last_reply_time.get(user_id)
-    if last:
-        if (get_current_time() - last).total_seconds() < REPLY_COOLDOWN_SECONDS:
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._seq), future)
+        heapq.heappush(self._waiters, entry)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), limit)
+        except asyncio.TimeoutError:
+            if future.done():
+                return future.result()
+            future.cancel()
+            self._shed(priority, "timeout")
             return False
-    return True
+        except asyncio.CancelledError:
+            # Granted just as the caller went away: hand the slot on
+            if future.done() and future.result():
+                self.release()
+            future.cancel()
+            raise
+        finally:
+            self._remove(entry)
+    
+    def release(self):
+        self.in_flight -= 1
+        self._grant()
+    
+    @asynccontextmanager
+    async def admit(self, priority: int):
+        # Yields whether the caller may generate; a False caller must answer locally
+        started = time.monotonic()
+        admitted = await self._acquire(priority)
+        waited = time.monotonic() - started
+        ADMISSION_WAIT_SECONDS.observe(waited, priority=AI_PRIORITY_NAMES[priority])
+        if not admitted:
+            yield False
+            return
+        self.admitted += 1
+        self.wait_max = max(self.wait_max, waited)
+        started = time.monotonic()
+        try:
+            yield True
+        finally:
+            service = time.monotonic() - started
+            self.service_ewma += ADMISSION_SERVICE_EWMA_ALPHA * (service - self.service_ewma)
+            self.release()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "slots": self.slots,
+            "in_flight": self.in_flight,
+            "queued": {AI_PRIORITY_NAMES[p]: n for p, n in self.depth_by_priority().items()},
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "service_ewma_ms": round(self.service_ewma * 1000, 1),
+            "estimated_wait_s": round(self.estimated_wait(AI_PRIORITY_NEW), 2),
+            "wait_max_ms": round(self.wait_max * 1000, 1)
+        }
 
-async def update_reply_time(user_id: int):
-    bot_state.last_reply_time[user_id] = get_current_time()
+ai_admission = AdmissionController(GEMINI_MAX_CONCURRENCY, ADMISSION_MAX_QUEUE, ADMISSION_MAX_WAIT)
 
-def get_user_name(message: Message) -> str:
-    try:
-        return message.from_user.first_name or f"User{message.from_user.id}"
-    except:
-        return "Unknown"
+def ai_priority(is_vip: bool, history: List[Dict]) -> int:
+    if is_vip:
+        return AI_PRIORITY_VIP
+    return AI_PRIORITY_KNOWN if history else AI_PRIORITY_NEW
 
-def get_user_id_safe(message: Message) -> Optional[int]:
-    try:
-        return message.from_user.id if message.from_user else None
-    except:
-        return None
+FALLBACK_REPLY = "Aryan off hai, aaega toh I will let you know"
+SAFETY_REPLY = "hmm kya bol rha hai"
+BUSY_REPLIES = (
+    "abhi thoda busy hu, baad mein baat karte",
+    "ek min bhai, thoda kaam mein hu",
+    "Aryan abhi busy hai, thodi der mein reply karega"
+)
 
-def escape_markdown(text: str) -> str:
-    if not text:
-        return ""
-    for char in ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']:
-        text = text.replace(char, f'\\{char}')
-    return text
+class ReplyCache:
+    # Caches several Gemini replies per (normalized opener, persona, time-of-day bucket)
+    # and only serves hits once enough variants exist to pick from
+    def __init__(self, max_entries: int, ttl: float, variants: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.variants = variants
+        self._entries: "OrderedDict[Tuple[str, str, int], Tuple[float, List[str]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+    
+    def make_key(self, text: str, persona: str) -> Optional[Tuple[str, str, int]]:
+        if len(text) > REPLY_CACHE_MAX_CHARS or count_words(text) > REPLY_CACHE_MAX_WORDS:
+            return None
+        normalized = normalize_text(text)
+        if not normalized:
+            return None
+        bucket = get_current_time().hour // REPLY_CACHE_BUCKET_HOURS
+        return (normalized, persona, bucket)
+    
+    def lookup(self, key: Tuple[str, str, int]) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] > self.ttl:
+            del self._entries[key]
+            entry = None
+        if entry is None or len(entry[1]) < self.variants:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return random.choice(entry[1])
+    
+    def store(self, key: Tuple[str, str, int], reply: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = (time.monotonic(), [])
+            self._entries[key] = entry
+        if reply not in entry[1] and len(entry[1]) < self.variants:
+            entry[1].append(reply)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def clear(self):
+        self._entries.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "skipped": self.skipped,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "gemini_calls_saved": self.hits
+        }
 
-async def safe_edit(message: Message, text: str, parse_mode: ParseMode = None) -> bool:
-    try:
-        await message.edit(text, parse_mode=parse_mode)
-        return True
-    except MessageNotModified:
-        return True
-    except:
-        return False
+reply_cache = ReplyCache(REPLY_CACHE_MAX_ENTRIES, REPLY_CACHE_TTL_SECONDS, REPLY_CACHE_VARIANTS)
 
-async def safe_reply(message: Message, text: str, parse_mode: ParseMode = None) -> bool:
-    try:
-        await message.reply(text, parse_mode=parse_mode)
-        return True
-    except FloodWait as e:
-        if e.value < 60:
-            await asyncio.sleep(e.value)
-            return await safe_reply(message, text, parse_mode)
+def has_recent_context(history: List[Dict]) -> bool:
+    if not history:
         return False
-    except:
-        return False
-
-async def safe_delete(message: Message) -> bool:
     try:
-        await message.delete()
-        return True
-    except:
+        last = datetime.fromisoformat(history[-1].get("time", ""))
+        if last.tzinfo is None:
+            last = TIMEZONE.localize(last)
+        return (get_current_time() - last).total_seconds() < REPLY_CACHE_CONTEXT_SECONDS
+    except Exception:
         return False
 
-# ═══════════════════════════════════════════════════════════════
-#                      GEMINI AI
-# ═══════════════════════════════════════════════════════════════
-
-ARYAN_PERSONALITY = """Tu Aryan hai (@MaiHuAryan). Telegram pe replies de raha hai.
+def response_text(response: Any) -> Tuple[str, str]:
+    # response.text raises when the candidate has no text parts, e.g. a thinking
+    # model that spent the whole max_output_tokens on thoughts (finish MAX_TOKENS)
+    feedback = getattr(response, "prompt_feedback", None)
+    if feedback is not None and getattr(feedback, "block_reason", 0):
+        return "", "BLOCKED"
+    candidates = getattr(response, "candidates", None) or []
+    if not candidates:
+        return "", "EMPTY"
+    candidate = candidates[0]
+    reason = getattr(candidate, "finish_reason", None)
+    finish = getattr(reason, "name", None) or str(reason)
+    content = getattr(candidate, "content", None)
+    parts = getattr(content, "parts", None) or []
+    text = "".join(getattr(part, "text", "") or "" for part in parts if not getattr(part, "thought", False))
+    return text, finish
 
-PERSONALITY:
-- Serious aur sarcastic ho
-- Hinglish mein naturally baat kar
-- Emojis BILKUL NAHI use kar
-- Short-medium replies de
-- Tu mostly serious rehta hai
+async def generate_reply(
+    prompt: str,
+    key_count: int,
+    max_output_tokens: Optional[int] = None,
+    kind: str = "reply",
+    max_chars: int = REPLY_MAX_CHARS
+) -> Optional[str]:
+    # Thinking tokens count against max_output_tokens, so the cap grows by exactly
+    # the configured budget and the rest stays the per-message reply size
+    generation_config = (
+        {
+            "max_output_tokens": max_output_tokens + GEMINI_THINKING_BUDGET,
+            "thinking_config": {"thinking_budget": GEMINI_THINKING_BUDGET},
+        }
+        if max_output_tokens else None
+    )
+    tried = set()
+    for attempt in range(min(GEMINI_MAX_RETRIES, key_count)):
+        key = await get_next_gemini_key(tried)
+        if not key:
+            break
+        if not gemini_breaker.allow():
+            key_scheduler.release(key)
+            break
+        tried.add(key)
+        responded = False
+        # Quota and safety errors are per key or per prompt; the backend itself answered
+        backend_ok = False
+        label = key_fingerprint(key)[:8]
+        try:
+            model = gemini_models.get(key, kind)
+            
+            async with gemini_semaphore:
+                started = time.monotonic()
+                response = await asyncio.wait_for(
+                    model.generate_content_async(
+                        prompt,
+                        generation_config=generation_config,
+                        request_options={"timeout": GEMINI_ATTEMPT_TIMEOUT}
+                    ),
+                    GEMINI_ATTEMPT_TIMEOUT
+                )
+            latency = time.monotonic() - started
+            key_scheduler.report_success(key, latency)
+            GEMINI_SECONDS.observe(latency, key=label)
+            GEMINI_REQUESTS.inc(key=label, outcome="ok")
+            responded = True
+            backend_ok = True
+            
+            text, finish = response_text(response)
+            reply = text.strip()
+            reply = reply.replace("Aryan:", "").strip().strip('"').strip("'")
+            reply = reply.replace("*", "").replace("_", "")
+            
+            if reply:
+                if len(reply) > max_chars:
+                    reply = reply[:max_chars] + "..."
+                return reply
+            # Every key gets the same prompt and config, so an empty answer would
+            # just repeat on the next one
+            GEMINI_REQUESTS.inc(key=label, outcome="empty")
+            if finish in ("SAFETY", "PROHIBITED_CONTENT", "BLOCKLIST", "BLOCKED"):
+                return SAFETY_REPLY
+            log_error(f"Gemini: empty {kind} (finish_reason={finish})")
+            return None
+                    
+        except asyncio.TimeoutError:
+            key_scheduler.report_failure(key)
+            GEMINI_REQUESTS.inc(key=label, outcome="timeout")
+            continue
+        except Exception as e:
+            error = str(e).lower()
+            if "quota" in error or "429" in error or "resource exhausted" in error:
+                key_scheduler.report_failure(key, quota=True)
+                GEMINI_REQUESTS.inc(key=label, outcome="quota")
+                backend_ok = True
+                continue
+            elif "safety" in error:
+                GEMINI_REQUESTS.inc(key=label, outcome="safety")
+                backend_ok = True
+                return SAFETY_REPLY
+            else:
+                if not responded:
+                    key_scheduler.report_failure(key)
+                    GEMINI_REQUESTS.inc(key=label, outcome="error")
+                continue
+        finally:
+            key_scheduler.release(key)
+            gemini_breaker.record(backend_ok)
+    
+    return None
 
-REPLY STYLE:
-- "kuch nhi, tu bta.."
-- "hn?"
-- "hn bhai bol bol"
-- "acha"
-- "hmm"
-- "dekh lenge"
-- "thik hai"
-- "soja" (for spam/bakwas)
+def estimate_tokens(text: str) -> int:
+    # Gemini averages ~4 characters per token on romanized Hinglish
+    return len(text) // 4 + 1
 
-SPECIAL RULES:
-- Bot question → "Kya farak padta hai, bol kaam kya hai"
-- Personal info → "Ye sab Aryan se seedha puch lena"
-- Money/earning → "Aryan se baat kar iske baare mein"
+def message_time(entry: Dict) -> Optional[datetime]:
+    try:
+        return parse_message_time(entry.get("time", ""))
+    except Exception:
+        return None
 
-VIP HANDLING:
-{vip_context}
+def format_turn(entry: Dict, max_chars: int) -> str:
+    sender = "User" if entry.get("sender") == "user" else "Aryan"
+    text = entry.get("text", "")
+    if len(text) > max_chars:
+        text = text[:max_chars] + "…"
+    return f"{sender}: {text}"
 
-Time: {current_time}
+def choose_max_output_tokens(text: str) -> int:
+    words = count_words(text)
+    if words <= 3:
+        return REPLY_TOKENS_SHORT
+    if words <= 25:
+        return REPLY_TOKENS_DEFAULT
+    return REPLY_TOKENS_LONG
 
-Recent chat:
-{history}
+def build_prompt(
+    text: str,
+    history: List[Dict],
+    summary: Optional[Dict],
+    vip_context: str,
+    budget: int = GEMINI_CONTEXT_LIMIT
+) -> Tuple[str, List[Dict]]:
+    # Newest turns first until the token budget runs out; older turns that the summary
+    # doesn't cover yet are returned so they can be folded in later
+    head = []
+    if vip_context:
+        head.append(vip_context)
+    head.append(f"Time: {get_current_time().strftime('%I:%M %p')}")
+    if summary and summary.get("text"):
+        head.append(f"Earlier in this chat: {summary['text']}")
+    tail = f"User: {text[:PROMPT_MESSAGE_MAX_CHARS]}\n\nReply (short, Hinglish, NO quotes):"
+    
+    remaining = budget - estimate_tokens("\n".join(head)) - estimate_tokens(tail)
+    lines = []
+    kept = 0
+    for entry in reversed(history[-PROMPT_MAX_TURNS:]):
+        line = format_turn(entry, PROMPT_TURN_MAX_CHARS)
+        cost = estimate_tokens(line)
+        if cost > remaining:
+            break
+        lines.append(line)
+        remaining -= cost
+        kept += 1
+    lines.reverse()
+    
+    covered = message_time({"time": summary.get("through", "")}) if summary else None
+    overflow = [
+        entry for entry in history[:len(history) - kept]
+        if covered is None or (message_time(entry) or covered) > covered
+    ]
+    
+    prompt = "\n".join(head) + "\n\nRecent chat:\n" + ("\n".join(lines) or "None") + "\n\n" + tail
+    return prompt, overflow
 
-User: {message}
+class ConversationSummarizer:
+    # Per-user rolling summary of turns that have scrolled out of the prompt window.
+    # Refreshed in the background after a reply, never on the reply path. Keyed by
+    # (account, user_id) like the history cache.
+    def __init__(self, max_users: int, min_turns: int):
+        self.max_users = max_users
+        self.min_turns = min_turns
+        self._cache: "OrderedDict[Tuple[str, int], Optional[Dict]]" = OrderedDict()
+        self._running: set = set()
+        self._tasks: set = set()
+        self.epoch = 0
+        self.updates = 0
+        self.failures = 0
+    
+    def _remember(self, key: Tuple[str, int], summary: Optional[Dict]):
+        self._cache[key] = summary
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_users:
+            self._cache.popitem(last=False)
+    
+    def seed(self, user_id: int, summary: Optional[Dict], epoch: int):
+        # Fill from a history read; skipped if an update or clear landed since
+        key = account_key(user_id)
+        if epoch == self.epoch and key not in self._cache and key not in self._running:
+            self._remember(key, summary)
+    
+    async def get(self, user_id: int) -> Optional[Dict]:
+        key = account_key(user_id)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        try:
+            summary = await db_call(storage.get_summary, user_id)
+        except Exception:
+            return None
+        self._remember(key, summary)
+        return summary
+    
+    def invalidate(self, user_id: int):
+        self.epoch += 1
+        self._cache.pop(account_key(user_id), None)
+    
+    def clear(self):
+        self.epoch += 1
+        name = current_account().name
+        for key in [key for key in self._cache if key[0] == name]:
+            del self._cache[key]
+    
+    def schedule(self, user_id: int, overflow: List[Dict], summary: Optional[Dict]):
+        if len(overflow) < self.min_turns or account_key(user_id) in self._running:
+            return
+        self._running.add(account_key(user_id))
+        task = asyncio.create_task(self._update(user_id, overflow, summary))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _update(self, user_id: int, overflow: List[Dict], summary: Optional[Dict]):
+        epoch = self.epoch
+        key = account_key(user_id)
+        try:
+            keys = await get_all_gemini_keys()
+            if not keys:
+                return
+            prompt = SUMMARY_PROMPT.format(
+                summary=(summary or {}).get("text") or "None",
+                turns="\n".join(format_turn(entry, SUMMARY_TURN_MAX_CHARS) for entry in overflow),
+                max_words=SUMMARY_MAX_CHARS // 6
+            )
+            PROMPT_TOKENS.observe(estimate_tokens(prompt), kind="summary")
+            async with ai_admission.admit(AI_PRIORITY_SUMMARY) as admitted:
+                if not admitted:
+                    return
+                text = await asyncio.wait_for(
+                    generate_reply(prompt, len(keys), SUMMARY_MAX_OUTPUT_TOKENS, "summary", SUMMARY_MAX_CHARS),
+                    GEMINI_REQUEST_TIMEOUT
+                )
+            if not text or text == SAFETY_REPLY:
+                self.failures += 1
+                return
+            through = overflow[-1].get("time", "")
+            await db_call(storage.set_summary, user_id, text, through)
+            if epoch == self.epoch:
+                self._remember(key, {"text": text, "through": through})
+            self.updates += 1
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"⚠️ Summary update failed for {user_id}: {e}")
+        finally:
+            self._running.discard(key)
 
-Reply (short, Hinglish, NO quotes):"""
+summarizer = ConversationSummarizer(HISTORY_CACHE_MAX_USERS, SUMMARY_MIN_TURNS)
 
-async def get_ai_response(user_id: int, text: str, is_vip: bool = False, vip_name: str = None) -> str:
-    fallback = "Aryan off hai, aaega toh I will let you know"
+async def get_ai_response(
+    user_id: int,
+    text: str,
+    is_vip: bool = False,
+    vip_name: str = None,
+    history: Optional[List[Dict]] = None
+) -> str:
+    fallback = FALLBACK_REPLY
     
     if not GEMINI_AVAILABLE:
         return fallback
     
     try:
-        history = get_conversation_history(user_id, 5)
-        context = ""
-        for msg in history[-3:]:
-            sender = "User" if msg.get("sender") == "user" else "Aryan"
-            context += f"{sender}: {msg.get('text', '')[:100]}\n"
+        if history is None:
+            history = await get_conversation_history(user_id, HISTORY_CACHE_DEPTH)
+        
+        cache_key = None
+        persona = f"{current_account().name}:{vip_name.lower() if is_vip and vip_name else ''}"
+        if has_recent_context(history):
+            reply_cache.skipped += 1
+        else:
+            cache_key = reply_cache.make_key(text, persona)
+            if cache_key is None:
+                reply_cache.skipped += 1
+            else:
+                cached = reply_cache.lookup(cache_key)
+                if cached:
+                    return cached
+        
+        if gemini_breaker.rejecting:
+            return fallback
         
         vip_context = ""
         if is_vip and vip_name:
@@ -737,262 +4073,442 @@ async def get_ai_response(user_id: int, text: str, is_vip: bool = False, vip_nam
             else:
                 vip_context = f"IMPORTANT: Ye {vip_name} hai (VIP). Friendly reh."
         
-        current_time = get_current_time().strftime("%I:%M %p")
+        summary = await summarizer.get(user_id)
+        prompt, overflow = build_prompt(text, history, summary, vip_context)
+        PROMPT_TOKENS.observe(estimate_tokens(prompt), kind="reply")
         
-        prompt = ARYAN_PERSONALITY.format(
-            vip_context=vip_context,
-            current_time=current_time,
-            history=context or "None",
-            message=text[:500]
-        )
-        
-        keys = get_all_gemini_keys()
+        keys = await get_all_gemini_keys()
         if not keys:
             return fallback
         
-        for attempt in range(min(GEMINI_MAX_RETRIES, len(keys))):
-            try:
-                key = get_next_gemini_key()
-                if not key:
-                    continue
-                
-                genai.configure(api_key=key)
-                model = genai.GenerativeModel(GEMINI_MODEL, safety_settings=SAFETY_SETTINGS)
-                
-                loop = asyncio.get_event_loop()
-                response = await loop.run_in_executor(None, model.generate_content, prompt)
-                
-                if response and response.text:
-                    reply = response.text.strip()
-                    reply = reply.replace("Aryan:", "").strip().strip('"').strip("'")
-                    reply = reply.replace("*", "").replace("_", "")
-                    
-                    if reply and len(reply) > 0:
-                        if len(reply) > 300:
-                            reply = reply[:300] + "..."
-                        return reply
-                        
-            except Exception as e:
-                if "quota" in str(e).lower() or "429" in str(e).lower():
-                    continue
-                elif "safety" in str(e).lower():
-                    return "hmm kya bol rha hai"
-                else:
-                    continue
-        
+        async with ai_admission.admit(ai_priority(is_vip, history)) as admitted:
+            if not admitted:
+                return random.choice(BUSY_REPLIES)
+            reply = await asyncio.wait_for(
+                generate_reply(prompt, len(keys), choose_max_output_tokens(text)),
+                GEMINI_REQUEST_TIMEOUT
+            )
+        summarizer.schedule(user_id, overflow, summary)
+        if reply and cache_key is not None and reply != SAFETY_REPLY:
+            reply_cache.store(cache_key, reply)
+        return reply or fallback
+    except asyncio.TimeoutError:
+        log_error(f"Gemini: no reply within {GEMINI_REQUEST_TIMEOUT}s")
         return fallback
-    except:
+    except Exception:
         return fallback
 
+# ═══════════════════════════════════════════════════════════════
+#                      USER MAILBOXES
+# ═══════════════════════════════════════════════════════════════
+
+class UserMailbox:
+    __slots__ = ("messages", "received", "task", "last_active")
+    
+    def __init__(self):
+        self.messages: List[Message] = []
+        self.received = 0
+        self.task: Optional[asyncio.Task] = None
+        self.last_active = time.monotonic()
+
+class MailboxRegistry:
+    # One actor per user: messages that arrive while a reply is being generated are
+    # queued, then answered together after a short quiet period. A message to an idle
+    # mailbox only waits `settle` (enough to pick up an album or paste delivered as
+    # several updates); the reply's typing delay already covers the follow-ups.
+    def __init__(self, debounce: float, max_wait: float, max_messages: int, idle_ttl: float, settle: float):
+        self.debounce = debounce
+        self.settle = settle
+        self.max_wait = max_wait
+        self.max_messages = max_messages
+        self.idle_ttl = idle_ttl
+        self._boxes: Dict[int, UserMailbox] = {}
+        self._last_sweep = time.monotonic()
+        self.merged_count = 0
+    
+    def __len__(self) -> int:
+        return len(self._boxes)
+    
+    @property
+    def active_count(self) -> int:
+        return sum(1 for box in self._boxes.values() if box.task is not None)
+    
+    def submit(self, user_id: int, message: Message, processor: Callable):
+        box = self._boxes.get(user_id)
+        if box is None:
+            box = self._boxes[user_id] = UserMailbox()
+        box.messages.append(message)
+        if len(box.messages) > self.max_messages:
+            del box.messages[0]
+        box.received += 1
+        box.last_active = time.monotonic()
+        if box.task is None:
+            box.task = asyncio.create_task(self._drain(user_id, box, processor))
+        self._sweep()
+    
+    async def _debounce(self, box: UserMailbox, quiet: float):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while True:
+            seen = box.received
+            await asyncio.sleep(min(quiet, max(0.0, deadline - loop.time())))
+            if box.received == seen or loop.time() >= deadline:
+                return
+    
+    async def _drain(self, user_id: int, box: UserMailbox, processor: Callable):
+        quiet = min(self.settle, self.debounce)
+        try:
+            while box.messages:
+                await self._debounce(box, quiet)
+                quiet = self.debounce
+                batch, box.messages = box.messages, []
+                if len(batch) > 1:
+                    self.merged_count += len(batch) - 1
+                try:
+                    await processor(batch)
+                except Exception as e:
+                    log_error(f"Handler: {e}")
+        finally:
+            box.task = None
+            box.last_active = time.monotonic()
+    
+    def _sweep(self):
+        now = time.monotonic()
+        if now - self._last_sweep < self.idle_ttl:
+            return
+        self._last_sweep = now
+        for user_id in [
+            uid for uid, box in self._boxes.items()
+            if box.task is None and not box.messages and now - box.last_active > self.idle_ttl
+        ]:
+            del self._boxes[user_id]
+
+mailboxes = AccountLocal("mailboxes")
+
+# ═══════════════════════════════════════════════════════════════
+#                      ACCOUNTS
+# ═══════════════════════════════════════════════════════════════
+
+class Account:
+    # One hosted Telegram session. Config, VIPs, history and stickers live in its own
+    # storage namespace; sends, log batching and per-user state are its own too.
+    # Gemini keys, the DB executor and pool, and the caches are shared.
+    def __init__(self, name: str, session_string: str, owner_id: int, primary: bool):
+        self.name = name
+        self.owner_id = owner_id
+        self.primary = primary
+        self.namespace = "" if primary else name
+        self.client = Client(
+            name=account_path("aryan_userbot", self.namespace),
+            api_id=API_ID,
+            api_hash=API_HASH,
+            session_string=session_string,
+            in_memory=False
+        )
+        self.storage: Optional[Storage] = None
+        self.config = ConfigCache(self)
+        self.state = BotState()
+        self.outbound = OutboundScheduler(
+            OUTBOUND_RATE_PER_SECOND, OUTBOUND_BURST, OUTBOUND_CHAT_INTERVAL, OUTBOUND_WORKERS, name
+        )
+        self.log_sink = LogSink(LOG_FLUSH_INTERVAL, LOG_BUFFER_MAX_LINES, account_path(LOG_SPILL_PATH, self.namespace))
+        self.mailboxes = MailboxRegistry(
+            MAILBOX_DEBOUNCE_SECONDS,
+            MAILBOX_MAX_WAIT_SECONDS,
+            MAILBOX_MAX_MESSAGES,
+            MAILBOX_IDLE_TTL,
+            MAILBOX_IDLE_SETTLE_SECONDS
+        )
+        self.context = contextvars.copy_context()
+        self.context.run(_current_account.set, self)
+        for func in HANDLERS:
+            for handler, group in func.handlers:
+                self.client.add_handler(handler, group)
+    
+    @property
+    def username(self) -> str:
+        me = getattr(self.client, "me", None)
+        if self.primary or me is None or not me.username:
+            return BOT_USERNAME
+        return me.username
+    
+    def run(self, coro: Any) -> asyncio.Task:
+        # The task and everything it spawns (including Pyrogram's handler workers when
+        # used for client.initialize()) resolve the AccountLocal singletons to this account
+        return self.context.run(asyncio.create_task, coro)
+
+class AccountRegistry:
+    def __init__(self):
+        self._accounts: List[Account] = []
+    
+    def __iter__(self):
+        return iter(self._accounts)
+    
+    def __len__(self) -> int:
+        return len(self._accounts)
+    
+    @property
+    def primary(self) -> Account:
+        if not self._accounts:
+            raise RuntimeError("no accounts loaded")
+        return self._accounts[0]
+    
+    def load(self, specs: List[Tuple[str, str, int]]) -> Account:
+        # Needs the running loop: Pyrogram binds each Client to it on construction
+        self._accounts = [
+            Account(name, session_string, owner_id, i == 0)
+            for i, (name, session_string, owner_id) in enumerate(specs)
+        ]
+        return self.primary
+    
+    def close_storage(self):
+        for account in self._accounts:
+            if account.storage is not None:
+                account.storage.close()
+        storage_failover.close()
+
+accounts = AccountRegistry()
+
 # ═══════════════════════════════════════════════════════════════
 #                      MESSAGE HANDLERS
 # ═══════════════════════════════════════════════════════════════
 
 async def show_action(client: Client, chat_id: int, duration: float = 3.0):
+    outbound.send_action(chat_id, lambda: client.send_chat_action(chat_id, ChatAction.TYPING))
+    await asyncio.sleep(duration)
+
+async def _keep_typing(client: Client, chat_id: int):
+    # Telegram clears "typing" after ~5s, so re-send it until cancelled
+    while True:
+        outbound.send_action(chat_id, lambda: client.send_chat_action(chat_id, ChatAction.TYPING))
+        await asyncio.sleep(TYPING_REFRESH_SECONDS)
+
+@asynccontextmanager
+async def typing_for(client: Client, chat_id: int, target: float, handler: str):
+    # Typing shows while the body runs; on exit, waits out whatever is left of target,
+    # so the reply lands after max(work, target) rather than work + target
+    started = time.monotonic()
+    task = asyncio.create_task(_keep_typing(client, chat_id))
     try:
-        await client.send_chat_action(chat_id, ChatAction.TYPING)
-        await asyncio.sleep(duration)
-    except:
-        await asyncio.sleep(duration)
+        yield
+        with pipeline_stage(handler, "delay"):
+            await asyncio.sleep(max(0.0, target - (time.monotonic() - started)))
+    finally:
+        task.cancel()
+
+async def process_private(client: Client, batch: List[Message]):
+    with pipeline_stage("private", "total"):
+        await _process_private(client, batch)
+
+async def _process_private(client: Client, batch: List[Message]):
+    message = batch[-1]
+    user_id = get_user_id_safe(message)
+    user_name = get_user_name(message)
+    
+    wait = reply_cooldown_remaining(user_id)
+    if wait > 0:
+        await asyncio.sleep(wait)
+    
+    texts = [m.text.strip() for m in batch if m.text and m.text.strip()]
+    media = [m for m in batch if not m.text]
+    
+    if not texts:
+        if not media:
+            return
+        for m in media:
+            await save_message(user_id, "[MEDIA]", "user", sent_time(m))
+        await show_action(client, message.chat.id)
+        reply = "Aryan ko aane do, dekh lega" if media[-1].voice else "mujhe kuch dikhai nhi de rha abhi"
+        await safe_reply(media[-1], reply)
+        await save_message(user_id, reply, "bot")
+        await update_reply_time(user_id)
+        MESSAGES_REPLIED.inc(account=current_account().name)
+        return
+    
+    text = "\n".join(texts)
+    
+    with pipeline_stage("private", "history"):
+        history = await get_conversation_history(user_id, HISTORY_CACHE_DEPTH)
+    is_first = len(history) == 0
+    
+    # Coalesced messages keep the time they were sent, not when the batch is processed
+    for m in batch:
+        await save_message(user_id, m.text.strip() if m.text else "[MEDIA]", "user", sent_time(m))
+    
+    if count_words(text) > MAX_WORDS_TO_REPLY:
+        await show_action(client, message.chat.id, 2)
+        await safe_reply(message, "Bhai itna lamba, summary bol")
+        await save_message(user_id, "Bhai itna lamba, summary bol", "bot")
+        await update_reply_time(user_id)
+        return
+    
+    if is_first and get_config("first_msg_enabled", True):
+        await show_action(client, message.chat.id)
+        reply = "⚠️ This is automated. Real reply baad mein.\n\nHn bhai bol, Aryan baad mein dekh lega"
+        await safe_reply(message, reply)
+        await save_message(user_id, reply, "bot")
+        await update_reply_time(user_id)
+        MESSAGES_REPLIED.inc(account=current_account().name)
+        return
+    
+    min_d, max_d = get_delay_range()
+    async with typing_for(client, message.chat.id, random.uniform(min_d, max_d), "private"):
+        with pipeline_stage("private", "ai"):
+            vip = await get_vip_info(user_id)
+            ai_reply = await get_ai_response(
+                user_id, text, vip is not None, vip.get("name") if vip else None, history=history
+            )
+    
+    with pipeline_stage("private", "send"):
+        await safe_reply(message, ai_reply)
+    await save_message(user_id, ai_reply, "bot")
+    
+    if should_send_sticker():
+        stickers = await get_all_stickers()
+        if stickers:
+            await safe_reply_sticker(message, random.choice(stickers))
+    
+    await update_reply_time(user_id)
+    MESSAGES_REPLIED.inc(account=current_account().name)
+    await send_log(f"💬 {user_name}\n📩 {text[:50]}\n📤 {ai_reply[:50]}")
 
-@app.on_message(filters.private & ~filters.me & ~filters.bot)
+@Client.on_message(filters.private & ~filters.me & ~filters.bot)
 async def handle_private(client: Client, message: Message):
     if not is_bot_active():
         return
     
     user_id = get_user_id_safe(message)
-    if not user_id or not bot_state.add_processing_user(user_id):
+    if not user_id or message.sticker:
         return
     
-    try:
-        user_name = get_user_name(message)
-        
-        if message.sticker:
-            return
-        
-        if not await check_reply_cooldown(user_id):
-            return
-        
-        if not message.text:
-            save_message(user_id, "[MEDIA]", "user")
-            await show_action(client, message.chat.id)
-            reply = "Aryan ko aane do, dekh lega" if message.voice else "mujhe kuch dikhai nhi de rha abhi"
-            await safe_reply(message, reply)
-            save_message(user_id, reply, "bot")
-            await update_reply_time(user_id)
-            BOT_STATS["messages_replied"] += 1
-            return
-        
-        text = message.text.strip()
-        if not text:
-            return
-        
-        history = get_conversation_history(user_id)
-        is_first = len(history) == 0
-        
-        save_message(user_id, text, "user")
-        
-        if is_spam(user_id, text):
-            await show_action(client, message.chat.id, 2)
+    with pipeline_stage("private", "spam"):
+        spam = is_spam(user_id, (message.text or "").strip())
+    if spam:
+        if spam_engine.should_warn(user_id):
             await safe_reply(message, "Ek baar bol, spam mat kar")
-            save_message(user_id, "Ek baar bol, spam mat kar", "bot")
-            await update_reply_time(user_id)
-            return
-        
-        if count_words(text) > MAX_WORDS_TO_REPLY:
-            await show_action(client, message.chat.id, 2)
-            await safe_reply(message, "Bhai itna lamba, summary bol")
-            save_message(user_id, "Bhai itna lamba, summary bol", "bot")
-            await update_reply_time(user_id)
-            return
-        
-        if is_first and get_config("first_msg_enabled", True):
-            await show_action(client, message.chat.id)
-            reply = "⚠️ This is automated. Real reply baad mein.\n\nHn bhai bol, Aryan baad mein dekh lega"
-            await safe_reply(message, reply)
-            save_message(user_id, reply, "bot")
-            await update_reply_time(user_id)
-            BOT_STATS["messages_replied"] += 1
-            return
-        
-        vip = get_vip_info(user_id)
-        ai_reply = await get_ai_response(user_id, text, vip is not None, vip.get("name") if vip else None)
-        
-        min_d, max_d = get_delay_range()
-        delay = random.uniform(min_d, max_d)
-        await show_action(client, message.chat.id, delay)
-        
-        await safe_reply(message, ai_reply)
-        save_message(user_id, ai_reply, "bot")
-        
-        if should_send_sticker():
-            stickers = get_all_stickers()
-            if stickers:
-                try:
-                    await asyncio.sleep(0.5)
-                    await message.reply_sticker(random.choice(stickers))
-                except:
-                    pass
-        
-        await update_reply_time(user_id)
-        BOT_STATS["messages_replied"] += 1
-        await send_log(f"💬 {user_name}\n📩 {text[:50]}\n📤 {ai_reply[:50]}")
-        
-    except Exception as e:
-        log_error(f"Handler: {e}")
-    finally:
-        bot_state.remove_processing_user(user_id)
+        return
+    
+    mailboxes.submit(user_id, message, partial(process_private, client))
 
-@app.on_message(filters.group & ~filters.me & ~filters.bot)
+@Client.on_message(filters.group & ~filters.me & ~filters.bot)
 async def handle_group(client: Client, message: Message):
     if not is_bot_active():
         return
     
-    if not message.text or f"@{BOT_USERNAME}" not in message.text:
+    mention = f"@{current_account().username}"
+    if not message.text or mention not in message.text:
         return
     
     user_id = get_user_id_safe(message)
-    if not user_id or not bot_state.add_processing_user(user_id):
+    if not user_id:
+        return
+    with pipeline_stage("group", "spam"):
+        spam = is_spam(user_id, message.text)
+    if spam or not bot_state.add_processing_user(user_id):
         return
     
+    started = time.perf_counter()
     try:
-        text = message.text.replace(f"@{BOT_USERNAME}", "").strip() or "mentioned"
-        save_message(user_id, f"[GROUP] {text}", "user")
+        text = message.text.replace(mention, "").strip() or "mentioned"
+        with pipeline_stage("group", "history"):
+            history = await get_conversation_history(user_id, HISTORY_CACHE_DEPTH)
+        await save_message(user_id, f"[GROUP] {text}", "user", sent_time(message))
         
-        vip = get_vip_info(user_id)
-        reply = await get_ai_response(user_id, text, vip is not None, vip.get("name") if vip else None)
+        async with typing_for(client, message.chat.id, GROUP_REPLY_DELAY_SECONDS, "group"):
+            with pipeline_stage("group", "ai"):
+                vip = await get_vip_info(user_id)
+                reply = await get_ai_response(
+                    user_id, text, vip is not None, vip.get("name") if vip else None, history=history
+                )
         
-        await show_action(client, message.chat.id)
         full_reply = f"{escape_markdown(reply)}\n\n_⚠️ This is automated_"
-        await safe_reply(message, full_reply, parse_mode=ParseMode.MARKDOWN)
-        save_message(user_id, reply, "bot")
-        BOT_STATS["messages_replied"] += 1
+        with pipeline_stage("group", "send"):
+            await safe_reply(message, full_reply, parse_mode=ParseMode.MARKDOWN)
+        await save_message(user_id, reply, "bot")
+        MESSAGES_REPLIED.inc(account=current_account().name)
         
     except Exception as e:
         log_error(f"Group: {e}")
     finally:
         bot_state.remove_processing_user(user_id)
+        PIPELINE_SECONDS.observe(
+            time.perf_counter() - started, account=current_account().name, handler="group", stage="total"
+        )
 
 # ═══════════════════════════════════════════════════════════════
 #                      COMMANDS (ALL 50+)
 # ═══════════════════════════════════════════════════════════════
 
-@app.on_message(filters.command("setowner") & filters.me)
+@Client.on_message(filters.command("setowner") & filters.me)
 @rate_limit(1)
 async def cmd_setowner(client: Client, message: Message):
     current = get_owner_id()
     if current != 0 and current != message.from_user.id:
         await safe_edit(message, "❌ Owner already set!")
         return
-    set_config("owner_id", message.from_user.id)
+    await set_config("owner_id", message.from_user.id)
     await safe_edit(message, f"✅ Owner: `{message.from_user.id}`")
 
-@app.on_message(filters.command("boton") & filters.me)
+@Client.on_message(filters.command("boton") & filters.me)
 @owner_only
 @rate_limit(2)
 async def cmd_boton(client: Client, message: Message):
-    set_config("bot_active", True)
+    await set_config("bot_active", True)
     await safe_edit(message, "🤖 **Bot Activated!**")
-    await send_log("🟢 Bot ON")
+    warmed = await prewarm_history_cache()
+    await send_log(f"🟢 Bot ON\n🔥 Prewarmed {warmed} chats")
+
+async def get_user_names(client: Client, ids: List[int]) -> Dict[int, str]:
+    # One unresolvable peer (PeerIdInvalid for a user this session never met) fails
+    # the whole batch, so fall back to resolving each id on its own
+    try:
+        users = await client.get_users(ids)
+        users = users if isinstance(users, list) else [users]
+    except Exception:
+        results = await asyncio.gather(*(client.get_users(uid) for uid in ids), return_exceptions=True)
+        users = [user for user in results if not isinstance(user, BaseException)]
+    return {user.id: user.first_name for user in users}
 
-@app.on_message(filters.command("botoff") & filters.me)
+@Client.on_message(filters.command("botoff") & filters.me)
 @owner_only
 @rate_limit(2)
 async def cmd_botoff(client: Client, message: Message):
-    set_config("bot_active", False)
+    await set_config("bot_active", False)
     
     summary = "🤖 **Bot OFF**\n\n"
     
-    if db is not None:  # ✅ FIXED
-        try:
-            cutoff = get_current_time() - timedelta(hours=24)
-            users_data = {}
-            
-            for doc in db.messages.find():
-                uid = doc.get("user_id")
-                msgs = doc.get("messages", [])
-                count = 0
-                for m in msgs:
-                    if m.get("sender") == "user":
-                        try:
-                            msg_time = datetime.fromisoformat(m.get("time", "2000-01-01"))
-                            if msg_time.tzinfo is None:
-                                msg_time = TIMEZONE.localize(msg_time)
-                            if msg_time > cutoff:
-                                count += 1
-                        except:
-                            pass
-                if count > 0:
-                    users_data[uid] = count
-            
-            if users_data:
-                summary += "📬 **24h Summary:**\n"
-                total = 0
-                for uid, cnt in sorted(users_data.items(), key=lambda x: x[1], reverse=True)[:10]:
-                    try:
-                        user = await client.get_users(uid)
-                        name = user.first_name or f"User{uid}"
-                        vip = get_vip_info(uid)
-                        if vip:
-                            name = f"👑 {vip.get('name', name)}"
-                    except:
-                        name = f"User{uid}"
-                    summary += f"• {name}: {cnt}\n"
-                    total += cnt
-                summary += f"\n**Total:** {total} from {len(users_data)}"
-        except:
-            pass
+    try:
+        activity = await get_activity_24h()
+        
+        if activity["top"]:
+            summary += "📬 **24h Summary:**\n"
+            ids = [uid for uid, _ in activity["top"]]
+            names = await get_user_names(client, ids)
+            vips = await get_vips_by_ids(ids)
+            for uid, cnt in activity["top"]:
+                name = names.get(uid) or f"User{uid}"
+                if uid in vips:
+                    name = f"👑 {vips[uid].get('name', name)}"
+                summary += f"• {name}: {cnt}\n"
+            summary += f"\n**Total:** {activity['total']} from {activity['users']}"
+    except Exception:
+        pass
     
     await safe_edit(message, summary)
     await send_log("🔴 Bot OFF")
 
-@app.on_message(filters.command("status") & filters.me)
+@Client.on_message(filters.command("status") & filters.me)
 @owner_only
 async def cmd_status(client: Client, message: Message):
     active = is_bot_active()
     uptime = str(datetime.now() - START_TIME).split('.')[0]
-    users = db.messages.count_documents({}) if db is not None else 0  # ✅ FIXED
-    vips = db.vips.count_documents({}) if db is not None else 0  # ✅ FIXED
+    users = await count_users()
+    vips = await count_vips()
+    keys = await get_all_gemini_keys()
+    stickers = await get_all_stickers()
+    cache = reply_cache.stats()
+    sends = outbound.stats()
+    ai = ai_admission.stats()
     
     text = f"""📊 **Status**
 
@@ -1000,20 +4516,26 @@ async def cmd_status(client: Client, message: Message):
 **Uptime:** {uptime}
 **Users:** {users}
 **VIPs:** {vips}
-**Keys:** {len(get_all_gemini_keys())}
-**Stickers:** {len(get_all_stickers())}
-**DB:** {"✅" if db is not None else "⚠️"}"""  # ✅ FIXED
+**Keys:** {len(keys)}
+**Stickers:** {len(stickers)}
+**Reply cache:** {cache["hits"]} hits / {cache["misses"]} misses ({cache["hit_rate"] * 100:.0f}%)
+**Outbound:** {sends["queue_depth"]} queued, avg wait {sends["wait_avg_ms"]:.0f}ms, {sends["flood_waits"]} floods
+**AI queue:** {ai["in_flight"]}/{ai["slots"]} running, {ai_admission.depth} queued, ~{ai["estimated_wait_s"]:.1f}s wait, {ai["shed"]} shed
+**DB:** {storage.name}{" (failover from mongo)" if storage_failover.active else ""}
+**Breakers:** {", ".join(b.describe() for b in circuit_breakers.values())}
+**Account:** {current_account().name} ({len(accounts)} hosted)
+**Startup:** {startup.describe()}"""
     
     await safe_edit(message, text)
 
-@app.on_message(filters.command("ping") & filters.me)
+@Client.on_message(filters.command("ping") & filters.me)
 async def cmd_ping(client: Client, message: Message):
     start = time.perf_counter()
     await safe_edit(message, "🏓 Pinging...")
     latency = (time.perf_counter() - start) * 1000
     await safe_edit(message, f"🏓 **Pong!** `{latency:.2f}ms`")
 
-@app.on_message(filters.command("help") & filters.me)
+@Client.on_message(filters.command("help") & filters.me)
 async def cmd_help(client: Client, message: Message):
     await safe_edit(message, """🤖 **Commands**
 
@@ -1024,7 +4546,7 @@ async def cmd_help(client: Client, message: Message):
 **Settings:** /firstmsg /delay /setlog
 **Memory:** /clearmemory /clearall""")
 
-@app.on_message(filters.command("addvip") & filters.me)
+@Client.on_message(filters.command("addvip") & filters.me)
 @owner_only
 async def cmd_addvip(client: Client, message: Message):
     if not message.reply_to_message:
@@ -1032,22 +4554,22 @@ async def cmd_addvip(client: Client, message: Message):
         return
     uid = message.reply_to_message.from_user.id
     name = message.reply_to_message.from_user.first_name
-    add_vip(uid, name)
+    await add_vip(uid, name)
     await safe_edit(message, f"✅ VIP: {name}")
 
-@app.on_message(filters.command("removevip") & filters.me)
+@Client.on_message(filters.command("removevip") & filters.me)
 @owner_only
 async def cmd_removevip(client: Client, message: Message):
     if not message.reply_to_message:
         return
     uid = message.reply_to_message.from_user.id
-    remove_vip(uid)
+    await remove_vip(uid)
     await safe_edit(message, "✅ Removed")
 
-@app.on_message(filters.command("listvip") & filters.me)
+@Client.on_message(filters.command("listvip") & filters.me)
 @owner_only
 async def cmd_listvip(client: Client, message: Message):
-    vips = get_all_vips()
+    vips = await get_all_vips()
     if not vips:
         await safe_edit(message, "No VIPs")
         return
@@ -1056,7 +4578,7 @@ async def cmd_listvip(client: Client, message: Message):
         text += f"• {v.get('name')} (`{v.get('user_id')}`)\n"
     await safe_edit(message, text)
 
-@app.on_message(filters.command("vipname") & filters.me)
+@Client.on_message(filters.command("vipname") & filters.me)
 @owner_only
 async def cmd_vipname(client: Client, message: Message):
     if len(message.command) < 3:
@@ -1064,50 +4586,53 @@ async def cmd_vipname(client: Client, message: Message):
     try:
         uid = int(message.command[1])
         name = " ".join(message.command[2:])
-        set_vip_name(uid, name)
+        await set_vip_name(uid, name)
         await safe_edit(message, f"✅ {name}")
     except:
         pass
 
-@app.on_message(filters.command("addkey") & filters.me)
+@Client.on_message(filters.command("addkey") & filters.me)
 @owner_only
 async def cmd_addkey(client: Client, message: Message):
     if len(message.command) < 2:
         return
     key = message.command[1].strip()
-    add_gemini_key(key)
-    await safe_edit(message, f"✅ Keys: {len(get_all_gemini_keys())}")
+    await add_gemini_key(key)
+    await safe_edit(message, f"✅ Keys: {len(await get_all_gemini_keys())}")
     await asyncio.sleep(2)
     await safe_delete(message)
 
-@app.on_message(filters.command("listkeys") & filters.me)
+@Client.on_message(filters.command("listkeys") & filters.me)
 @owner_only
 async def cmd_listkeys(client: Client, message: Message):
-    keys = get_all_gemini_keys()
-    await safe_edit(message, f"🔑 **Keys:** {len(keys)}")
+    keys = await get_all_gemini_keys()
+    text = f"🔑 **Keys:** {len(keys)} ({key_scheduler.healthy_count()} healthy)"
+    lines = key_scheduler.describe()
+    if lines:
+        text += "\n\n" + "\n".join(lines)
+    await safe_edit(message, text)
 
-@app.on_message(filters.command("clearkeys") & filters.me)
+@Client.on_message(filters.command("clearkeys") & filters.me)
 @owner_only
 async def cmd_clearkeys(client: Client, message: Message):
-    if db is not None:  # ✅ FIXED
-        db.gemini_keys.delete_one({"type": "keys"})
+    await clear_gemini_keys()
     await safe_edit(message, "✅ Keys cleared")
 
-@app.on_message(filters.command("addsticker") & filters.me)
+@Client.on_message(filters.command("addsticker") & filters.me)
 @owner_only
 async def cmd_addsticker(client: Client, message: Message):
     if not message.reply_to_message or not message.reply_to_message.sticker:
         return
-    add_sticker(message.reply_to_message.sticker.file_id)
-    await safe_edit(message, f"✅ Stickers: {len(get_all_stickers())}")
+    await add_sticker(message.reply_to_message.sticker.file_id)
+    await safe_edit(message, f"✅ Stickers: {len(await get_all_stickers())}")
 
-@app.on_message(filters.command("liststickers") & filters.me)
+@Client.on_message(filters.command("liststickers") & filters.me)
 @owner_only
 async def cmd_liststickers(client: Client, message: Message):
-    stickers = get_all_stickers()
+    stickers = await get_all_stickers()
     await safe_edit(message, f"📎 **Stickers:** {len(stickers)}")
 
-@app.on_message(filters.command("stickerchance") & filters.me)
+@Client.on_message(filters.command("stickerchance") & filters.me)
 @owner_only
 async def cmd_stickerchance(client: Client, message: Message):
     if len(message.command) < 2:
@@ -1117,12 +4642,12 @@ async def cmd_stickerchance(client: Client, message: Message):
     try:
         chance = int(message.command[1])
         if 0 <= chance <= 100:
-            set_config("sticker_chance", chance)
+            await set_config("sticker_chance", chance)
             await safe_edit(message, f"✅ {chance}%")
     except:
         pass
 
-@app.on_message(filters.command("firstmsg") & filters.me)
+@Client.on_message(filters.command("firstmsg") & filters.me)
 @owner_only
 async def cmd_firstmsg(client: Client, message: Message):
     if len(message.command) < 2:
@@ -1131,13 +4656,13 @@ async def cmd_firstmsg(client: Client, message: Message):
         return
     arg = message.command[1].lower()
     if arg in ["on", "1", "yes"]:
-        set_config("first_msg_enabled", True)
+        await set_config("first_msg_enabled", True)
         await safe_edit(message, "✅ First msg ON")
     elif arg in ["off", "0", "no"]:
-        set_config("first_msg_enabled", False)
+        await set_config("first_msg_enabled", False)
         await safe_edit(message, "✅ First msg OFF")
 
-@app.on_message(filters.command("delay") & filters.me)
+@Client.on_message(filters.command("delay") & filters.me)
 @owner_only
 async def cmd_delay(client: Client, message: Message):
     if len(message.command) < 2:
@@ -1148,46 +4673,42 @@ async def cmd_delay(client: Client, message: Message):
         parts = message.command[1].split("-")
         min_d = int(parts[0])
         max_d = int(parts[1]) if len(parts) > 1 else min_d
-        set_config("delay_min", min_d)
-        set_config("delay_max", max_d)
+        await set_config("delay_min", min_d)
+        await set_config("delay_max", max_d)
         await safe_edit(message, f"✅ {min_d}-{max_d}s")
     except:
         pass
 
-@app.on_message(filters.command("setlog") & filters.me)
+@Client.on_message(filters.command("setlog") & filters.me)
 @owner_only
 async def cmd_setlog(client: Client, message: Message):
     if len(message.command) < 2:
         return
     try:
         chat_id = int(message.command[1])
-        set_config("log_group_id", chat_id)
+        await set_config("log_group_id", chat_id)
         await safe_edit(message, f"✅ Log: `{chat_id}`")
         await send_log("🎉 Log configured!")
     except:
         pass
 
-@app.on_message(filters.command("clearmemory") & filters.me)
+@Client.on_message(filters.command("clearmemory") & filters.me)
 @owner_only
 async def cmd_clearmemory(client: Client, message: Message):
     if not message.reply_to_message:
         return
     uid = message.reply_to_message.from_user.id
-    if db is not None:  # ✅ FIXED
-        db.messages.delete_one({"user_id": uid})
+    await clear_user_messages(uid)
     await safe_edit(message, f"✅ Cleared: {uid}")
 
-@app.on_message(filters.command("clearall") & filters.me)
+@Client.on_message(filters.command("clearall") & filters.me)
 @owner_only
 async def cmd_clearall(client: Client, message: Message):
-    if db is None:  # ✅ FIXED
-        await safe_edit(message, "❌ No DB")
-        return
-    total = db.messages.count_documents({})
+    total = await count_users()
     bot_state.confirm_clear_time = get_current_time()
     await safe_edit(message, f"⚠️ Delete {total}?\n\n/confirmclear")
 
-@app.on_message(filters.command("confirmclear") & filters.me)
+@Client.on_message(filters.command("confirmclear") & filters.me)
 @owner_only
 async def cmd_confirmclear(client: Client, message: Message):
     if not bot_state.confirm_clear_time:
@@ -1197,34 +4718,138 @@ async def cmd_confirmclear(client: Client, message: Message):
         bot_state.confirm_clear_time = None
         await safe_edit(message, "❌ Expired")
         return
-    if db is not None:  # ✅ FIXED
-        count = db.messages.delete_many({}).deleted_count
-        await safe_edit(message, f"✅ Cleared {count}")
+    count = await clear_all_messages()
+    await safe_edit(message, f"✅ Cleared {count}")
     bot_state.confirm_clear_time = None
 
+# Every hosted account registers these on its own Client (see Account)
+HANDLERS = [obj for obj in list(globals().values()) if callable(obj) and hasattr(obj, "handlers")]
+
 # ═══════════════════════════════════════════════════════════════
 #                      STARTUP
 # ═══════════════════════════════════════════════════════════════
 
+class StartupTimer:
+    # Wall time of each startup phase; phases run concurrently, so they overlap
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.ready_after: Optional[float] = None
+        self.background: List[asyncio.Task] = []
+    
+    async def run(self, phase: str, awaitable: Any) -> Any:
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.phases[phase] = time.perf_counter() - started
+            STARTUP_SECONDS.set(self.phases[phase], phase=phase)
+    
+    def mark_ready(self):
+        self.ready_after = time.perf_counter() - self.started
+        STARTUP_SECONDS.set(self.ready_after, phase="ready")
+    
+    def describe(self) -> str:
+        parts = [f"{phase} {seconds:.2f}s" for phase, seconds in self.phases.items()]
+        ready = f"ready {self.ready_after:.2f}s" if self.ready_after is not None else "starting"
+        return f"{ready} ({', '.join(parts)})"
+
+startup = StartupTimer()
+
+async def login_telegram(client: Client):
+    # client.start() without initialize(): updates are not dispatched until storage is ready
+    is_authorized = await client.connect()
+    try:
+        if not is_authorized:
+            await client.authorize()
+        await client.invoke(GetState())
+        client.me = await client.get_me()
+    except Exception:
+        await client.disconnect()
+        raise
+
+async def ensure_indexes(account: Account):
+    delay = INDEX_RETRY_SECONDS
+    while True:
+        try:
+            await startup.run("indexes", db_call(account.storage.ensure_indexes))
+            return
+        except Exception as e:
+            logger.warning(f"⚠️ Index creation failed for {account.name}: {e}, retrying in {delay:.0f}s")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, INDEX_RETRY_MAX_SECONDS)
+
+async def init_storage():
+    backends = await startup.run("storage", db_call(connect_storage, [a.namespace for a in accounts]))
+    for account, backend in zip(accounts, backends):
+        account.storage = backend
+        # Indexes already exist after the first deploy; don't hold the first reply for them
+        startup.background.append(asyncio.create_task(ensure_indexes(account)))
+    await asyncio.gather(
+        startup.run("config", asyncio.gather(*(db_call(a.config.load) for a in accounts))),
+        startup.run("keys", key_scheduler.reload())
+    )
+
+async def init_gemini():
+    if GEMINI_AVAILABLE:
+        await startup.run("gemini_import", asyncio.to_thread(gemini_sdk))
+
 async def start_bot():
-    await app.start()
-    me = await app.get_me()
+    accounts.load(ACCOUNT_SPECS)
+    port = int(os.environ.get("PORT", 10000))
+    await startup.run("web", web_server.start("0.0.0.0", port))
+    logger.info(f"✅ Web server on port {port}")
     
+    await asyncio.gather(
+        startup.run("telegram", asyncio.gather(*(login_telegram(a.client) for a in accounts))),
+        init_storage(),
+        init_gemini()
+    )
+    if GEMINI_AVAILABLE:
+        gemini_models.warm(await get_all_gemini_keys())
+    for account in accounts:
+        account.config.start_watcher()
+    restored = message_buffer.restore(list(accounts))
+    if restored:
+        logger.info(f"♻️ Restored {restored} unsaved messages from {WRITE_BUFFER_SPILL_PATH}")
+    message_buffer.start()
+    storage_failover.start()
+    await asyncio.gather(*(account.run(account.client.initialize()) for account in accounts))
+    startup.mark_ready()
+    
+    users = "\n".join(
+        f"║  User: {a.client.me.first_name} [{a.name}] {'🟢 ON' if a.config.get('bot_active', False) else '🔴 OFF'}"
+        for a in accounts
+    )
     logger.info(f"""
 ╔══════════════════════════════════════════════════════════════╗
 ║            🤖 ARYAN'S USERBOT V5.3 STARTED                  ║
 ╠══════════════════════════════════════════════════════════════╣
-║  User: {me.first_name}
-║  Status: {'🟢 ON' if is_bot_active() else '🔴 OFF'}
-║  Database: {'✅ Connected' if db is not None else '⚠️ Memory'}
-║  Keys: {len(get_all_gemini_keys())}
-║  Port: {os.environ.get('PORT', 10000)}
+{users}
+║  Database: {'✅ MongoDB' if storage.name == 'mongo' else '💾 SQLite'}
+║  Keys: {len(await get_all_gemini_keys())}
+║  Port: {port}
+║  Startup: {startup.describe()}
 ╚══════════════════════════════════════════════════════════════╝
     """)
     
-    await send_log(f"🚀 V5.3 Started!\n{me.first_name}")
+    key_scheduler.start()
+    health_probe.start()
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    for account in accounts:
+        await account.run(send_log(f"🚀 V5.3 Started!\n{account.client.me.first_name}\n⏱ {startup.describe()}"))
     await idle()
-    await app.stop()
+    lag_monitor.cancel()
+    await health_probe.stop()
+    for account in accounts:
+        await account.run(account.log_sink.close())
+    await asyncio.gather(*(account.client.stop() for account in accounts))
+    await storage_failover.stop()
+    await message_buffer.close()
+    await key_scheduler.stop()
+    for account in accounts:
+        await account.outbound.stop()
+    await web_server.stop()
 
 # ═══════════════════════════════════════════════════════════════
 #                      MAIN
@@ -1233,10 +4858,6 @@ async def start_bot():
 if __name__ == "__main__":
     print("🚀 Starting Aryan's Userbot V5.3 FINAL...\n")
     
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    logger.info(f"✅ Web server on port {os.environ.get('PORT', 10000)}")
-    
     try:
         asyncio.get_event_loop().run_until_complete(start_bot())
     except KeyboardInterrupt:
@@ -1245,6 +4866,6 @@ if __name__ == "__main__":
         logger.critical(f"❌ Fatal: {e}")
         traceback.print_exc()
     finally:
-        if mongo_client is not None:  # ✅ FIXED
-            mongo_client.close()
+        db_executor.shutdown(wait=True)
+        accounts.close_storage()
         logger.info("Bot stopped")
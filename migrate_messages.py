@@ -0,0 +1,167 @@
+"""
+╔══════════════════════════════════════════════════════════════╗
+║         MESSAGE STORAGE MIGRATION - embedded → per_message   ║
+║                                                              ║
+║  Copies every embedded db.messages[*].messages entry into    ║
+║  one chat_messages document with a native BSON date, then    ║
+║  marks (or strips) the source array. Safe to re-run; each    ║
+║  run also copies messages appended since the last one.       ║
+║                                                              ║
+║  Usage: python migrate_messages.py [--dry-run] [--drop-embedded]
+║                                    [--account NAME ...]
+╚══════════════════════════════════════════════════════════════╝
+"""
+
+import os
+import sys
+import argparse
+import hashlib
+import logging
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+import pytz
+from dotenv import load_dotenv
+from pymongo import MongoClient, ReplaceOne
+
+BATCH_SIZE = 1000
+MAX_ACCOUNTS = 20
+TIMEZONE = pytz.timezone("Asia/Kolkata")
+FALLBACK_TIME = datetime(2000, 1, 1, tzinfo=pytz.utc)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def mongo_database_name(namespace: str) -> str:
+    # Same naming as main.py: the primary account keeps the original database
+    return f"aryan_userbot_{namespace}" if namespace else "aryan_userbot"
+
+def configured_accounts() -> List[Tuple[str, str]]:
+    # (name, namespace) for every account main.py would host, from the same env vars
+    accounts = [(os.getenv("ACCOUNT_NAME") or "main", "")]
+    for i in range(2, MAX_ACCOUNTS + 1):
+        session = os.getenv(f"SESSION_STRING_{i}")
+        if session and session.strip():
+            name = os.getenv(f"ACCOUNT_NAME_{i}") or f"account{i}"
+            accounts.append((name, name))
+    return accounts
+
+def parse_time(value) -> datetime:
+    if isinstance(value, datetime):
+        return value if value.tzinfo else pytz.utc.localize(value)
+    try:
+        parsed = datetime.fromisoformat(value)
+        return parsed if parsed.tzinfo else TIMEZONE.localize(parsed)
+    except Exception:
+        return FALLBACK_TIME
+
+def message_id(user_id: int, message: Dict, seen: Dict[str, int]) -> str:
+    # Derived from the message itself rather than its array position, which shifts
+    # when the capped array is trimmed between runs; the counter keeps exact
+    # duplicates apart
+    digest = hashlib.sha1(
+        f"{message.get('time')}|{message.get('sender')}|{message.get('text')}".encode()
+    ).hexdigest()[:16]
+    seen[digest] = seen.get(digest, 0) + 1
+    return f"{user_id}:{digest}:{seen[digest]}"
+
+def convert(user_id: int, messages: List[Dict]) -> List[Dict]:
+    seen: Dict[str, int] = {}
+    return [
+        {
+            "_id": message_id(user_id, m, seen),
+            "user_id": user_id,
+            "sender": m.get("sender", "user"),
+            "text": m.get("text", ""),
+            "time": parse_time(m.get("time"))
+        }
+        for m in messages
+    ]
+
+def migrate(db, dry_run: bool, drop_embedded: bool) -> Dict[str, int]:
+    stats = {"users": 0, "messages": 0, "skipped": 0}
+
+    if not dry_run:
+        db.chat_messages.create_index([("user_id", 1), ("time", -1)])
+        db.messages.create_index("last_active")
+
+    # Users marked migrated are read again: the bot keeps appending to the embedded
+    # array until it is switched to per_message, and the upserts below only add what
+    # an earlier run hasn't copied yet
+    query = {"messages.0": {"$exists": True}}
+    for doc in db.messages.find(query, {"user_id": 1, "messages": 1}, no_cursor_timeout=True).batch_size(100):
+        user_id = doc.get("user_id")
+        if user_id is None:
+            stats["skipped"] += 1
+            continue
+
+        docs = convert(user_id, doc.get("messages", []))
+        stats["users"] += 1
+        stats["messages"] += len(docs)
+        if dry_run or not docs:
+            continue
+
+        # Upserts on deterministic ids, so repeated or interrupted runs never
+        # duplicate messages
+        for i in range(0, len(docs), BATCH_SIZE):
+            db.chat_messages.bulk_write(
+                [ReplaceOne({"_id": d["_id"]}, d, upsert=True) for d in docs[i:i + BATCH_SIZE]],
+                ordered=False
+            )
+
+        last_active = max(d["time"] for d in docs)
+        update = {
+            "$set": {"migrated_to_chat_messages": True},
+            "$max": {"last_active": last_active.astimezone(pytz.utc).replace(tzinfo=None)}
+        }
+        if drop_embedded:
+            update["$unset"] = {"messages": ""}
+        db.messages.update_one({"_id": doc["_id"]}, update)
+
+    return stats
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Migrate embedded message arrays to per-message documents")
+    parser.add_argument("--dry-run", action="store_true", help="count what would be migrated without writing")
+    parser.add_argument("--drop-embedded", action="store_true", help="remove the embedded arrays after copying")
+    parser.add_argument(
+        "--account", action="append", metavar="NAME",
+        help="only migrate this account (repeatable); defaults to every configured account"
+    )
+    args = parser.parse_args()
+
+    load_dotenv()
+    uri = os.getenv("MONGO_URI")
+    if not uri:
+        logger.critical("❌ Missing required: MONGO_URI")
+        return 1
+
+    accounts = configured_accounts()
+    if args.account:
+        known = dict(accounts)
+        unknown = [name for name in args.account if name not in known]
+        if unknown:
+            logger.critical(f"❌ Unknown account: {', '.join(unknown)} (configured: {', '.join(known)})")
+            return 1
+        accounts = [(name, known[name]) for name in dict.fromkeys(args.account)]
+
+    mode = "Would migrate" if args.dry_run else "Migrated"
+    client = MongoClient(uri, serverSelectionTimeoutMS=5000)
+    try:
+        client.admin.command('ping')
+        for name, namespace in accounts:
+            database = mongo_database_name(namespace)
+            stats = migrate(client[database], args.dry_run, args.drop_embedded)
+            logger.info(
+                f"✅ {name} ({database}): {mode} {stats['messages']} messages "
+                f"for {stats['users']} users ({stats['skipped']} skipped)"
+            )
+    finally:
+        client.close()
+
+    if not args.dry_run:
+        logger.info("Set MESSAGE_STORAGE=per_message to read from the new layout")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())